@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Benchmarks JSON serialization (`fileserver.serialize`) of the responses of every route, comparing
+# the available JSON backends (the stdlib json module, and orjson if installed).  For each route it
+# reports the time to encode the route's response body, and the latency of the whole request
+# (through the flask test client; onion requests through their plaintext handlers, i.e. without the
+# onion encryption), with each backend.
+#
+# Usage: bench/serialize.py 'dbname=test user=joe' [--count N] [--size BYTES]
+#
+# The benchmark uses (and afterwards drops) a `sfs_bench` schema in the given database.
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__) + "/..")
+
+parser = argparse.ArgumentParser(description="Benchmark JSON response serialization")
+parser.add_argument("pgsql", help="postgresql connect string of the database to use")
+parser.add_argument("--count", type=int, default=2000, help="number of requests per test")
+parser.add_argument("--size", type=int, default=10_000, help="size of the uploaded file")
+args = parser.parse_args()
+
+from fileserver import config  # noqa: E402
+
+config.pgsql_connect_opts = {"conninfo": args.pgsql, "options": "-c search_path=sfs_bench"}
+config.BACKWARDS_COMPAT_IDS = False
+
+from fileserver.web import app  # noqa: E402
+from fileserver import db, onion_req, serialize, utils  # noqa: E402
+
+with open(os.path.dirname(__file__) + "/../schema.pgsql") as f:
+    schema = f.read()
+
+
+def timed(f):
+    times = []
+    for _ in range(args.count):
+        started = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - started)
+    return statistics.mean(times) * 1_000_000
+
+
+def bench(f):
+    """Returns the mean time of `f()` in µs for each backend"""
+    results = {}
+    for name in sorted(serialize.BACKENDS):
+        serialize.use(name)
+        f()  # warm up
+        results[name] = timed(f)
+    serialize.use(config.JSON_BACKEND)
+    return results
+
+
+with db.psql_pool.connection() as conn:
+    with conn.transaction():
+        conn.execute("DROP SCHEMA IF EXISTS sfs_bench CASCADE")
+        conn.execute("CREATE SCHEMA sfs_bench")
+        conn.execute("SET search_path TO sfs_bench")
+        conn.execute(schema)
+        conn.execute(
+            """
+            INSERT INTO releases (project, version_code, url, name)
+            SELECT id, 1002003, 'https://example.com', 'v1.2.3' FROM projects
+            """
+        )
+        conn.execute("INSERT INTO session_token_stats VALUES (240000000, 20000, 40000000)")
+        # A week of history, sampled every 10 minutes:
+        conn.execute(
+            """
+            INSERT INTO session_token_history (current_value, circulating_supply, total_nodes,
+                updated)
+            SELECT 1.234567 + i / 1000.0, 100000000 + i, 2000 + i % 50,
+                NOW() - i * '10 minutes'::interval
+            FROM generate_series(0, 7 * 144) i
+            """
+        )
+
+try:
+    client = app.test_client()
+    content = os.urandom(args.size)
+    id = client.post("/file", data=content).json["id"]
+    b64 = utils.encode_base64(content)
+
+    requests = (
+        ("POST", "/file", {"data": content}),
+        ("POST", "/files", {"json": {"file": b64}}),
+        ("GET", f"/file/{id}", {}),
+        ("GET", f"/files/{id}", {}),
+        ("GET", f"/file/{id}/info", {}),
+        ("GET", "/session_version?platform=desktop", {}),
+        ("GET", "/token_info?days=7", {}),
+        ("GET", "/stats", {}),
+        ("GET", "/stats/version_checks", {}),
+        ("GET", "/metrics", {}),
+        ("GET", "/session_version?platform=nokia", {}),
+    )
+
+    v3_body = serialize.dumps({"method": "GET", "endpoint": f"/file/{id}/info"})
+    v4_meta = serialize.dumps({"method": "GET", "endpoint": f"/file/{id}/info"})
+    v4_body = b"l%d:%se" % (len(v4_meta), v4_meta)
+
+    print(f"{args.count} requests of each; {args.size:,} byte file\n")
+    columns = sorted(serialize.BACKENDS)
+    header = ["{:<40}".format("request")]
+    header += ["{:>12}".format(f"{b} enc µs") for b in columns]
+    header += ["{:>12}".format(f"{b} req µs") for b in columns]
+    print(" ".join(header))
+
+    def report(name, encode, request):
+        row = ["{:<40}".format(name[:40])]
+        row += ["{:>12.1f}".format(encode[b]) if encode else "{:>12}".format("-") for b in columns]
+        row += ["{:>12.1f}".format(request[b]) for b in columns]
+        print(" ".join(row))
+
+    for method, path, kwargs in requests:
+        response = client.open(path, method=method, **kwargs)
+        assert response.status_code in (200, 404), f"{method} {path}: {response.status_code}"
+
+        encode = None
+        if response.mimetype == "application/json":
+            data = serialize.loads(response.get_data())
+            encode = bench(lambda: serialize.dumps(data))
+
+        report(
+            f"{method} {path}",
+            encode,
+            bench(lambda: client.open(path, method=method, **kwargs).get_data()),
+        )
+
+    with app.test_request_context("/oxen/v4/lsrpc", method="POST"):
+        report(
+            "POST /oxen/v3/lsrpc (plaintext)",
+            None,
+            bench(lambda: onion_req.handle_v3_onionreq_plaintext(v3_body)),
+        )
+        report(
+            "POST /oxen/v4/lsrpc (plaintext)",
+            None,
+            bench(lambda: onion_req.handle_v4_onionreq_plaintext(v4_body)),
+        )
+finally:
+    with db.psql_pool.connection() as conn:
+        conn.execute("DROP SCHEMA IF EXISTS sfs_bench CASCADE")
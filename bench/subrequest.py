@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Benchmarks onion sub-request handling, comparing the direct fast path for common endpoints
+# (`fileserver.subrequest.fast_subrequest`) with full flask dispatch of the same sub-requests.
+# Reports the per-request latency of `make_subrequest` for each endpoint with SUBREQUEST_FAST_PATH
+# enabled and disabled.
+#
+# Usage: bench/subrequest.py 'dbname=test user=joe' [--count N] [--size BYTES]
+#
+# The benchmark uses (and afterwards drops) a `sfs_bench` schema in the given database.
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__) + "/..")
+
+parser = argparse.ArgumentParser(description="Benchmark onion sub-request dispatch")
+parser.add_argument("pgsql", help="postgresql connect string of the database to use")
+parser.add_argument("--count", type=int, default=2000, help="number of requests per test")
+parser.add_argument("--size", type=int, default=10_000, help="size of the downloaded file")
+args = parser.parse_args()
+
+from fileserver import config  # noqa: E402
+
+config.pgsql_connect_opts = {"conninfo": args.pgsql, "options": "-c search_path=sfs_bench"}
+config.BACKWARDS_COMPAT_IDS = False
+
+from fileserver.web import app  # noqa: E402
+from fileserver import db  # noqa: E402
+from fileserver.subrequest import make_subrequest  # noqa: E402
+
+with open(os.path.dirname(__file__) + "/../schema.pgsql") as f:
+    schema = f.read()
+
+
+def run(method, path, body=None):
+    times = []
+    with app.test_request_context("/oxen/v4/lsrpc", method="POST"):
+        for _ in range(args.count):
+            started = time.perf_counter()
+            response, _headers = make_subrequest(method, path, body=body)
+            response.get_data()
+            times.append(time.perf_counter() - started)
+            assert response.status_code == 200, f"{method} {path}: {response.status_code}"
+    return times
+
+
+with db.psql_pool.connection() as conn:
+    with conn.transaction():
+        conn.execute("DROP SCHEMA IF EXISTS sfs_bench CASCADE")
+        conn.execute("CREATE SCHEMA sfs_bench")
+        conn.execute("SET search_path TO sfs_bench")
+        conn.execute(schema)
+        conn.execute(
+            """
+            INSERT INTO releases (project, version_code, url, name)
+            SELECT id, 1002003, 'https://example.com', 'v1.2.3' FROM projects
+            """
+        )
+
+try:
+    content = os.urandom(args.size)
+    with app.test_request_context("/oxen/v4/lsrpc", method="POST"):
+        id = make_subrequest("POST", "/file", body=content)[0].json["id"]
+
+    requests = (
+        ("GET", f"/file/{id}", None),
+        ("GET", f"/file/{id}/info", None),
+        ("GET", "/session_version?platform=desktop", None),
+        ("POST", "/file", content),
+    )
+
+    print(f"{args.count} requests of each; {args.size:,} byte file\n")
+    print("{:<40} {:>12} {:>12} {:>10}".format("request", "flask µs", "fast µs", "speedup"))
+    for method, path, body in requests:
+        results = {}
+        for fast in (False, True):
+            config.SUBREQUEST_FAST_PATH = fast
+            run(method, path, body)  # warm up
+            results[fast] = statistics.mean(run(method, path, body)) * 1_000_000
+        print(
+            "{:<40} {:>12.1f} {:>12.1f} {:>9.2f}x".format(
+                f"{method} {path[:30]}",
+                results[False],
+                results[True],
+                results[False] / results[True],
+            )
+        )
+finally:
+    with db.psql_pool.connection() as conn:
+        conn.execute("DROP SCHEMA IF EXISTS sfs_bench CASCADE")
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Benchmarks storing content-hash (i.e. BACKWARDS_COMPAT_IDS = False) uploads in the database,
+# comparing the old refresh-then-insert-in-a-savepoint approach with the single upsert statement
+# used by `fileserver.routes.upsert_file`.  Reports per-upload latency and the WAL volume generated
+# for new uploads and for re-uploads of existing files.
+#
+# Usage: bench/upload.py 'dbname=test user=joe' [--count N] [--size BYTES]
+#
+# The benchmark uses (and afterwards drops) a `sfs_bench` schema in the given database.
+
+import argparse
+from base64 import urlsafe_b64encode
+from hashlib import blake2b
+import os
+import psycopg
+import statistics
+import time
+
+parser = argparse.ArgumentParser(description="Benchmark content-hash file uploads")
+parser.add_argument("pgsql", help="postgresql connect string of the database to use")
+parser.add_argument("--count", type=int, default=200, help="number of uploads per test")
+parser.add_argument("--size", type=int, default=1_000_000, help="size of each upload")
+args = parser.parse_args()
+
+expiry = '14 days'
+
+
+def make_upload(size):
+    data = os.urandom(size)
+    return urlsafe_b64encode(blake2b(data, digest_size=33).digest()).decode(), data
+
+
+def store_old(conn, upload):
+    id, data = upload
+    refresh = """
+        UPDATE files SET uploaded = NOW(), expiry = NOW() + %s, accessed = NOW() WHERE id = %s
+        """
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute(refresh, (expiry, id))
+        if cur.rowcount == 0:
+            try:
+                with conn.transaction():
+                    cur.execute(
+                        "INSERT INTO files (id, data, size, expiry) "
+                        "VALUES (%s, %s, %s, NOW() + %s)",
+                        (id, data, len(data), expiry),
+                    )
+            except psycopg.errors.UniqueViolation:
+                cur.execute(refresh, (expiry, id))
+
+
+def store_new(conn, upload):
+    id, data = upload
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO files (id, data, size, expiry) VALUES (%s, %s, %s, NOW() + %s)
+            ON CONFLICT (id) DO UPDATE
+                SET uploaded = NOW(), expiry = EXCLUDED.expiry, accessed = NOW()
+            """,
+            (id, data, len(data), expiry),
+        )
+
+
+def wal_lsn(conn):
+    return conn.execute("SELECT pg_current_wal_lsn()").fetchone()[0]
+
+
+def run(conn, store, uploads):
+    start_lsn = wal_lsn(conn)
+    times = []
+    for upload in uploads:
+        started = time.perf_counter()
+        store(conn, upload)
+        times.append(time.perf_counter() - started)
+    wal = conn.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)", (start_lsn,)).fetchone()
+    return times, int(wal[0])
+
+
+conn = psycopg.connect(args.pgsql, autocommit=True)
+with open(os.path.dirname(__file__) + "/../schema.pgsql") as f:
+    schema = f.read()
+
+print(f"{args.count} uploads of {args.size:,} bytes each\n")
+print(
+    "{:<8} {:<10} {:>10} {:>10} {:>16}".format(
+        "method", "uploads", "mean ms", "p95 ms", "WAL/upload"
+    )
+)
+
+try:
+    for name, store in (("old", store_old), ("upsert", store_new)):
+        with conn.transaction():
+            conn.execute("DROP SCHEMA IF EXISTS sfs_bench CASCADE")
+            conn.execute("CREATE SCHEMA sfs_bench")
+            conn.execute("SET search_path TO sfs_bench")
+            conn.execute(schema)
+
+        uploads = [make_upload(args.size) for _ in range(args.count)]
+        for kind in ("new", "repeat"):
+            times, wal = run(conn, store, uploads)
+            print(
+                "{:<8} {:<10} {:>10.3f} {:>10.3f} {:>16,.0f}".format(
+                    name,
+                    kind,
+                    statistics.mean(times) * 1000,
+                    statistics.quantiles(times, n=20)[-1] * 1000,
+                    wal / len(uploads),
+                )
+            )
+finally:
+    conn.execute("DROP SCHEMA IF EXISTS sfs_bench CASCADE")
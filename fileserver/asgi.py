@@ -0,0 +1,249 @@
+from .web import app
+from . import config, db, http, serialize
+from .routes import FileDataStream
+from .timer import timer
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import psycopg
+import sys
+import tempfile
+
+# ASGI serving mode, as an alternative to uwsgi: run with any ASGI server, e.g.
+#
+#     uvicorn fileserver.asgi:application --workers 4
+#
+# Under uwsgi every request occupies a worker for its whole duration, including the time spent
+# receiving the request body from and sending the response to the client, so a few hundred slow
+# clients can tie up all of the workers.  Here the event loop does all of the network I/O: request
+# bodies are received in full (spooling large ones to a temporary file) before the request is
+# handled, and responses are sent afterwards, so only the actual handling of the request (database
+# queries, onion request crypto, file hashing, etc.) takes up one of the ASGI_THREADS handler
+# threads, and thousands of in-flight connections fit in a handful of processes.
+#
+# Requests are handled by the same flask app (and so the same routes, `make_subrequest`, `db.psql`,
+# etc.) as under uwsgi.  Downloads of file content stored in the database are streamed from the
+# event loop using `db.async_pool` (see routes.FileDataStream); other response bodies are iterated
+# in a handler thread, one chunk at a time.
+#
+# The periodic jobs (uwsgi timers, see timer.py) run in just one of the server processes, chosen
+# with a postgresql advisory lock.
+
+executor = ThreadPoolExecutor(max_workers=config.ASGI_THREADS, thread_name_prefix="sfs-handler")
+
+# Advisory lock id held by the process running the periodic jobs, and how often (in seconds) the
+# other processes check whether they need to take over.
+TIMERS_LOCK = 0x5F5_71AE
+TIMERS_LOCK_RETRY = 60
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def run(f, *args):
+    """Runs `f(*args)` in a handler thread, returning its result."""
+    return await asyncio.get_running_loop().run_in_executor(executor, f, *args)
+
+
+async def receive_body(receive):
+    """
+    Receives the request body.  Returns a tuple of the body and its size, where the body is either
+    bytes or, if larger than ASGI_SPOOL_SIZE, a temporary file containing it.  The body is None if
+    it is larger than ASGI_MAX_BODY.  Raises ClientDisconnected if the client goes away.
+    """
+    chunks, size, spool = [], 0, None
+    try:
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnected()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > config.ASGI_MAX_BODY:
+                if spool is not None:
+                    spool.close()
+                return None, size
+            if spool is None and size > config.ASGI_SPOOL_SIZE:
+                spool = await run(tempfile.TemporaryFile)
+                chunks.append(chunk)
+                await run(spool.writelines, chunks)
+                chunks = None
+            elif spool is not None:
+                await run(spool.write, chunk)
+            else:
+                chunks.append(chunk)
+            if not message.get("more_body"):
+                break
+    except BaseException:
+        if spool is not None:
+            spool.close()
+        raise
+    if spool is None:
+        return b"".join(chunks), size
+    await run(spool.seek, 0)
+    return spool, size
+
+
+def wsgi_environ(scope, body, size):
+    """Returns the WSGI environ (see PEP 3333) for the request of ASGI `scope`."""
+    server = scope.get("server") or ("localhost", None)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "CONTENT_LENGTH": str(size),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body) if isinstance(body, bytes) else body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if isinstance(body, bytes):
+        # Lets endpoints that would otherwise stream the body use it directly, without a copy:
+        environ["fileserver.body"] = body
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_LENGTH":
+            continue
+        key = name if name == "CONTENT_TYPE" else "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+def dispatch(environ):
+    """Handles a request with the flask app; runs in a handler thread.  Returns the response."""
+    with app.request_context(environ):
+        try:
+            return app.full_dispatch_request()
+        except Exception as e:
+            return app.handle_exception(e)
+
+
+async def send_response(send, environ, response):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": [
+                (k.lower().encode("latin-1"), v.encode("latin-1"))
+                for k, v in response.get_wsgi_headers(environ).to_wsgi_list()
+            ],
+        }
+    )
+    try:
+        if (
+            isinstance(response.response, FileDataStream)
+            and db.async_pool is not None
+            and environ["REQUEST_METHOD"] != "HEAD"
+        ):
+            async for chunk in response.response:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        elif isinstance(response.response, (list, tuple)):
+            # Already in memory, e.g. JSON responses
+            for chunk in response.get_app_iter(environ):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        else:
+            # Iterables that read from disk or the database block, so get each chunk in a thread:
+            chunks = iter(response.get_app_iter(environ))
+            while (chunk := await run(next, chunks, None)) is not None:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        response.close()
+
+
+async def send_error(send, code):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": code,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send({"type": "http.response.body", "body": serialize.status_body(code)})
+
+
+async def run_timer(secs, f):
+    while True:
+        await asyncio.sleep(secs)
+        try:
+            await run(f, 0)
+        except Exception as e:
+            app.logger.error(f"Periodic job {f.__name__} failed: {e}")
+
+
+async def run_timers():
+    """
+    Runs the periodic jobs registered with `timer` if (and for as long as) this process holds the
+    TIMERS_LOCK advisory lock.
+    """
+    conn = await psycopg.AsyncConnection.connect(db._pgsql_conninfo, **db._pgsql_kwargs)
+    try:
+        while True:
+            cur = await conn.execute("SELECT pg_try_advisory_lock(%s)", (TIMERS_LOCK,))
+            if (await cur.fetchone())[0]:
+                break
+            await asyncio.sleep(TIMERS_LOCK_RETRY)
+        app.logger.info("Running periodic jobs in this process")
+        await asyncio.gather(*(run_timer(secs, f) for secs, f in timer.registered))
+    finally:
+        await conn.close()
+
+
+async def lifespan(receive, send):
+    timers = None
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await db.async_connect()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            timers = asyncio.create_task(run_timers())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if timers is not None:
+                timers.cancel()
+            await db.async_close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """The ASGI application."""
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        raise RuntimeError(f"Unsupported ASGI request type {scope['type']}")
+
+    length = next((v for k, v in scope["headers"] if k.lower() == b"content-length"), b"0")
+    if length.isdigit() and int(length) > config.ASGI_MAX_BODY:
+        return await send_error(send, http.PAYLOAD_TOO_LARGE)
+
+    try:
+        body, size = await receive_body(receive)
+    except ClientDisconnected:
+        return
+    if body is None:
+        return await send_error(send, http.PAYLOAD_TOO_LARGE)
+
+    try:
+        environ = wsgi_environ(scope, body, size)
+        response = await run(dispatch, environ)
+        await send_response(send, environ, response)
+    finally:
+        if not isinstance(body, bytes):
+            body.close()
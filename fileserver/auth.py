@@ -0,0 +1,75 @@
+from . import cache, config
+
+from collections import OrderedDict
+from hashlib import blake2b
+import threading
+import time
+import nacl.bindings as sodium
+from nacl.signing import VerifyKey
+
+# Caches that take repeated work out of request authentication (see
+# routes.valid_blinded_version_id_for_auth):
+#
+# - A per-worker LRU cache of (up to AUTH_KEY_CACHE_SIZE) X-FS-Pubkey values that we have already
+#   checked for being valid Ed25519 points, along with their prepared VerifyKeys (or None for an
+#   invalid point).
+# - A replay cache (cache.auth_replays, shared by all workers when using uwsgi) of the requests
+#   whose signature we have verified, keyed by a hash of the pubkey, signature, and the signed
+#   request data (timestamp, method, path, and body hash).  Clients retrying a request through a
+#   different onion path send exactly the same signed request again, which then doesn't need to be
+#   verified again; entries expire when the timestamp leaves the accepted window, after which the
+#   request wouldn't be accepted anyway.
+
+# How far (in seconds) a request timestamp may be from the current time
+TIMESTAMP_WINDOW = 24 * 60 * 60
+
+_keys = OrderedDict()
+_keys_lock = threading.Lock()
+
+
+def verify_key(pk):
+    """
+    Returns the VerifyKey for 32-byte Ed25519 pubkey `pk`, or None if `pk` isn't a valid point.
+    """
+    with _keys_lock:
+        if pk in _keys:
+            _keys.move_to_end(pk)
+            key = _keys[pk]
+            cache.stats.incr('auth_key_cache_hits')
+            return key
+
+    cache.stats.incr('auth_key_cache_misses')
+    key = VerifyKey(pk) if sodium.crypto_core_ed25519_is_valid_point(pk) else None
+    with _keys_lock:
+        _keys[pk] = key
+        while len(_keys) > config.AUTH_KEY_CACHE_SIZE:
+            _keys.popitem(last=False)
+    return key
+
+
+def replay_key(pk, sig, signed):
+    """Returns the replay cache key of a request with pubkey `pk`, signature `sig` on `signed`."""
+    h = blake2b(digest_size=20)
+    for x in (pk, sig, signed):
+        h.update(x)
+    return h.hexdigest()
+
+
+def seen(key):
+    """Returns True if the request with replay cache key `key` was already verified."""
+    if cache.auth_replays is None:
+        return False
+    if cache.auth_replays.get(key) is None:
+        cache.stats.incr('auth_replay_misses')
+        return False
+    cache.stats.incr('auth_replay_hits')
+    return True
+
+
+def add(key, ts):
+    """Records a verified request with replay cache key `key` and timestamp `ts`."""
+    if cache.auth_replays is None:
+        return
+    ttl = int(ts + TIMESTAMP_WINDOW - time.time()) + 1
+    if ttl > 0:
+        cache.auth_replays.set(key, b'1', ttl)
@@ -0,0 +1,220 @@
+from . import config
+from .web import app
+
+from collections import OrderedDict
+import struct
+import threading
+import time
+
+try:
+    import uwsgi
+except ModuleNotFoundError:
+    uwsgi = None
+
+# In-memory caches shared by all workers.
+#
+# Under uwsgi these are backed by uwsgi caches, which live in shared memory and so are shared by all
+# of the worker processes (rather than each worker holding its own copy).  The caches must be
+# defined in the uwsgi configuration, e.g.:
+#
+#     cache2 = name=sfs_files,items=2000,blocksize=65536,blocks=2000,bitmap=1,purge_lru=1
+#     cache2 = name=sfs_missing,items=100000,blocksize=1,purge_lru=1
+#     cache2 = name=sfs_stats,items=2000,blocksize=8
+#     cache2 = name=sfs_versions,items=10,blocksize=65536
+#     cache2 = name=sfs_auth,items=100000,blocksize=1,purge_lru=1
+#
+# which gives a (LRU purged) 128MB file cache, a cache of recently requested nonexistent file ids,
+# a small cache for statistics counters, one for the /session_version responses, and one of
+# recently verified authenticated requests.  When not running under uwsgi, or if a cache is not
+# defined in the uwsgi configuration, we fall back to a cache local to the process (except for the
+# missing file cache, which is then disabled).
+
+
+class LocalCache:
+    """
+    Per-process cache used when no shared cache is available; evicts least recently used.  Safe to
+    use from multiple threads (e.g. the ASGI handler threads).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()  # key -> (value, expiry timestamp or 0)
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            if item[1] and item[1] <= time.time():
+                self._delete(key)
+                return None
+            self.items.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value, ttl=0):
+        with self.lock:
+            self._delete(key)
+            if len(value) > self.max_bytes:
+                return
+            self.items[key] = (value, time.time() + ttl if ttl else 0)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, (v, _) = self.items.popitem(last=False)
+                self.size -= len(v)
+
+    def delete(self, key):
+        with self.lock:
+            self._delete(key)
+
+    def _delete(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.size -= len(item[0])
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def counter(self, key):
+        return self.counters.get(key, 0)
+
+    def set_counter(self, key, value):
+        self.counters[key] = value
+
+
+class UwsgiCache:
+    """A cache shared by all uwsgi workers, stored in the uwsgi cache `name`."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def get(self, key):
+        return uwsgi.cache_get(key, self.name)
+
+    def set(self, key, value, ttl=0):
+        uwsgi.cache_update(key, value, ttl, self.name)
+
+    def delete(self, key):
+        uwsgi.cache_del(key, self.name)
+
+    def incr(self, key, amount=1):
+        uwsgi.cache_inc(key, amount, 0, self.name)
+
+    def counter(self, key):
+        return uwsgi.cache_num(key, self.name) or 0
+
+    def set_counter(self, key, value):
+        # uwsgi cache counters are stored as native 64-bit integers
+        uwsgi.cache_update(key, struct.pack('=q', value), 0, self.name)
+
+
+def uwsgi_cache_names():
+    """Returns the names of the caches defined in the uwsgi configuration."""
+    if uwsgi is None:
+        return set()
+    opts = uwsgi.opt.get('cache2', [])
+    if not isinstance(opts, list):
+        opts = [opts]
+    names = set()
+    for opt in opts:
+        if isinstance(opt, bytes):
+            opt = opt.decode()
+        for kv in opt.split(','):
+            k, _, v = kv.partition('=')
+            if k.strip() == 'name':
+                names.add(v.strip())
+    return names
+
+
+def open_cache(name, local_max_bytes):
+    """
+    Returns the shared cache with the given uwsgi cache name, or a LocalCache holding up to
+    `local_max_bytes` if there is no such uwsgi cache.
+    """
+    if name is not None and name in uwsgi_cache_names():
+        return UwsgiCache(name)
+    if uwsgi is not None and name is not None:
+        app.logger.warning(f"uwsgi cache '{name}' is not configured; using a per-process cache")
+    return LocalCache(local_max_bytes)
+
+
+files = open_cache(config.FILE_CACHE, config.FILE_CACHE_LOCAL_SIZE) if config.FILE_CACHE else None
+missing = None
+if config.MISSING_FILE_TTL:
+    # Only a shared cache will do here: an upload only clears the id in the worker that handled it
+    if config.MISSING_FILE_CACHE in uwsgi_cache_names():
+        missing = UwsgiCache(config.MISSING_FILE_CACHE)
+    elif uwsgi is not None:
+        app.logger.warning(
+            f"uwsgi cache '{config.MISSING_FILE_CACHE}' is not configured; "
+            "the missing file cache is disabled"
+        )
+stats = open_cache(config.STATS_CACHE, 0)
+versions = open_cache(config.VERSION_CACHE, 1_000_000)
+auth_replays = (
+    open_cache(config.AUTH_REPLAY_CACHE, 1_000_000) if config.AUTH_REPLAY_CACHE else None
+)
+
+# Cached file values are the upload and expiry unix timestamps followed by the file content
+_file_header = struct.Struct('!dd')
+
+
+def get_file(id):
+    """
+    Looks up a file in the file cache; returns a tuple of (data, uploaded, expiry) (the latter two
+    as unix timestamps) if found, None if not.
+    """
+    if files is None:
+        return None
+    val = files.get(id)
+    if val is None:
+        stats.incr('file_cache_misses')
+        return None
+    stats.incr('file_cache_hits')
+    uploaded, expiry = _file_header.unpack_from(val)
+    return val[_file_header.size :], uploaded, expiry
+
+
+def set_file(id, data, uploaded, expiry):
+    """
+    Adds a file to the file cache (if enabled and the file is small enough).  The cached value
+    expires when the file does.
+    """
+    if files is None or len(data) > config.FILE_CACHE_MAX_FILE_SIZE:
+        return
+    ttl = int(expiry - time.time())
+    if ttl > 0:
+        files.set(id, _file_header.pack(uploaded, expiry) + data, ttl)
+
+
+def drop_files(ids):
+    """Removes the given file ids from the file cache (e.g. because they have been deleted)."""
+    if files is None:
+        return
+    for id in ids:
+        files.delete(id)
+
+
+def is_missing(id):
+    """Returns True if `id` is known to not exist (i.e. because it was recently looked up)."""
+    if missing is None or missing.get(id) is None:
+        return False
+    stats.incr('missing_cache_hits')
+    return True
+
+
+def set_missing(id):
+    """Records that `id` does not exist, for the next MISSING_FILE_TTL seconds."""
+    if missing is None:
+        return
+    missing.set(id, b'1', config.MISSING_FILE_TTL)
+    stats.incr('missing_cache_adds')
+
+
+def drop_missing(id):
+    """Removes `id` from the nonexistent id cache; called when a file gets added."""
+    if missing is not None:
+        missing.delete(id)
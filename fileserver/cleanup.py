@@ -2,16 +2,209 @@ from flask import current_app
 from .web import app
 from . import db
 from . import config
+from . import cache, github, storage, token_info, version_checks
 from .timer import timer
-from .stats import log_stats
+from .stats import compact_file_stats, log_stats, pretty_bytes
 
 import re
-from datetime import datetime
-import requests
+import time
+from datetime import datetime, timedelta, timezone
+from psycopg import sql
 
 last_stats_printed = None
 
 
+def move_to_cold_tier(cur):
+    """
+    Moves files that haven't been accessed for COLD_AFTER from the files table to the cold tier
+    table, in batches of at most COLD_BATCH_SIZE files per call.
+    """
+    cur.execute(
+        sql.SQL(
+            """
+            WITH moved AS (
+                DELETE FROM files WHERE id IN (
+                    SELECT id FROM files WHERE accessed < NOW() - %s::interval
+                    ORDER BY accessed LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, data, blob, size, uploaded, expiry, accessed
+            )
+            INSERT INTO {cold} (id, data, blob, size, uploaded, expiry, accessed)
+            SELECT * FROM moved
+            ON CONFLICT (id) DO UPDATE SET
+                data = EXCLUDED.data, blob = EXCLUDED.blob, size = EXCLUDED.size,
+                uploaded = EXCLUDED.uploaded, expiry = EXCLUDED.expiry, accessed = EXCLUDED.accessed
+            """
+        ).format(cold=sql.Identifier(config.COLD_TABLE)),
+        (config.COLD_AFTER, config.COLD_BATCH_SIZE),
+    )
+    if cur.rowcount > 0:
+        app.logger.info(f"Moved {cur.rowcount} files to cold storage")
+
+
+def maintain_partitions(psql):
+    """
+    For a partitioned files table (see partition-files.pgsql), creates the daily partitions that
+    files uploaded from now on will go into, and drops partitions in which all files have expired,
+    releasing their blobs.  Returns the number of partitions dropped.
+    """
+    with psql.cursor() as cur:
+        cur.execute(
+            """
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'files'::regclass
+            """
+        )
+        existing = {r[0] for r in cur.fetchall() if re.fullmatch(r"files_p\d{8}", r[0])}
+
+        cur.execute(
+            """
+            SELECT generate_series(
+                (NOW() AT TIME ZONE 'UTC')::date,
+                ((NOW() + %s::interval) AT TIME ZONE 'UTC')::date + 1,
+                '1 day')::date
+            """,
+            (config.FILE_EXPIRY,),
+        )
+        for (day,) in cur.fetchall():
+            name = f"files_p{day:%Y%m%d}"
+            if name in existing:
+                continue
+            part = sql.Identifier(name)
+            start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+            with psql.transaction():
+                cur.execute(
+                    sql.SQL(
+                        "CREATE TABLE IF NOT EXISTS {} PARTITION OF files "
+                        "FOR VALUES FROM ({}) TO ({})"
+                    ).format(part, sql.Literal(start), sql.Literal(start + timedelta(days=1)))
+                )
+                cur.execute(
+                    sql.SQL("ALTER TABLE {} ALTER COLUMN data SET STORAGE EXTERNAL").format(part)
+                )
+
+        # A partition only holds files expiring before the end of its day, so once that day is
+        # over all of them have expired:
+        today = datetime.now(timezone.utc).strftime("%Y%m%d")
+        expired = sorted(name for name in existing if name[7:] < today)
+        for part in expired:
+            part = sql.Identifier(part)
+            with psql.transaction():
+                cur.execute(
+                    sql.SQL("SELECT DISTINCT blob FROM {} WHERE blob IS NOT NULL").format(part)
+                )
+                blobs = [r[0] for r in cur.fetchall()]
+                # Dropping the partition doesn't fire the file_stats triggers, so do their job:
+                cur.execute(
+                    sql.SQL(
+                        """
+                        INSERT INTO file_stats (tbl, day, shard, files, bytes)
+                        SELECT 'files', (uploaded AT TIME ZONE 'UTC')::date, 0,
+                            -COUNT(*), -SUM(size)
+                        FROM {} GROUP BY 2
+                        ON CONFLICT (tbl, day, shard) DO UPDATE SET
+                            files = file_stats.files + EXCLUDED.files,
+                            bytes = file_stats.bytes + EXCLUDED.bytes
+                        """
+                    ).format(part)
+                )
+                cur.execute(sql.SQL("DROP TABLE {}").format(part))
+            if blobs:
+                n = storage.release_blobs(psql, blobs)
+                app.logger.info(f"Removed {n} expired file blobs")
+
+    if expired:
+        app.logger.info(f"Dropped expired files partitions {', '.join(expired)}")
+    return len(expired)
+
+
+def expire_batch(cur, table, size_expr, blobs):
+    """
+    Deletes up to EXPIRY_BATCH_SIZE of the files from `table` that expired longest ago.  Returns a
+    tuple of the deleted file ids, blob hashes (for tables with a `blob` column), and sizes.
+    """
+    cur.execute(
+        sql.SQL(
+            """
+            DELETE FROM {t} WHERE id IN (
+                SELECT id FROM {t} WHERE expiry <= NOW()
+                ORDER BY expiry LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, {blob}, {size}
+            """
+        ).format(
+            t=sql.Identifier(table),
+            blob=sql.SQL("blob" if blobs else "NULL"),
+            size=sql.SQL(size_expr),
+        ),
+        (config.EXPIRY_BATCH_SIZE,),
+    )
+    rows = cur.fetchall()
+    return [r[0] for r in rows], [r[1] for r in rows if r[1] is not None], [r[2] for r in rows]
+
+
+def expire_files(psql):
+    """
+    Removes expired files in batches of EXPIRY_BATCH_SIZE (each deleted in its own transaction, so
+    that a large backlog of expired files doesn't turn into one huge, long-running delete), oldest
+    first, until there are no more expired files or EXPIRY_TIME_BUDGET seconds have passed (but
+    always at least one batch per table); any remaining expired files get removed on later calls.
+    Returns a tuple of the number of files and bytes removed and the number of expired files still
+    remaining.
+    """
+    started = time.monotonic()
+    removed = 0
+    removed_bytes = 0
+    remaining = 0
+    # (A partitioned files table gets cleaned up by `maintain_partitions` instead; that only applies
+    # to the primary, as the slave's files table is maintained the same way as an unpartitioned one)
+    partitioned = config.PARTITIONED_FILES and psql is db.psql
+    tables = [] if partitioned else [("files", "size", True)]
+    if config.COLD_TABLE is not None:
+        tables.append((config.COLD_TABLE, "size", True))
+    if config.BACKUP_TABLE is not None:
+        tables.append((config.BACKUP_TABLE, "length(data)", False))
+
+    with psql.cursor() as cur:
+        for table, size_expr, has_blobs in tables:
+            while True:
+                ids, blobs, sizes = expire_batch(cur, table, size_expr, has_blobs)
+                removed += len(ids)
+                removed_bytes += sum(s or 0 for s in sizes)
+                if psql is db.psql:
+                    cache.drop_files(ids)
+                if blobs:
+                    n = storage.release_blobs(psql, blobs)
+                    app.logger.info(f"Removed {n} expired file blobs")
+                if len(ids) < config.EXPIRY_BATCH_SIZE:
+                    break
+
+                if time.monotonic() - started >= config.EXPIRY_TIME_BUDGET:
+                    cur.execute(
+                        sql.SQL("SELECT COUNT(*) FROM {} WHERE expiry <= NOW()").format(
+                            sql.Identifier(table)
+                        )
+                    )
+                    remaining += cur.fetchone()[0]
+                    break
+
+    duration = time.monotonic() - started
+    if psql is db.psql:
+        cache.stats.incr('expired_files', removed)
+        cache.stats.incr('expired_bytes', removed_bytes)
+        cache.stats.set_counter('expiry_backlog', remaining)
+        cache.stats.set_counter('expiry_tick_ms', int(duration * 1000))
+    if removed or remaining:
+        app.logger.info(
+            "Expired {} files ({}) in {:.2f}s; {} expired files remaining".format(
+                removed, pretty_bytes(removed_bytes), duration, remaining
+            )
+        )
+    return removed, removed_bytes, remaining
+
+
 @timer(15, target="worker1")
 def periodic(signum):
     with app.app_context():
@@ -19,97 +212,28 @@ def periodic(signum):
             if not psql:
                 continue
 
-            with psql.cursor() as cur:
-                cur.execute("DELETE FROM files WHERE expiry <= NOW()")
-                if config.BACKUP_TABLE is not None:
-                    cur.execute(f"DELETE FROM {config.BACKUP_TABLE} WHERE expiry <= NOW()")
-
-                # NB: we do this infrequently (once every 30 minutes, per project) because Github rate
-                # limits if you make more than 60 requests in an hour.
-                # Limit to 1 because, if there are more than 1 outdated, it doesn't hurt anything to delay
-                # the next one by 30 seconds (and avoids triggering github rate limiting).
-                cur.execute(
-                    """
-                    SELECT id, name FROM projects
-                    WHERE updated < NOW() + '30 minutes ago' LIMIT 1
-                    """
-                )
-                row = cur.fetchone()
-                if row:
-                    projid, project = row
-                    latest = requests.get(
-                        f"https://api.github.com/repos/{project}/releases/latest", timeout=5
-                    ).json()
-
-                    # If the latest release doesn't have version information then don't bother continuing
-                    # this means something is invalid, or we were rate limited
-                    if 'tag_name' not in latest:
-                        app.logger.warn(
-                            f"'tag_name' key not found in latest release for project {project}"
-                        )
-                        continue
+            if config.PARTITIONED_FILES and psql is db.psql:
+                maintain_partitions(psql)
+            expire_files(psql)
+            try:
+                version_checks.maintain(psql)
+            except Exception as e:
+                app.logger.warning(f"Account version check maintenance failed: {e}")
 
-                    recent = requests.get(
-                        f"https://api.github.com/repos/{project}/releases?per_page=3", timeout=5
-                    ).json()
+            if psql is db.psql:
+                github.start()
 
-                    with psql.transaction():
-                        for release in recent:
-                            v = release["tag_name"]
-                            vresult = re.match(r'v?(\d{1,3})\.(\d{1,3})\.(\d{1,3})$', v)
-                            if not vresult:
-                                app.logger.warn(
-                                    f"Unknown {project} tag does not look like a x.y.z version: {v}'"
-                                )
-                                continue
-                            vcode = (
-                                1000000 * int(vresult.group(1))
-                                + 1000 * int(vresult.group(2))
-                                + int(vresult.group(3))
-                            )
-
-                            cur.execute(
-                                """
-                                INSERT INTO releases (project, prerelease, version_code, url, name, notes)
-                                VALUES (%s, %s, %s, %s, %s, %s)
-                                ON CONFLICT(project, version_code) DO UPDATE SET
-                                    prerelease = EXCLUDED.prerelease,
-                                    url = EXCLUDED.url,
-                                    name = EXCLUDED.name,
-                                    notes = EXCLUDED.notes
-                                    WHERE releases.prerelease != EXCLUDED.prerelease
-                                        OR releases.url != EXCLUDED.url
-                                        OR releases.name != EXCLUDED.name
-                                        OR releases.notes != EXCLUDED.notes
-                                    RETURNING id
-                                """,
-                                (
-                                    projid,
-                                    bool(release.get("prerelease")),
-                                    vcode,
-                                    release.get("html_url"),
-                                    release.get("name"),
-                                    release.get("body"),
-                                ),
-                            )
-                            row = cur.fetchone()
-                            if row:
-                                relid = row[0]
-                                # We either inserted or updated the row, so clear any assets and
-                                # readd them (in case the upload assets changed)
-                                cur.execute(
-                                    "DELETE FROM release_assets WHERE release = %s", (relid,)
-                                )
-                                for asset in release.get('assets', []):
-                                    cur.execute(
-                                        "INSERT INTO release_assets (release, name, url) VALUES (%s, %s, %s)",
-                                        (relid, asset['name'], asset['url']),
-                                    )
-
-                        cur.execute("UPDATE projects SET updated = NOW() WHERE id = %s", (projid,))
+            with psql.cursor() as cur:
+                if config.COLD_TABLE is not None and psql is db.psql:
+                    move_to_cold_tier(cur)
+
+                if psql is db.psql:
+                    token_info.poll(cur)
 
                 now = datetime.now()
                 global last_stats_printed
                 if last_stats_printed is None or (now - last_stats_printed).total_seconds() >= 3600:
+                    with psql.transaction():
+                        compact_file_stats(cur)
                     log_stats(cur)
                     last_stats_printed = now
@@ -0,0 +1,75 @@
+from . import config
+
+from hashlib import blake2b
+import secrets
+
+# Allocation of backwards-compatible integer file ids.
+#
+# Rather than picking random ids (and retrying when one is already taken) we take the next value of
+# a postgresql sequence and run it through a keyed permutation of the available id space.  Because
+# it is a permutation, distinct sequence values always give distinct ids, so allocation never
+# collides, while the ids still look random (and so don't reveal how many files we store, or let
+# anyone enumerate them).
+#
+# The permutation is a 4-round Feistel network over the smallest even number of bits that covers
+# the id space; values that land outside of the id space are fed through it again ("cycle walking")
+# until they land inside it, which preserves the permutation.  The key is generated once and stored
+# in the database: changing it would make the ids of new files collide with existing ones.
+
+FEISTEL_ROUNDS = 4
+
+_key = None
+
+
+def random_bits():
+    """Returns the number of non-fixed bits of a compat id (see BACKWARDS_COMPAT_IDS_FIXED_BITS)."""
+    return 53 - len(config.BACKWARDS_COMPAT_IDS_FIXED_BITS)
+
+
+def fixed_prefix():
+    """Returns the value of the fixed most significant bits of compat ids, shifted into place."""
+    msb = sum(y << x for x, y in enumerate(reversed(config.BACKWARDS_COMPAT_IDS_FIXED_BITS)))
+    return msb << random_bits()
+
+
+def permute(n, bits, key):
+    """Maps `n` in [0, 2^bits) to a unique, random-looking value in [0, 2^bits) using `key`."""
+    half = (bits + 1) // 2
+    mask = (1 << half) - 1
+    nbytes = (half + 7) // 8
+    while True:
+        left, right = n >> half, n & mask
+        for r in range(FEISTEL_ROUNDS):
+            f = blake2b(right.to_bytes(nbytes, "big"), digest_size=8, key=key, salt=bytes([r]))
+            left, right = right, left ^ (int.from_bytes(f.digest(), "big") & mask)
+        n = left << half | right
+        if n < 1 << bits:
+            return n
+
+
+def get_key(cur):
+    """Returns the permutation key stored in the database, generating it if not yet set."""
+    global _key
+    if _key is None:
+        row = cur.execute("SELECT key FROM compat_id_key").fetchone()
+        if row is None:
+            cur.execute(
+                "INSERT INTO compat_id_key (key) VALUES (%s) ON CONFLICT DO NOTHING",
+                (secrets.token_bytes(32),),
+            )
+            row = cur.execute("SELECT key FROM compat_id_key").fetchone()
+        _key = bytes(row[0])
+    return _key
+
+
+def allocate(cur):
+    """
+    Returns a new, never before allocated integer file id, or None if the id space has been used
+    up.
+    """
+    key = get_key(cur)
+    n = cur.execute("SELECT nextval('compat_file_ids')").fetchone()[0]
+    bits = random_bits()
+    if n >= 1 << bits:
+        return None
+    return fixed_prefix() | permute(n, bits, key)
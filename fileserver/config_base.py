@@ -13,9 +13,10 @@ BACKWARDS_COMPAT_IDS = True
 # Use this bit suffix in generated backwards compatible integer IDs.  This is intended to avoid
 # synchronization conflicts when setting up multi-master database synchronization.  The bits added
 # here (which must be an array of 0 or 1s) will be hard-coded into the most significant bits of the
-# value, then the remaining 53-bit determined randomly.  E.g. 1 reserved bit is enough for 2
-# servers, 2 is enough for 4, etc.  Each server in a cluster should have a different bit pattern
-# with exactly the same number of fixed bits.  Should be empty for a single server file server.
+# value, and the remaining bits are allocated (see fileserver/compat_ids.py) so as to look random.
+# E.g. 1 reserved bit is enough for 2 servers, 2 is enough for 4, etc.  Each server in a cluster
+# should have a different bit pattern with exactly the same number of fixed bits.  Should be empty
+# for a single server file server.
 BACKWARDS_COMPAT_IDS_FIXED_BITS = []
 
 # Maximum file size we will accept, in bytes.  This should generally be the same as Session's value,
@@ -32,17 +33,168 @@ MAX_FILE_SIZE_B64 = 8_000_000
 # use a precise unit.
 FILE_EXPIRY = '3 weeks'
 
+# If set to a directory then file content is stored on disk in this directory (in a sharded,
+# content-addressed blob store) rather than in the postgresql `files` table, which then only stores
+# the file metadata.  This keeps the database (and its WAL, vacuuming, and backups) small.  Existing
+# files can be moved out of the database with the `migrate_storage.py` script.  If None then file
+# content is stored in the database.
+FILE_STORAGE_DIR = None
+
+# Name of the uwsgi cache to use as an in-memory cache of recently downloaded files shared by all
+# workers, which takes repeated downloads of popular files off the database.  The cache has to be
+# defined in the uwsgi configuration (see fileserver/cache.py for an example).  If not running under
+# uwsgi then a per-process cache of FILE_CACHE_LOCAL_SIZE bytes is used instead.  None disables the
+# file cache.
+FILE_CACHE = None
+FILE_CACHE_LOCAL_SIZE = 64_000_000
+
+# Files larger than this are never put in the file cache
+FILE_CACHE_MAX_FILE_SIZE = 1_000_000
+
+# Requests for nonexistent files (e.g. from stale clients requesting expired files) are remembered
+# for this many seconds in the given uwsgi cache so that repeated requests for them don't need to
+# query the database.  This cache is only used if the uwsgi cache is defined (it is disabled when
+# not running under uwsgi, e.g. via ASGI), since an upload has to remove the id from the cache of
+# every worker.  With multi-master database synchronization (see BACKWARDS_COMPAT_IDS_FIXED_BITS)
+# a file uploaded to another master may still be reported as missing here for up to this long after
+# it has been synchronized, so keep this short (or set it to 0) in that case.  0 disables this
+# cache.
+MISSING_FILE_CACHE = 'sfs_missing'
+MISSING_FILE_TTL = 30
+
+# Name of the uwsgi cache used to keep statistics counters (such as file cache hits) shared across
+# workers.  If not running under uwsgi, or not defined in the uwsgi configuration, counters are
+# per-process.
+STATS_CACHE = 'sfs_stats'
+
+# Name of the uwsgi cache holding the precomputed /session_version responses, which the GitHub
+# poller updates whenever it updates a project (see fileserver/versions.py).  Responses that aren't
+# in the cache are built from the database and cached for SESSION_VERSION_TTL seconds; if the cache
+# isn't defined in the uwsgi configuration then that happens in every worker (other than the one
+# running the poller) every SESSION_VERSION_TTL seconds.
+VERSION_CACHE = 'sfs_versions'
+SESSION_VERSION_TTL = 60
+
+# Account version checks (from authenticated /session_version requests) are buffered by each worker
+# and written to the database in bulk once VERSION_CHECK_BATCH_SIZE have accumulated, and at least
+# every VERSION_CHECK_FLUSH_INTERVAL seconds (see fileserver/version_checks.py); a worker that
+# crashes loses the checks it hadn't written yet.  While the database is unavailable each worker
+# keeps at most VERSION_CHECK_MAX_BUFFER checks.
+VERSION_CHECK_BATCH_SIZE = 1000
+VERSION_CHECK_FLUSH_INTERVAL = 5
+VERSION_CHECK_MAX_BUFFER = 100_000
+
+# Raw account version checks (which are partitioned by day) are kept for this many days; each
+# finished day is first rolled up into daily per-platform check counts and unique user estimates,
+# which are kept indefinitely (and can be fetched from /stats/version_checks).
+VERSION_CHECK_RETENTION_DAYS = 30
+
+# /token_info responses are cached by each worker until new token history arrives (which is checked
+# every 15 seconds; see fileserver/token_info.py), but for at most this many seconds.
+TOKEN_INFO_TTL = 300
+
+
+# Set to True if the files table is partitioned by expiry day (see partition-files.pgsql, which has
+# to be applied to the database first).  Expired files are then removed by dropping whole expired
+# partitions, which is much cheaper than deleting them row by row.  Cannot be used with COLD_TABLE.
+# (This only applies to the primary database; expired files on the slave are deleted row by row).
+PARTITIONED_FILES = False
+
+# Expired files are deleted (every 15 seconds) in batches of EXPIRY_BATCH_SIZE files, oldest first,
+# for up to EXPIRY_TIME_BUDGET seconds; if there are more expired files than that (e.g. after
+# downtime) the rest get deleted over the following runs.
+EXPIRY_BATCH_SIZE = 1000
+EXPIRY_TIME_BUDGET = 5
+
+# JSON library used to encode responses (see fileserver/serialize.py): 'orjson' or 'json' (the
+# stdlib module), or None to use orjson if it is installed and json otherwise.
+JSON_BACKEND = None
+
+# Request authentication caches (see fileserver/auth.py): each worker keeps up to
+# AUTH_KEY_CACHE_SIZE validated pubkeys, and verified requests are remembered (until their timestamp
+# expires) in the uwsgi cache AUTH_REPLAY_CACHE so that identical retries don't need verifying
+# again.  If that uwsgi cache isn't configured then each worker remembers requests separately.  None
+# disables the replay cache.
+AUTH_KEY_CACHE_SIZE = 10_000
+AUTH_REPLAY_CACHE = 'sfs_auth'
+
+
+# Addresses from which the administrative endpoints (such as /stats) may be requested.  These are
+# never accessible via onion requests.
+ADMIN_ADDRESSES = ['127.0.0.1', '::1']
+
+# Onion sub-requests for the most common endpoints (file uploads and downloads, version checks,
+# etc.) call the endpoint directly rather than going through flask's full request dispatch, which
+# is considerably faster.  Set to False to dispatch all sub-requests through flask.
+SUBREQUEST_FAST_PATH = True
+
+# Limits on batched v4 onion requests (see onion_req.handle_v4_onion_request): the number of
+# sub-requests in one batch, and the total size of the response bodies (responses that don't fit
+# get a 413 error instead).  Consecutive GET sub-requests are run concurrently on a pool of
+# ONION_BATCH_THREADS threads per worker (0 to run everything sequentially); under uwsgi this
+# requires `enable-threads = true`.
+ONION_BATCH_MAX_REQUESTS = 10
+ONION_BATCH_MAX_SIZE = 6_000_000
+ONION_BATCH_THREADS = 4
+
+
+# Options for serving via ASGI (fileserver.asgi:application) rather than uwsgi.  Request bodies are
+# received and responses sent on the event loop, while the request handling itself runs on a pool
+# of ASGI_THREADS threads, so the number of concurrent (slow) clients isn't limited by the number of
+# workers.  Request bodies larger than ASGI_SPOOL_SIZE are spooled to a temporary file while being
+# received; bodies larger than ASGI_MAX_BODY are rejected.  ASGI_DB_CONNECTIONS is the maximum size
+# of the asyncio database pool used for streaming downloads.
+ASGI_THREADS = 32
+ASGI_MAX_BODY = 10_000_000
+ASGI_SPOOL_SIZE = 1_000_000
+ASGI_DB_CONNECTIONS = 32
+
 
 # postgresql connect options
 pgsql_connect_opts = {"dbname": "sessionfiles"}
 
 
+# Tiered storage: if set, files that haven't been downloaded (or re-uploaded) for COLD_AFTER are
+# moved, in the background, out of the `files` table into this table (`files_cold` from the
+# schema), which keeps the `files` table and its indices small enough to stay in memory.  The cold
+# table can be put in a different (e.g. slower, bigger) tablespace.  Reads fall through to the
+# cold table transparently; if COLD_PROMOTE is True then a file read from the cold table gets moved
+# back into the `files` table.  COLD_BATCH_SIZE limits how many files get moved every 15 seconds.
+COLD_TABLE = None
+COLD_AFTER = '3 days'
+COLD_PROMOTE = False
+COLD_BATCH_SIZE = 1000
+
+# Name of a table of old files (with just the id, data, uploaded, and expiry columns) to read files
+# from when not found in the files table.  Files are never added to this table, but they are
+# removed from it when they expire.
 BACKUP_TABLE = None
 
 # If not None then we replicate database changes into this database as well;
 # the value is as connection options dict, just like pgsql_connect_opts
 pgsql_slave = None
 
+# Changes are replicated to the slave asynchronously (see fileserver/replication.py): every
+# REPLICATION_INTERVAL seconds we replicate waiting changes in batches of REPLICATION_BATCH_SIZE
+# until there are none left or REPLICATION_TIME_BUDGET seconds have passed.
+REPLICATION_INTERVAL = 2
+REPLICATION_BATCH_SIZE = 100
+REPLICATION_TIME_BUDGET = 5
+
+
+# Session releases are checked for on GitHub (see fileserver/github.py) every GITHUB_POLL_INTERVAL
+# seconds per project (or GITHUB_RETRY_INTERVAL seconds after a failure), using conditional
+# requests so that checks of unchanged releases are cheap.  The poller runs on a background thread
+# of the first uwsgi worker unless GITHUB_POLLER_EXTERNAL is set, in which case it has to be run as
+# a separate process with `python3 -m fileserver.github` (e.g. via uwsgi's `attach-daemon`); the
+# workers then pick up changed releases within SESSION_VERSION_TTL seconds.
+# GITHUB_API can be changed to use some other GitHub API compatible server.
+GITHUB_API = 'https://api.github.com'
+GITHUB_POLL_INTERVAL = 1800
+GITHUB_RETRY_INTERVAL = 300
+GITHUB_TIMEOUT = 5
+GITHUB_POLLER_EXTERNAL = False
+
 
 # The default log level
 log_level = logging.INFO
@@ -2,26 +2,34 @@ from . import config
 from .postfork import postfork
 from .web import app
 
+from contextlib import contextmanager
 from flask import g
-from psycopg_pool import ConnectionPool
+import psycopg
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 from werkzeug.local import LocalProxy
 
 
 psql_pool = None
 slave_pool = None
 
+# Only set up when serving via ASGI (see asgi.py), by async_connect():
+async_pool = None
+
+# Connection info and options of the primary database, as used by the pools:
+_pgsql_conninfo = None
+_pgsql_kwargs = None
+
 @postfork
 def pg_connect():
-    global psql_pool, slave_pool
+    global psql_pool, slave_pool, _pgsql_conninfo, _pgsql_kwargs
 
     # Test suite sets this to handle the connection itself:
     if 'defer' in config.pgsql_connect_opts:
         return
 
-    conninfo = config.pgsql_connect_opts.pop('conninfo', '')
-    psql_pool = ConnectionPool(
-        conninfo, min_size=2, max_size=32, kwargs={**config.pgsql_connect_opts, "autocommit": True}
-    )
+    _pgsql_conninfo = config.pgsql_connect_opts.pop('conninfo', '')
+    _pgsql_kwargs = {**config.pgsql_connect_opts, "autocommit": True}
+    psql_pool = ConnectionPool(_pgsql_conninfo, min_size=2, max_size=32, kwargs=_pgsql_kwargs)
     psql_pool.wait()
 
     if config.pgsql_slave is not None:
@@ -32,6 +40,29 @@ def pg_connect():
         slave_pool.wait()
 
 
+async def async_connect():
+    """
+    Sets up `async_pool`, an asyncio connection pool to the primary database for code running on
+    the event loop when serving via ASGI.  Request handlers themselves still use `psql`.
+    """
+    global async_pool
+    async_pool = AsyncConnectionPool(
+        _pgsql_conninfo,
+        min_size=2,
+        max_size=config.ASGI_DB_CONNECTIONS,
+        kwargs=_pgsql_kwargs,
+        open=False,
+    )
+    await async_pool.open(wait=True)
+
+
+async def async_close():
+    global async_pool
+    if async_pool is not None:
+        await async_pool.close()
+        async_pool = None
+
+
 def get_psql_conn():
     global psql_pool
     if "psql" not in g:
@@ -60,3 +91,18 @@ def release_psql_conn(exception):
 
 psql = LocalProxy(get_psql_conn)
 slave = LocalProxy(get_slave_conn)
+
+
+@contextmanager
+def pipeline(conn):
+    """
+    Context manager that runs the statements issued on `conn` inside the block in pipeline mode,
+    that is, each statement is sent without waiting for the result of the previous one.  Yields a
+    function that syncs the pipeline (i.e. waits for all results so far).  If libpq is too old to
+    support pipeline mode this falls back to running the statements normally.
+    """
+    if psycopg.Pipeline.is_supported():
+        with conn.pipeline() as p:
+            yield p.sync
+    else:
+        yield lambda: None
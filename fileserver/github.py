@@ -0,0 +1,230 @@
+from .web import app
+from . import config, db, utils, versions
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import re
+import threading
+import time
+import requests
+
+# Polls GitHub for new Session releases.
+#
+# Every 15 seconds the poller looks for projects that haven't been checked for GITHUB_POLL_INTERVAL
+# seconds and fetches their recent releases from the GitHub API, all concurrently.  Requests are
+# conditional (If-None-Match with the ETag of the previous reply, stored in the projects table), so
+# checking a project whose releases haven't changed costs a single 304 reply (which also doesn't
+# count against GitHub's API rate limit).  Changed releases are applied to the database(s) by
+# updating just the release rows and assets that differ, and the /session_version response of the
+# platform gets rebuilt (see versions.py).
+#
+# No database cursor is held while waiting for GitHub, and the poller never runs on a thread that
+# serves requests: either it runs as a separate process (`python3 -m fileserver.github`, with
+# GITHUB_POLLER_EXTERNAL = True), or on a background thread of the first uwsgi worker.  (Only if
+# uwsgi has no python thread support does the periodic job in the first worker poll directly).
+
+_thread = None
+
+# Projects that failed to update, which we don't retry before the given time.monotonic() value:
+_retry_at = {}
+
+
+def fetch_releases(project, etag=None):
+    """
+    Fetches the most recent releases of GitHub project `project` (e.g. "oxen-io/session-desktop").
+    Returns a tuple of the list of releases (None if unchanged since the reply with ETag `etag`)
+    and the ETag of the reply.  Raises on failure.
+    """
+    headers = {"Accept": "application/vnd.github+json"}
+    if etag:
+        headers["If-None-Match"] = etag
+    r = requests.get(
+        f"{config.GITHUB_API}/repos/{project}/releases",
+        params={"per_page": 3},
+        headers=headers,
+        timeout=config.GITHUB_TIMEOUT,
+    )
+    if r.status_code == 304:
+        return None, etag
+    r.raise_for_status()
+    releases = r.json()
+    # Anything else (e.g. an error object) means something is invalid, or we were rate limited
+    if not isinstance(releases, list) or not all("tag_name" in rel for rel in releases):
+        raise ValueError("unexpected response: not a list of releases")
+    return releases, r.headers.get("ETag")
+
+
+def version_code(tag):
+    """Returns the numeric version code of a vX.Y.Z release tag, or None if not such a tag."""
+    vresult = re.match(r'v?(\d{1,3})\.(\d{1,3})\.(\d{1,3})$', tag)
+    if not vresult:
+        return None
+    return 1000000 * int(vresult[1]) + 1000 * int(vresult[2]) + int(vresult[3])
+
+
+def sync_assets(cur, release_id, assets):
+    """
+    Brings the release_assets of release `release_id` in line with GitHub release assets `assets`,
+    deleting and inserting only the assets that changed.
+    """
+    cur.execute("SELECT name, url FROM release_assets WHERE release = %s", (release_id,))
+    have = set(cur.fetchall())
+    want = list(dict.fromkeys((a["name"], a["url"]) for a in assets))
+
+    removed = have.difference(want)
+    if removed:
+        cur.executemany(
+            "DELETE FROM release_assets WHERE release = %s AND name = %s AND url = %s",
+            [(release_id, name, url) for name, url in removed],
+        )
+    added = [a for a in want if a not in have]
+    if added:
+        cur.executemany(
+            "INSERT INTO release_assets (release, name, url) VALUES (%s, %s, %s)",
+            [(release_id, name, url) for name, url in added],
+        )
+
+
+def update_project(psql, project_id, project, releases, etag):
+    """Applies the fetched `releases` of a project to the database `psql`."""
+    with psql.transaction(), psql.cursor() as cur:
+        for release in releases:
+            vcode = version_code(release["tag_name"])
+            if vcode is None:
+                app.logger.warning(
+                    f"Unknown {project} tag does not look like a x.y.z version: "
+                    f"{release['tag_name']}"
+                )
+                continue
+
+            cur.execute(
+                """
+                INSERT INTO releases (project, prerelease, version_code, url, name, notes)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT(project, version_code) DO UPDATE SET
+                    prerelease = EXCLUDED.prerelease,
+                    url = EXCLUDED.url,
+                    name = EXCLUDED.name,
+                    notes = EXCLUDED.notes
+                    WHERE releases.prerelease != EXCLUDED.prerelease
+                        OR releases.url != EXCLUDED.url
+                        OR releases.name IS DISTINCT FROM EXCLUDED.name
+                        OR releases.notes IS DISTINCT FROM EXCLUDED.notes
+                RETURNING id
+                """,
+                (
+                    project_id,
+                    bool(release.get("prerelease")),
+                    vcode,
+                    release.get("html_url"),
+                    release.get("name"),
+                    release.get("body"),
+                ),
+            )
+            row = cur.fetchone()
+            if row is None:
+                # Unchanged release, but its assets still might have changed
+                cur.execute(
+                    "SELECT id FROM releases WHERE project = %s AND version_code = %s",
+                    (project_id, vcode),
+                )
+                row = cur.fetchone()
+            sync_assets(cur, row[0], release.get("assets", []))
+
+        cur.execute(
+            "UPDATE projects SET updated = NOW(), etag = %s WHERE id = %s", (etag, project_id)
+        )
+
+
+def poll(psql, slave=None):
+    """
+    Checks all projects that are due for a check for new releases, and applies any changes to the
+    primary database `psql` and (if given) the `slave` database.  Returns the number of projects
+    that changed.
+    """
+    with psql.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, name, etag FROM projects
+            WHERE updated < NOW() - %s * '1 second'::interval
+            """,
+            (config.GITHUB_POLL_INTERVAL,),
+        )
+        now = time.monotonic()
+        projects = [p for p in cur.fetchall() if _retry_at.get(p[1], 0) <= now]
+    if not projects:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=len(projects)) as executor:
+        futures = [executor.submit(fetch_releases, name, etag) for _, name, etag in projects]
+
+    changed = 0
+    for (project_id, project, _), future in zip(projects, futures):
+        try:
+            releases, etag = future.result()
+            if releases is None:
+                for conn in (psql, slave):
+                    if conn:
+                        conn.execute(
+                            "UPDATE projects SET updated = NOW() WHERE id = %s", (project_id,)
+                        )
+            else:
+                update_project(psql, project_id, project, releases, etag)
+                if slave:
+                    try:
+                        update_project(slave, project_id, project, releases, etag)
+                    except Exception as e:
+                        app.logger.warning(f"Failed to update {project} releases on slave: {e}")
+                changed += 1
+                app.logger.info(f"Updated {project} releases")
+            _retry_at.pop(project, None)
+
+            # (Even if unchanged, as the response includes the time of the last update)
+            platform = versions.project_platform(project)
+            if platform is not None:
+                with psql.cursor() as cur:
+                    versions.refresh(cur, platform)
+
+        except Exception as e:
+            app.logger.warning(f"Failed to update {project} releases: {e}")
+            _retry_at[project] = time.monotonic() + config.GITHUB_RETRY_INTERVAL
+
+    return changed
+
+
+def poll_once():
+    """Runs `poll` with database connections from the pools."""
+    with ExitStack() as stack:
+        psql = stack.enter_context(db.psql_pool.connection())
+        slave = stack.enter_context(db.slave_pool.connection()) if db.slave_pool else None
+        return poll(psql, slave)
+
+
+def run():
+    """Polls GitHub every 15 seconds, forever."""
+    while True:
+        try:
+            poll_once()
+        except Exception as e:
+            app.logger.warning(f"GitHub release polling failed: {e}")
+        time.sleep(15)
+
+
+def start():
+    """
+    Called by the periodic job of the first worker: starts the poller thread (if not already
+    running), or polls directly if we don't have thread support.  Does nothing if the poller runs
+    as a separate process.
+    """
+    global _thread
+    if config.GITHUB_POLLER_EXTERNAL:
+        return
+    if not utils.threads_enabled():
+        poll(db.psql, db.slave)
+    elif _thread is None:
+        _thread = threading.Thread(target=run, name="sfs-github", daemon=True)
+        _thread.start()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,55 @@
+from hashlib import blake2b
+import math
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketch for estimating the number of distinct values added to it.  Sketches are
+    mergeable (the sketch of a union of sets is the register-wise maximum of their sketches) and
+    serialize to 2^`precision` bytes; the standard error of the estimate is 1.04/sqrt(2^precision),
+    i.e. about 1.6% for the default precision of 12 (a 4kB sketch).
+    """
+
+    def __init__(self, registers=None, precision=12):
+        if registers is not None:
+            precision = len(registers).bit_length() - 1
+            if len(registers) != 1 << precision:
+                raise ValueError("Invalid HyperLogLog sketch: size is not a power of 2")
+        self.precision = precision
+        self.registers = bytearray(registers if registers is not None else 1 << precision)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(registers=data)
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    def add(self, value):
+        """Adds a value (str or bytes) to the sketch."""
+        if isinstance(value, str):
+            value = value.encode()
+        h = int.from_bytes(blake2b(value, digest_size=8).digest(), 'big')
+        bits = 64 - self.precision
+        i, w = h >> bits, h & ((1 << bits) - 1)
+        rank = bits - w.bit_length() + 1
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def merge(self, other):
+        """Merges `other` (of the same precision) into this sketch; returns self."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches of different precisions")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """Returns the estimated number of distinct values added."""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction: linear counting is more accurate here
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
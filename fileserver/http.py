@@ -1,10 +1,14 @@
 OK = 200
+PARTIAL_CONTENT = 206
+NOT_MODIFIED = 304
 
 # error status codes:
 BAD_REQUEST = 400
 UNAUTHORIZED = 401
+FORBIDDEN = 403
 NOT_FOUND = 404
 PAYLOAD_TOO_LARGE = 413
+RANGE_NOT_SATISFIABLE = 416
 TOO_EARLY = 425
 INSUFFICIENT_STORAGE = 507
 INTERNAL_SERVER_ERROR = 500
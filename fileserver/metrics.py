@@ -0,0 +1,246 @@
+from .web import app
+from . import cache, db, http, replication
+from .routes import require_admin
+
+import flask
+from flask import request
+import time
+
+try:
+    import uwsgi
+except ModuleNotFoundError:
+    uwsgi = None
+
+# Prometheus-style metrics, served (in the Prometheus text format) by the /metrics endpoint.
+#
+# Metric values are kept as counters in the shared statistics cache (see cache.stats) so that they
+# are aggregated across all uwsgi workers.  Since we can't enumerate the keys of a uwsgi cache, only
+# metrics with a known set of label values are used: per-endpoint metrics are labelled with the
+# flask endpoint name (and response status class), and histograms use the fixed LATENCY_BUCKETS.
+#
+# Histogram observations only increment the counter of the bucket they fall into (plus the count
+# and sum); the cumulative bucket values that Prometheus expects are computed when rendering.  Sums
+# are kept in microseconds since the cache counters are integers.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+
+# psycopg_pool statistics (see ConnectionPool.get_stats()): counters, which we accumulate in the
+# shared stats, and gauges, which each worker reports separately and which we then sum.
+POOL_COUNTERS = (
+    "requests_num",
+    "requests_queued",
+    "requests_wait_ms",
+    "requests_errors",
+    "usage_ms",
+    "connections_num",
+    "connections_errors",
+    "returns_bad",
+)
+POOL_GAUGES = ("pool_size", "pool_available", "requests_waiting")
+
+# How often (in seconds) each worker adds its pool statistics to the shared stats
+POOL_STATS_INTERVAL = 1.0
+
+_last_pool_stats = 0
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def inc(name, amount=1, **labels):
+    """Increments counter metric `name`, with the given labels, by `amount`."""
+    cache.stats.incr(_key(name, sorted(labels.items())), amount)
+
+
+def observe(name, seconds, **labels):
+    """Records a duration, in seconds, in histogram metric `name`."""
+    le = next((f"{b:g}" for b in LATENCY_BUCKETS if seconds <= b), "+Inf")
+    labels = sorted(labels.items())
+    cache.stats.incr(_key(f"{name}_bucket", sorted(labels + [("le", le)])))
+    cache.stats.incr(_key(f"{name}_count", labels))
+    cache.stats.incr(_key(f"{name}_sum_us", labels), int(seconds * 1_000_000))
+
+
+class timed:
+    """Context manager that records the duration of the block in histogram metric `name`."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+def _pools():
+    return (("psql", db.psql_pool), ("slave", db.slave_pool))
+
+
+def _worker_ids():
+    return range(1, uwsgi.numproc + 1) if uwsgi is not None else (0,)
+
+
+def publish_pool_stats():
+    """
+    Adds this worker's connection pool statistics to the shared stats (at most once every
+    POOL_STATS_INTERVAL seconds).
+    """
+    global _last_pool_stats
+    now = time.monotonic()
+    if now - _last_pool_stats < POOL_STATS_INTERVAL:
+        return
+    _last_pool_stats = now
+
+    worker = uwsgi.worker_id() if uwsgi is not None else 0
+    for name, pool in _pools():
+        if pool is None:
+            continue
+        stats = pool.pop_stats()
+        for k in POOL_COUNTERS:
+            if stats.get(k):
+                inc(f"sfs_db_pool_{k}", stats[k], pool=name)
+        for k in POOL_GAUGES:
+            cache.stats.set_counter(
+                _key(f"sfs_db_pool_{k}", [("pool", name), ("worker", worker)]), stats.get(k, 0)
+            )
+
+
+@app.before_request
+def start_request_timer():
+    # Stored in the environ rather than `g` because sub-requests share the outer request's `g`
+    request.environ['fileserver.started'] = time.perf_counter()
+
+
+def record_request(endpoint, status_code, started=None):
+    """
+    Records a request to `endpoint` with response status `status_code`; `started` is the
+    time.perf_counter() value from when the request started.
+    """
+    inc("sfs_requests_total", endpoint=endpoint, status=f"{status_code // 100}xx")
+    if started is not None:
+        observe("sfs_request_duration_seconds", time.perf_counter() - started, endpoint=endpoint)
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or "none"
+    record_request(endpoint, response.status_code, request.environ.get('fileserver.started'))
+
+    # Sub-request bodies are already counted as part of the onion request that carried them:
+    if not request.environ.get('fileserver.subrequest'):
+        inc("sfs_request_bytes_total", request.content_length or 0, endpoint=endpoint)
+        inc("sfs_response_bytes_total", response.content_length or 0, endpoint=endpoint)
+        publish_pool_stats()
+
+    return response
+
+
+def _render_histogram(out, name, labels):
+    labels = sorted(labels)
+    total = 0
+    for b in [f"{b:g}" for b in LATENCY_BUCKETS] + ["+Inf"]:
+        key = _key(f"{name}_bucket", sorted(labels + [("le", b)]))
+        total += cache.stats.counter(key)
+        out.append(f"{key} {total}")
+    sum_us = cache.stats.counter(_key(f"{name}_sum_us", labels))
+    out.append(f"{_key(f'{name}_sum', labels)} {sum_us / 1e6}")
+    out.append(f"{_key(f'{name}_count', labels)} {total}")
+
+
+def render():
+    """Returns all metrics in the Prometheus text exposition format."""
+    endpoints = sorted(app.view_functions) + ["none"]
+    out = []
+
+    out.append("# TYPE sfs_requests_total counter")
+    for e in endpoints:
+        for s in STATUS_CLASSES:
+            key = _key("sfs_requests_total", [("endpoint", e), ("status", s)])
+            out.append(f"{key} {cache.stats.counter(key)}")
+
+    out.append("# TYPE sfs_request_duration_seconds histogram")
+    for e in endpoints:
+        _render_histogram(out, "sfs_request_duration_seconds", [("endpoint", e)])
+
+    for name in ("sfs_request_bytes_total", "sfs_response_bytes_total"):
+        out.append(f"# TYPE {name} counter")
+        for e in endpoints:
+            key = _key(name, [("endpoint", e)])
+            out.append(f"{key} {cache.stats.counter(key)}")
+
+    for name in (
+        "sfs_onion_decrypt_duration_seconds",
+        "sfs_onion_encrypt_duration_seconds",
+        "sfs_subrequest_duration_seconds",
+    ):
+        out.append(f"# TYPE {name} histogram")
+        _render_histogram(out, name, [])
+
+    pools = [name for name, pool in _pools() if pool is not None]
+    for k in POOL_COUNTERS:
+        out.append(f"# TYPE sfs_db_pool_{k} counter")
+        for name in pools:
+            key = _key(f"sfs_db_pool_{k}", [("pool", name)])
+            out.append(f"{key} {cache.stats.counter(key)}")
+    for k in POOL_GAUGES:
+        out.append(f"# TYPE sfs_db_pool_{k} gauge")
+        for name in pools:
+            total = sum(
+                cache.stats.counter(_key(f"sfs_db_pool_{k}", [("pool", name), ("worker", w)]))
+                for w in _worker_ids()
+            )
+            out.append(f"{_key(f'sfs_db_pool_{k}', [('pool', name)])} {total}")
+
+    # Other statistics kept elsewhere:
+    for name in (
+        "file_cache_hits",
+        "file_cache_misses",
+        "missing_cache_hits",
+        "missing_cache_adds",
+        "version_cache_hits",
+        "version_cache_misses",
+        "token_info_cache_hits",
+        "token_info_cache_misses",
+        "auth_key_cache_hits",
+        "auth_key_cache_misses",
+        "auth_replay_hits",
+        "auth_replay_misses",
+        "compat_id_retries",
+        "expired_files",
+        "expired_bytes",
+        "version_checks_written",
+        "version_checks_dropped",
+        "replication_done",
+        "replication_failures",
+    ):
+        out.append(f"# TYPE sfs_{name}_total counter")
+        out.append(f"sfs_{name}_total {cache.stats.counter(name)}")
+    for name in ("expiry_backlog", "expiry_tick_ms"):
+        out.append(f"# TYPE sfs_{name} gauge")
+        out.append(f"sfs_{name} {cache.stats.counter(name)}")
+
+    if replication.enabled():
+        with db.psql.cursor() as cur:
+            backlog, lag = replication.status(cur)
+        out.append("# TYPE sfs_replication_backlog gauge")
+        out.append(f"sfs_replication_backlog {backlog}")
+        out.append("# TYPE sfs_replication_lag_seconds gauge")
+        out.append(f"sfs_replication_lag_seconds {lag}")
+
+    return "\n".join(out) + "\n"
+
+
+@app.get("/metrics")
+def get_metrics():
+    require_admin()
+    return flask.Response(
+        render(), status=http.OK, content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -1,8 +1,9 @@
-from flask import request, abort
-import json
+from flask import request, abort, copy_current_request_context, Response
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.wsgi import FileWrapper
 
 from .web import app
-from . import crypto, http, utils
+from . import config, crypto, http, metrics, serialize, utils
 from .subrequest import make_subrequest
 
 from session_util.onionreq import OnionReqParser
@@ -13,7 +14,7 @@ def handle_v3_onionreq_plaintext(body):
         if not body.startswith(b'{'):
             raise RuntimeError("Invalid v3 onion request body: expected JSON object")
 
-        req = json.loads(body)
+        req = serialize.loads(body)
         endpoint, method = req['endpoint'], req['method']
         subreq_headers = {k.lower(): v for k, v in req.get('headers', {}).items()}
 
@@ -50,11 +51,15 @@ def handle_v3_onionreq_plaintext(body):
                 f"Onion sub-request for {endpoint} returned success, {len(data)} bytes"
             )
             return data
-        return json.dumps({'status_code': response.status_code}).encode()
+        return serialize.status_body(response.status_code)
 
     except Exception as e:
         app.logger.warning("Invalid onion request: {}".format(e))
-        return json.dumps({'status_code': http.BAD_REQUEST}).encode()
+        return serialize.status_body(http.BAD_REQUEST)
+
+
+V4_ERROR_META = {'code': http.BAD_REQUEST, 'headers': {'content-type': 'text/plain; charset=utf-8'}}
+V4_ERROR_BODY = b'Invalid v4 onion request'
 
 
 def handle_v4_onionreq_plaintext(body):
@@ -67,7 +72,10 @@ def handle_v4_onionreq_plaintext(body):
         # Metadata json; this element is always required:
         meta, belems = utils.bencode_consume_string(belems)
 
-        meta = json.loads(meta.tobytes())
+        meta = serialize.loads(meta.tobytes())
+
+        if isinstance(meta, list):
+            return handle_v4_batch(meta, belems)
 
         # Then we can have a second optional string containing the body:
         if len(belems) > 1:
@@ -77,38 +85,184 @@ def handle_v4_onionreq_plaintext(body):
         else:
             subreq_body = b''
 
+        meta, response = v4_subrequest(meta, subreq_body)
+        return bencode_v4_reply(meta, [response])
+
+    except Exception as e:
+        app.logger.warning("Invalid v4 onion request: {}".format(e))
+        return bencode_v4_reply(V4_ERROR_META, [Response(V4_ERROR_BODY)])
+
+
+def v4_subrequest(meta, body):
+    """
+    Makes the sub-request described by v4 request metadata `meta`, with request body `body`.
+    Returns the response metadata and the response.
+    """
+    try:
         method, endpoint = meta['method'], meta['endpoint']
         if not endpoint.startswith('/'):
             raise RuntimeError("Invalid v4 onion request: endpoint must start with /")
 
         response, headers = make_subrequest(
-            method, endpoint, headers=meta.get('headers', {}), body=subreq_body
-        )
-
-        data = response.get_data()
-        app.logger.debug(
-            f"Onion sub-request for {endpoint} returned {response.status_code}, {len(data)} bytes"
+            method, endpoint, headers=meta.get('headers', {}), body=body
         )
-
-        meta = {'code': response.status_code, 'headers': headers}
+        app.logger.debug(f"Onion sub-request for {endpoint} returned {response.status_code}")
+        return {'code': response.status_code, 'headers': headers}, response
 
     except Exception as e:
         app.logger.warning("Invalid v4 onion request: {}".format(e))
-        meta = {'code': http.BAD_REQUEST, 'headers': {'content-type': 'text/plain; charset=utf-8'}}
-        data = b'Invalid v4 onion request'
+        return V4_ERROR_META, Response(V4_ERROR_BODY)
+
 
-    meta = json.dumps(meta).encode()
-    return b''.join(
-        (b'l', str(len(meta)).encode(), b':', meta, str(len(data)).encode(), b':', data, b'e')
+if utils.threads_enabled() and config.ONION_BATCH_THREADS > 0:
+    batch_executor = ThreadPoolExecutor(
+        max_workers=config.ONION_BATCH_THREADS, thread_name_prefix="sfs-batch"
     )
+else:
+    batch_executor = None
+
+
+def handle_v4_batch(reqs, belems):
+    """
+    Handles a batch v4 request (see handle_v4_onion_request): `reqs` is the list of sub-request
+    metadata, and `belems` the remaining bencoded elements, i.e. the sub-request bodies.
+    """
+    if not 0 < len(reqs) <= config.ONION_BATCH_MAX_REQUESTS:
+        raise RuntimeError(
+            f"Invalid v4 batch request: {len(reqs)} sub-requests ∉ [1, "
+            f"{config.ONION_BATCH_MAX_REQUESTS}]"
+        )
+    if not all(isinstance(r, dict) for r in reqs):
+        raise RuntimeError("Invalid v4 batch request: sub-requests must be objects")
+    bodies = []
+    for _ in reqs:
+        b, belems = utils.bencode_consume_string(belems)
+        bodies.append(b)
+    if len(belems):
+        raise RuntimeError("Invalid v4 batch request: found more parts than sub-requests")
+
+    # Sub-requests run in order, except that consecutive GET requests run concurrently (each in its
+    # own app context, and so with its own database connection).
+    results = []
+    i = 0
+    while i < len(reqs):
+        j = i + 1
+        if batch_executor is not None and reqs[i].get('method') == 'GET':
+            while j < len(reqs) and reqs[j].get('method') == 'GET':
+                j += 1
+        if j - i > 1:
+            futures = [
+                batch_executor.submit(
+                    copy_current_request_context(v4_subrequest), reqs[k], bodies[k]
+                )
+                for k in range(i, j)
+            ]
+            results += [f.result() for f in futures]
+        else:
+            results.append(v4_subrequest(reqs[i], bodies[i]))
+        i = j
+
+    # Responses that would take the reply over the size limit are replaced with errors:
+    metas, responses = [], []
+    total = 0
+    for meta, response in results:
+        size = response_size(response)
+        if total + size > config.ONION_BATCH_MAX_SIZE:
+            response.close()
+            meta, response = {'code': http.PAYLOAD_TOO_LARGE, 'headers': {}}, Response(b'')
+            size = 0
+        total += size
+        metas.append(meta)
+        responses.append(response)
+
+    return bencode_v4_reply(metas, responses)
+
+
+def response_size(response):
+    """Returns the size of the body of `response`, reading it into memory if of unknown size."""
+    if response.is_sequence or response.content_length is None:
+        return len(response.get_data())
+    return response.content_length
+
+
+def bencode_v4_reply(meta, responses):
+    """
+    Returns the bencoded v4 onion request reply (see handle_v4_onion_request) consisting of
+    json-encodable metadata `meta` followed by the bodies of the flask responses `responses`, as a
+    bytearray.
+
+    The reply buffer is allocated up front and the bodies written directly into it (file bodies get
+    read from disk straight into it), so that the buffer is the only copy of the body that we make:
+    large file downloads would otherwise briefly need two or three times their size in memory.
+    """
+    meta = serialize.dumps(meta)
+    try:
+        sizes = [response_size(r) for r in responses]
+        reply = bytearray(
+            len(meta)
+            + sum(sizes)
+            + sum(len(str(n)) + 1 for n in [len(meta), *sizes])
+            + 2
+        )
+        out = memoryview(reply)
+        prefix = b'l%d:%s' % (len(meta), meta)
+        out[: len(prefix)] = prefix
+        out = out[len(prefix) :]
+
+        for response, size in zip(responses, sizes):
+            prefix = b'%d:' % size
+            out[: len(prefix)] = prefix
+            write_body(out[len(prefix) : len(prefix) + size], response)
+            out = out[len(prefix) + size :]
+        out[:] = b'e'
+    finally:
+        for r in responses:
+            r.close()
+
+    return reply
+
+
+def write_body(out, response):
+    """Writes the body of `response` into memoryview `out`, which must be exactly its size."""
+    body = response.get_data() if response.is_sequence else response.response
+    if isinstance(body, bytes):
+        # Already in memory (in which case get_data() doesn't copy it)
+        out[:] = body
+    elif isinstance(body, FileWrapper):
+        while out:
+            n = body.file.readinto(out)
+            if not n:
+                raise RuntimeError("Unexpected end of file reading response body")
+            out = out[n:]
+    else:
+        pos = 0
+        for chunk in body:
+            out[pos : pos + len(chunk)] = chunk
+            pos += len(chunk)
+        if pos != len(out):
+            raise RuntimeError(f"Response body size {pos} != Content-Length {len(out)}")
+
+
+# Whether parser.encrypt_reply accepts a bytearray, which depends on the session_util build; if not
+# we have to pass it a bytes copy of the reply instead.
+_encrypt_bytearray = True
+
+
+def encrypt_reply(parser, reply):
+    global _encrypt_bytearray
+    if isinstance(reply, bytearray) and _encrypt_bytearray:
+        try:
+            return parser.encrypt_reply(reply)
+        except TypeError:
+            app.logger.warning("OnionReqParser.encrypt_reply requires bytes; copying replies")
+            _encrypt_bytearray = False
+    return parser.encrypt_reply(bytes(reply))
 
 
 def decrypt_onionreq():
     try:
-        return OnionReqParser(
-            crypto.server_pubkey_bytes,
-            crypto._privkey_bytes,
-            request.data)
+        with metrics.timed("sfs_onion_decrypt_duration_seconds"):
+            return OnionReqParser(crypto.server_pubkey_bytes, crypto._privkey_bytes, request.data)
     except Exception as e:
         app.logger.warning("Failed to decrypt onion request: {}".format(e))
     abort(http.BAD_REQUEST)
@@ -154,7 +308,10 @@ def handle_onion_request():
     """
 
     parser = decrypt_onionreq()
-    return utils.encode_base64(parser.encrypt_reply(handle_v3_onionreq_plaintext(parser.payload)))
+    response = handle_v3_onionreq_plaintext(parser.payload)
+    with metrics.timed("sfs_onion_encrypt_duration_seconds"):
+        response = parser.encrypt_reply(response)
+    return utils.encode_base64(response)
 
 
 @app.post("/oxen/v4/lsrpc")
@@ -243,6 +400,24 @@ def handle_v4_onion_request():
     Error responses (e.g. a 403) are not treated specially; that is: they still have a "code" set to
     the response code and "headers" and a body part of whatever the request returned for a body).
 
+    Batch requests:
+        Several requests can be made at once, with a single onion request, by sending a json *list*
+        of request metadata objects as the first string, followed by exactly one body string for
+        each request (an empty string for requests without a body).  For example, to fetch a file
+        and the current desktop version:
+
+            l105:[{"method":"GET","endpoint":"/file/abc"},{"method":"GET","endpoint":"/session_version?platform=desktop"}]0:0:e
+
+        The reply is then a json list of the response metadata ("code" and "headers", as above) of
+        each request, followed by each request's response body, e.g.:
+
+            l123:[...the list of response metadata...]5:abcde45:{"status_code":200,...}e
+
+        Requests are processed in order, except that consecutive GET requests are processed
+        concurrently.  A batch may contain at most ONION_BATCH_MAX_REQUESTS requests (otherwise the
+        whole batch fails with a 400 error reply, as above); responses whose body would take the
+        reply over ONION_BATCH_MAX_SIZE bytes are replaced with an empty 413 response.
+
     The final value returned from the endpoint is the encrypted bencoded bytes, and these encrypted
     bytes are returned directly to the client (i.e. no base64 encoding applied, unlike v3 requests).
     """  # noqa: E501
@@ -271,4 +446,5 @@ def handle_v4_onion_request():
     # enc_type that were specified in the outer request).  We then return that encrypted binary
     # payload as-is back to the client which bounces its way through the SN path back to the client.
     response = handle_v4_onionreq_plaintext(parser.payload)
-    return parser.encrypt_reply(response)
+    with metrics.timed("sfs_onion_encrypt_duration_seconds"):
+        return encrypt_reply(parser, response)
@@ -0,0 +1,218 @@
+from .web import app
+from . import cache, config, db, storage
+from .timer import timer
+
+from psycopg import sql
+from psycopg.types.json import Jsonb
+import time
+
+# Asynchronous replication to the `pgsql_slave` mirror database.
+#
+# Requests only write to the primary database: along with the change itself they record, in the
+# same transaction, an entry in the `replication_outbox` table describing what needs replicating.
+# A background timer then drains the outbox in batches, applying the changes to the slave, and
+# removes the entries once the slave has committed them.  If the slave is unavailable (or a change
+# fails to apply) the entries stay in the outbox and are retried later with a growing back-off, so
+# that changes are never lost.
+#
+# Outbox entries are one of:
+# - kind 'file', ref = file id: copy the current state of the file (i.e. its content, and upload
+#   and expiry times) from the primary to the slave.  The slave always stores file content in the
+#   database as it does not have our on-disk blob storage.
+# - kind 'version_checks', payload = a list of [blinded_id, platform, timestamp] account version
+#   checks written in one go by version_checks.flush().
+# - kind 'version_check', payload = a single inserted account_version_checks row.  (No longer
+#   queued, but may still be waiting in the outbox of an upgraded server).
+
+
+def enabled():
+    """Returns True if a slave database is configured, i.e. if we need to record changes."""
+    return config.pgsql_slave is not None
+
+
+def queue_file(cur, id):
+    """Records that file `id` was added or refreshed; call in the same transaction as the change."""
+    if enabled():
+        cur.execute("INSERT INTO replication_outbox (kind, ref) VALUES ('file', %s)", (id,))
+
+
+def queue_version_checks(cur, rows):
+    """
+    Records account version checks, given as a list of (blinded_id, platform, timestamp) tuples, in
+    the primary database and queues them (as a single outbox entry) for replication.
+    """
+    with cur.copy(
+        "COPY account_version_checks (blinded_id, platform, timestamp) FROM STDIN"
+    ) as copy:
+        for row in rows:
+            copy.write_row(row)
+    if enabled():
+        cur.execute(
+            "INSERT INTO replication_outbox (kind, payload) VALUES ('version_checks', %s)",
+            (Jsonb([[b, p, ts.isoformat()] for b, p, ts in rows]),),
+        )
+
+
+def fetch_files(cur, ids):
+    """
+    Returns a dict of file id -> (data, size, uploaded, expiry) for the given file ids as currently
+    stored in the primary database.  Ids of files that no longer exist are omitted.
+    """
+    tables = [sql.Identifier(t) for t in ("files", config.COLD_TABLE) if t is not None]
+    cur.execute(
+        sql.SQL(" UNION ALL ").join(
+            sql.SQL(
+                "SELECT id, data, blob, size, uploaded, expiry FROM {} WHERE id = ANY(%(ids)s)"
+            ).format(t)
+            for t in tables
+        ),
+        {"ids": list(ids)},
+        binary=True,
+    )
+    files = {}
+    for id, data, blob, size, uploaded, expiry in cur:
+        if blob is not None:
+            data = storage.read_blob(blob)
+            if data is None:
+                app.logger.error(f"Unable to replicate '{id}': content blob {blob} is missing!")
+                continue
+        files[id] = (data, size, uploaded, expiry)
+    return files
+
+
+def apply(cur, entry, files):
+    """Applies a single outbox entry to the slave database using slave cursor `cur`."""
+    _id, kind, ref, payload = entry
+    if kind == 'file':
+        f = files.get(ref)
+        if f is None:
+            return  # Expired (or removed) since it was queued, so nothing to replicate
+        cur.execute(
+            """
+            INSERT INTO files (id, data, size, uploaded, expiry) VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (id) DO UPDATE SET uploaded = EXCLUDED.uploaded, expiry = EXCLUDED.expiry
+            """,
+            (ref, *f),
+        )
+    elif kind == 'version_check':
+        cur.execute(
+            """
+            INSERT INTO account_version_checks (blinded_id, platform, timestamp)
+            VALUES (%s, %s, %s)
+            """,
+            (payload["blinded_id"], payload["platform"], payload["timestamp"]),
+        )
+    elif kind == 'version_checks':
+        # (Not COPY, which can't be used in the pipeline we apply batches in)
+        cur.executemany(
+            """
+            INSERT INTO account_version_checks (blinded_id, platform, timestamp)
+            VALUES (%s, %s, %s)
+            """,
+            payload,
+        )
+    else:
+        raise ValueError(f"Unknown replication entry kind '{kind}'")
+
+
+def replicate_batch():
+    """
+    Replicates the next batch of (up to REPLICATION_BATCH_SIZE) outbox entries to the slave.
+    Returns the number of entries processed (whether successfully or not).
+    """
+    with db.psql.transaction(), db.psql.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, kind, ref, payload FROM replication_outbox
+            WHERE next_attempt <= NOW()
+            ORDER BY id LIMIT %s
+            FOR UPDATE SKIP LOCKED
+            """,
+            (config.REPLICATION_BATCH_SIZE,),
+        )
+        entries = cur.fetchall()
+        if not entries:
+            return 0
+
+        # Replicate each file just once, no matter how many times it appears in the batch:
+        files_seen = set()
+        to_apply = []
+        for e in entries:
+            if e[1] == 'file':
+                if e[2] in files_seen:
+                    continue
+                files_seen.add(e[2])
+            to_apply.append(e)
+        files = fetch_files(cur, files_seen) if files_seen else {}
+
+        failed = set()
+        try:
+            # Normally the whole batch applies in one go:
+            with db.pipeline(db.slave), db.slave.transaction(), db.slave.cursor() as scur:
+                for e in to_apply:
+                    apply(scur, e, files)
+        except Exception as ex:
+            app.logger.warning(f"Failed to replicate batch ({ex}); retrying entries individually")
+            for e in to_apply:
+                try:
+                    with db.slave.transaction(), db.slave.cursor() as scur:
+                        apply(scur, e, files)
+                except Exception as ex:
+                    app.logger.warning(f"Failed to replicate {e[1]} {e[2] or e[0]}: {ex}")
+                    failed.add((e[1], e[2]) if e[1] == 'file' else e[0])
+
+        done = [e[0] for e in entries if ((e[1], e[2]) if e[1] == 'file' else e[0]) not in failed]
+        retry = [e[0] for e in entries if e[0] not in done]
+        cur.execute("DELETE FROM replication_outbox WHERE id = ANY(%s)", (done,))
+        if retry:
+            # Back off by 30s per failed attempt, up to 30 minutes
+            cur.execute(
+                """
+                UPDATE replication_outbox
+                SET attempts = attempts + 1,
+                    next_attempt = NOW() + LEAST(attempts + 1, 60) * '30 seconds'::interval
+                WHERE id = ANY(%s)
+                """,
+                (retry,),
+            )
+
+    cache.stats.incr('replication_done', len(done))
+    if retry:
+        cache.stats.incr('replication_failures', len(retry))
+    return len(entries)
+
+
+def status(cur):
+    """
+    Returns a tuple of the number of changes waiting to be replicated and the replication lag, i.e.
+    the age in seconds of the oldest waiting change (0 if there are none).
+    """
+    cur.execute(
+        """
+        SELECT COUNT(*), COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(created)), 0)
+        FROM replication_outbox
+        """
+    )
+    backlog, lag = cur.fetchone()
+    return backlog, float(lag)
+
+
+def replicate():
+    """
+    Drains the replication outbox, batch by batch, for at most REPLICATION_TIME_BUDGET seconds.
+    """
+    if not enabled() or not db.slave:
+        return
+    started = time.monotonic()
+    while time.monotonic() - started < config.REPLICATION_TIME_BUDGET:
+        if replicate_batch() < config.REPLICATION_BATCH_SIZE:
+            break
+
+
+@timer(config.REPLICATION_INTERVAL, target="worker1")
+def replicate_periodic(signum):
+    with app.app_context():
+        try:
+            replicate()
+        except Exception as e:
+            app.logger.warning(f"Replication to slave failed: {e}")
@@ -1,41 +1,30 @@
 from . import config
 from .web import app
 from . import db
-from . import http, utils
+from . import auth, cache, compat_ids, http, replication, stats, storage, utils
+from . import serialize, token_info, version_checks, versions
 
 import flask
 from flask import request, abort, Response
-import secrets
-from base64 import urlsafe_b64encode
+from werkzeug.wsgi import wrap_file
 from hashlib import blake2b
-import json
-from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import psycopg
+from psycopg import sql
 import time
 import nacl
-from nacl.signing import VerifyKey
 import nacl.exceptions
-import nacl.bindings as sodium
 
 if config.BACKWARDS_COMPAT_IDS:
     assert all(x in (0, 1) for x in config.BACKWARDS_COMPAT_IDS_FIXED_BITS)
-    BACKWARDS_COMPAT_MSB = sum(
-        y << x for x, y in enumerate(reversed(config.BACKWARDS_COMPAT_IDS_FIXED_BITS))
-    )
-    BACKWARDS_COMPAT_RANDOM_BITS = 53 - len(config.BACKWARDS_COMPAT_IDS_FIXED_BITS)
 
-class CustomEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return str(obj)
-        elif isinstance(obj, datetime):
-            return obj.timestamp()
-        return super(CustomEncoder, self).default(obj)
+assert not (
+    config.PARTITIONED_FILES and config.COLD_TABLE
+), "COLD_TABLE cannot be used with PARTITIONED_FILES"
 
 def json_resp(data, status=200):
     """Takes data and optionally an HTTP status, returns it as a json response."""
-    return flask.Response(json.dumps(data, cls=CustomEncoder), status=status, mimetype="application/json")
+    return flask.Response(serialize.dumps(data), status=status, mimetype="application/json")
 
 
 def error_resp(code):
@@ -43,7 +32,7 @@ def error_resp(code):
     Simple JSON error response to send back, embedded as `status_code` and also as the HTTP response
     code.
     """
-    return json_resp({"status_code": code}, code)
+    return flask.Response(serialize.status_body(code), status=code, mimetype="application/json")
 
 
 def generate_file_id(data):
@@ -52,9 +41,9 @@ def generate_file_id(data):
     base64 chars.  (Ideally would be 32, but that would result in base64 padding, so increased to 33
     to fit perfectly).
     """
-    return urlsafe_b64encode(
-        blake2b(data, digest_size=33, salt=b"SessionFileSvr\0\0").digest()
-    ).decode()
+    hasher = utils.file_id_hasher()
+    hasher.update(data)
+    return utils.file_id_from_hasher(hasher)
 
 def abort_with_reason(code, msg, warn=True):
     if warn:
@@ -67,6 +56,15 @@ def valid_blinded_version_id_for_auth(request, required):
     """
     Check if a request is correctly authenticated, if the auth headers are missing and auth isn't
     required then just return 'None'.
+
+    X-FS-Signature must be the signature of TIMESTAMP || METHOD || PATH, followed by `?` and the
+    query string if there is one, followed by (for a request with a body) the 64-byte BLAKE2b hash
+    of the body, as raw bytes.
+
+    A request that exactly repeats an already accepted request (same signature, timestamp, and
+    request, e.g. from a client retrying through a different onion path) is accepted without
+    verifying the signature again.  The request environ's `fileserver.auth_replay` is set to whether
+    the request was such a repeat.
     """
     pk, ts_str, sig_in = (
         request.headers.get(f"X-FS-{h}") for h in ('Pubkey', 'Timestamp', 'Signature')
@@ -97,7 +95,8 @@ def valid_blinded_version_id_for_auth(request, required):
         )
     pk = pk[1:]
 
-    if not sodium.crypto_core_ed25519_is_valid_point(pk):
+    verify_key = auth.verify_key(pk)
+    if verify_key is None:
         abort_with_reason(
             http.BAD_REQUEST,
             "Invalid authentication: given X-FS-Pubkey is not a valid Ed25519 pubkey",
@@ -120,7 +119,7 @@ def valid_blinded_version_id_for_auth(request, required):
     # Parameter value validation
 
     now = time.time()
-    if not now - 24 * 60 * 60 <= ts <= now + 24 * 60 * 60:
+    if not now - auth.TIMESTAMP_WINDOW <= ts <= now + auth.TIMESTAMP_WINDOW:
         abort_with_reason(
             http.TOO_EARLY, "Invalid authentication: X-FS-Timestamp is too far from current time"
         )
@@ -128,7 +127,7 @@ def valid_blinded_version_id_for_auth(request, required):
     # Signature validation
 
     # Signature should be on:
-    #     TIMESTAMP || METHOD || PATH
+    #     TIMESTAMP || METHOD || PATH [|| '?' || QUERY] [|| BLAKE2b-512(BODY)]
     to_verify = (
         ts_str.encode()
         + request.method.encode()
@@ -143,97 +142,206 @@ def valid_blinded_version_id_for_auth(request, required):
         to_verify = to_verify + b'?' + request.query_string
 
     if len(request.data):
-        to_verify = to_verify + blake2b(request.data, digest_size=64)
+        to_verify = to_verify + blake2b(request.data, digest_size=64).digest()
+
+    replay_key = auth.replay_key(pk, sig_in, to_verify)
+    replayed = auth.seen(replay_key)
+    if not replayed:
+        try:
+            verify_key.verify(to_verify, sig_in)
+        except nacl.exceptions.BadSignatureError:
+            abort_with_reason(
+                http.UNAUTHORIZED, "Invalid authentication: X-FS-Signature verification failed"
+            )
+        auth.add(replay_key, ts)
 
-    try:
-        pk = VerifyKey(pk)
-        pk.verify(to_verify, sig_in)
-    except nacl.exceptions.BadSignatureError:
-        abort_with_reason(
-            http.UNAUTHORIZED, "Invalid authentication: X-FS-Signature verification failed"
+    request.environ['fileserver.auth_replay'] = replayed
+    return blinded_version_id
+
+
+def insert_file(cur, id, upload, blob=None):
+    """
+    Inserts a new file row for storage.Upload `upload`.  The file body is stored in the row itself
+    unless `blob` is given, in which case the body is stored in the blob store under that content
+    hash (the caller must hold the blob lock; see `storage.lock_blob`).
+    """
+    if blob is not None:
+        cur.execute(
+            "INSERT INTO files (id, blob, size, expiry) VALUES (%s, %s, %s, NOW() + %s)",
+            (id, blob, upload.size, config.FILE_EXPIRY),
         )
+        storage.store_blob(blob, upload)
+    elif upload.data is not None:
+        cur.execute(
+            "INSERT INTO files (id, data, size, expiry) VALUES (%s, %s, %s, NOW() + %s)",
+            (id, upload.data, upload.size, config.FILE_EXPIRY),
+        )
+    else:
+        storage.copy_into_files(cur, id, upload)
 
-    return blinded_version_id
+
+def upsert_file(psql, id, upload, blob=None):
+    """
+    Stores a file with content hash id `id`.  If we already have this file then we de-duplicate by
+    just refreshing its expiry; the file body only gets written for a new file.  Arguments are as
+    for `insert_file`.  The file is also queued for replication to the slave database.
+
+    A file that was moved to the cold tier (COLD_TABLE) gets re-inserted into the files table (as it
+    is now in use again), and so is removed from the cold table in the same transaction.
+    """
+    uncold = None
+    if config.COLD_TABLE is not None:
+        uncold = sql.SQL("DELETE FROM {} WHERE id = %s").format(sql.Identifier(config.COLD_TABLE))
+
+    upsert = """
+        INSERT INTO files (id, {}, size, expiry) VALUES (%s, %s, %s, NOW() + %s)
+        ON CONFLICT (id) DO UPDATE
+            SET uploaded = NOW(), expiry = EXCLUDED.expiry, accessed = NOW()
+        """
+    refresh = """
+        UPDATE files SET uploaded = NOW(), expiry = NOW() + %s, accessed = NOW()
+        WHERE id = %s
+        """
+    if config.PARTITIONED_FILES:
+        # A partitioned table can't have a unique index on just the id, so we can't upsert: instead
+        # adding a file is serialized with the id lock (the id, being the content hash, is also the
+        # blob key) and we refresh an existing file (which moves it into the partition of its new
+        # expiry) or else insert it.
+        with psql.transaction(), psql.cursor() as cur:
+            with db.pipeline(psql):
+                storage.lock_blob(cur, id)
+                cur.execute(refresh, (config.FILE_EXPIRY, id))
+            if cur.rowcount == 0:
+                insert_file(cur, id, upload, blob)
+            elif blob is not None:
+                storage.store_blob(blob, upload)
+            replication.queue_file(cur, id)
+
+    elif blob is not None:
+        # The blob lock has to be held while we write the blob, so the BEGIN, lock, and upsert go
+        # out together in a single round trip, and the COMMIT in a second one once the blob is in
+        # place.
+        with db.pipeline(psql) as sync, psql.transaction(), psql.cursor() as cur:
+            storage.lock_blob(cur, blob)
+            if uncold is not None:
+                cur.execute(uncold, (id,))
+            cur.execute(upsert.format("blob"), (id, blob, upload.size, config.FILE_EXPIRY))
+            replication.queue_file(cur, id)
+            sync()
+            # Also restores the blob of an existing file if it somehow went missing
+            storage.store_blob(blob, upload)
+
+    elif upload.data is not None:
+        # A single round trip.  (When the id already exists postgresql checks the unique index
+        # before writing the new row, so the data doesn't get written at all).
+        with db.pipeline(psql), psql.transaction(), psql.cursor() as cur:
+            if uncold is not None:
+                cur.execute(uncold, (id,))
+            cur.execute(upsert.format("data"), (id, upload.data, upload.size, config.FILE_EXPIRY))
+            replication.queue_file(cur, id)
+
+    else:
+        # A spooled upload gets streamed in with COPY, which can't do an upsert, so try refreshing
+        # an existing file first:
+        with psql.transaction(), psql.cursor() as cur:
+            if uncold is not None:
+                cur.execute(uncold, (id,))
+            cur.execute(refresh, (config.FILE_EXPIRY, id))
+            if cur.rowcount == 0:
+                try:
+                    with psql.transaction():
+                        storage.copy_into_files(cur, id, upload)
+                except psycopg.errors.UniqueViolation:
+                    # Someone else concurrently uploaded the same file
+                    cur.execute(refresh, (config.FILE_EXPIRY, id))
+            replication.queue_file(cur, id)
+
+
+# Endpoints taking an `req=request` argument use it rather than `request` directly so that they can
+# also be called by the sub-request fast path (see subrequest.py), which passes a lightweight
+# stand-in for the request.
 
 
 @app.post("/file")
-def submit_file(*, body=None, deprecated=False):
+def submit_file(*, body=None, deprecated=False, req=request):
     if body is None:
-        body = request.data
+        # Subrequests (e.g. from onion requests) already have the whole body in memory:
+        body = req.environ.get('fileserver.body')
 
-    if not 0 < len(body) <= config.MAX_FILE_SIZE:
+    if body is not None:
+        upload = storage.upload_from_bytes(body)
+    elif (req.content_length or 0) > config.MAX_FILE_SIZE:
+        upload = None
+    else:
+        # Stream the body from the client so that we never hold the whole upload in memory
+        upload = storage.spool_upload(req.stream, config.MAX_FILE_SIZE)
+
+    if upload is None or not 0 < upload.size <= config.MAX_FILE_SIZE:
         app.logger.warn(
-            "Rejecting upload of size {} ∉ (0, {}]".format(len(body), config.MAX_FILE_SIZE)
+            "Rejecting upload of size {} ∉ (0, {}]".format(
+                upload.size if upload is not None else req.content_length or "(too large)",
+                config.MAX_FILE_SIZE,
+            )
         )
+        if upload is not None:
+            upload.close()
         return error_resp(http.PAYLOAD_TOO_LARGE)
 
+    with upload:
+        return store_upload(upload, deprecated)
+
+
+def store_upload(upload, deprecated):
+    """Stores a storage.Upload as a new file; returns the response for `submit_file`."""
     id = None
     try:
         if config.BACKWARDS_COMPAT_IDS:
-            done = False
-            for attempt in range(25):
-
-                id = BACKWARDS_COMPAT_MSB << BACKWARDS_COMPAT_RANDOM_BITS | secrets.randbits(
-                    BACKWARDS_COMPAT_RANDOM_BITS
-                )
-                if not deprecated:
-                    id = str(id)  # New ids are always strings; legacy requests require an integer
-                try:
-                    with db.psql.cursor() as cur:
-                        cur.execute(
-                            "INSERT INTO files (id, data, expiry) VALUES (%s, %s, NOW() + %s)",
-                            (id, body, config.FILE_EXPIRY),
-                        )
-                except psycopg.errors.UniqueViolation:
-                    continue
-
-                if db.slave:
+            blob = upload.id if storage.enabled() else None
+            with db.psql.transaction(), db.psql.cursor() as cur:
+                if blob is not None:
+                    storage.lock_blob(cur, blob)
+
+                # Allocated ids never collide with each other, but could (very rarely) collide with
+                # a random id assigned by an older version of the file server
+                for attempt in range(5):
+                    id = compat_ids.allocate(cur)
+                    if id is None:
+                        break
+                    if not deprecated:
+                        # New ids are always strings; legacy requests require an integer
+                        id = str(id)
+                    # The files primary key only catches a collision in the hot tier (and not at
+                    # all with a partitioned table), so check all the file tables for the id,
+                    # holding the id lock (as `upsert_file` does)
+                    storage.lock_blob(cur, str(id))
+                    if file_exists(cur, str(id)):
+                        cache.stats.incr('compat_id_retries')
+                        id = None
+                        continue
                     try:
-                        with db.slave.cursor() as cur:
-                            cur.execute(
-                                "INSERT INTO files (id, data, expiry) VALUES (%s, %s, NOW() + %s)",
-                                (id, body, config.FILE_EXPIRY),
-                            )
-                    except psycopg.errors.Error as e:
-                        app.logger.warning(f"Failed to store file on slave: {e}")
-                        pass
-
-                done = True
-                break
-
-            if not done:
+                        with db.psql.transaction():
+                            insert_file(cur, id, upload, blob)
+                        replication.queue_file(cur, id)
+                        break
+                    except psycopg.errors.UniqueViolation:
+                        cache.stats.incr('compat_id_retries')
+                        id = None
+
+            if id is None:
                 app.logger.error(
-                    "Tried 25 random IDs and got all constraint failures, something getting wrong!"
+                    "Unable to allocate a unique file id (is the compat id space used up?)"
                 )
                 return error_resp(http.INSUFFICIENT_STORAGE)
 
         else:
-            id = generate_file_id(body)
-            for psql in (db.psql, db.slave):
-                if not psql:
-                    continue
-
-                with psql.transaction(), psql.cursor() as cur:
-                    try:
-                        # Don't pass the data yet because we might be de-duplicating
-                        with db.psql.transaction():
-                            cur.execute(
-                                "INSERT INTO files (id, data, expiry) VALUES (%s, '', NOW() + %s)",
-                                (id, config.FILE_EXPIRY),
-                            )
-                    except psycopg.errors.UniqueViolation:
-                        # Found a duplicate id, so de-duplicate by just refreshing the expiry
-                        cur.execute(
-                            "UPDATE files SET uploaded = NOW(), expiry = NOW() + %s WHERE id = %s",
-                            (config.FILE_EXPIRY, id),
-                        )
-                    else:
-                        cur.execute("UPDATE files SET data = %s WHERE id = %s", (body, id))
+            id = upload.id
+            upsert_file(db.psql, id, upload, id if storage.enabled() else None)
 
     except Exception as e:
         app.logger.error("Failed to insert file: {}".format(e))
         return error_resp(http.INTERNAL_SERVER_ERROR)
 
+    cache.drop_missing(str(id))
     response = {"result": id, "status_code": 200} if deprecated else {"id": id}
     return json_resp(response)
 
@@ -259,185 +367,321 @@ def submit_file_old():
     return submit_file(body=body, deprecated=True)
 
 
-@app.get("/file/<id>")
-def get_file(id):
-    with db.psql.cursor() as cur:
-        cur.execute("SELECT data FROM files WHERE id = %s", (id,), binary=True)
-        row = cur.fetchone()
-        if not row and config.BACKUP_TABLE is not None:
-            cur.execute(f"SELECT data FROM {config.BACKUP_TABLE} WHERE id = %s", (id,), binary=True)
-            row = cur.fetchone()
-        if row:
-            response = flask.make_response(row[0])
-            response.headers.set("Content-Type", "application/octet-stream")
-            return response
-        else:
-            app.logger.warn("File '{}' does not exist".format(id))
-            return error_resp(http.NOT_FOUND)
+def file_tables():
+    """
+    Returns the names of the tables that may contain files, in lookup order: the files table (i.e.
+    the hot tier), the cold tier table, and the backup table (the latter two only if configured).
+    """
+    return [t for t in ("files", config.COLD_TABLE, config.BACKUP_TABLE) if t is not None]
 
 
-@app.get("/files/<id>")
-def get_file_old(id):
-    with db.psql.cursor() as cur:
-        cur.execute("SELECT data FROM files WHERE id = %s", (id,), binary=True)
-        row = cur.fetchone()
-        if not row and config.BACKUP_TABLE is not None:
-            cur.execute(f"SELECT data FROM {config.BACKUP_TABLE} WHERE id = %s", (id,), binary=True)
-            row = cur.fetchone()
-        if row:
-            return json_resp({"status_code": 200, "result": utils.encode_base64(row[0])})
-        else:
-            app.logger.warn("File '{}' does not exist".format(id))
-            return error_resp(http.NOT_FOUND)
+def file_exists(cur, id):
+    """
+    Returns True if there is a file (even an expired one not yet removed) with id `id` in any of the
+    `file_tables()`.
+    """
+    tables = file_tables()
+    cur.execute(
+        sql.SQL(" UNION ALL ").join(
+            sql.SQL("SELECT 1 FROM {} WHERE id = %s").format(sql.Identifier(t)) for t in tables
+        )
+        + sql.SQL(" LIMIT 1"),
+        [id] * len(tables),
+    )
+    return cur.fetchone() is not None
 
 
-@app.get("/file/<id>/info")
-def get_file_info(id):
+def lookup_file(columns, id, *, params=(), binary=False):
+    """
+    Looks up file `id` in each of the `file_tables()` in turn, using a single query.  `columns` is
+    the SQL select list, which may use the id, data, blob, size, uploaded, and expiry columns;
+    `params` are any query parameters used in `columns`.  Returns the selected values plus the name
+    of the table the file was found in, or None (after logging) if the file does not exist.
+
+    When tiered storage is enabled this also records the access to the file (so that it stays in
+    the hot tier), and promotes it back to the hot tier if found in the cold tier and COLD_PROMOTE
+    is set.
+
+    Nonexistent ids are remembered for a short time (see `cache.set_missing`) so that repeated
+    requests for them (from stale clients, scanners, etc.) don't need to query the database.
+    """
+    if cache.is_missing(id):
+        app.logger.debug("File '{}' does not exist (cached)".format(id))
+        return None
+
+    selects = []
+    args = []
+    for table in file_tables():
+        if table == config.BACKUP_TABLE:
+            # The backup table stores everything in `data`, so give it the same columns as files
+            source = sql.SQL(
+                """(
+                SELECT id, data, NULL::varchar AS blob, length(data)::bigint AS size, uploaded,
+                    expiry
+                FROM {}) AS backup"""
+            ).format(sql.Identifier(table))
+        else:
+            source = sql.Identifier(table)
+        where = sql.SQL("id = %s")
+        if table == "files" and config.PARTITIONED_FILES:
+            # Expired files stay around until their whole partition can be dropped
+            where += sql.SQL(" AND expiry > NOW()")
+        selects.append(
+            sql.SQL("SELECT {}, {} FROM {} WHERE {}").format(
+                sql.SQL(columns), sql.Literal(table), source, where
+            )
+        )
+        args += (*params, id)
+
+    query = sql.SQL(" UNION ALL ").join(selects)
+    if len(selects) > 1:
+        query += sql.SQL(" LIMIT 1")
+    if config.COLD_TABLE is not None:
+        # Record the access, at a coarse granularity so that popular files don't get updated on
+        # every download.
+        query = (
+            sql.SQL(
+                """
+                WITH touched AS (
+                    UPDATE files SET accessed = NOW()
+                    WHERE id = %s AND accessed < NOW() - '1 hour'::interval
+                )
+                """
+            )
+            + query
+        )
+        args.insert(0, id)
+
     with db.psql.cursor() as cur:
-        cur.execute("SELECT length(data), uploaded, expiry FROM files WHERE id = %s", (id,))
+        cur.execute(query, args, binary=binary)
         row = cur.fetchone()
-        if not row and config.BACKUP_TABLE is not None:
-            cur.execute(f"SELECT length(data), uploaded, expiry FROM {config.BACKUP_TABLE} WHERE id = %s", (id,))
-            row = cur.fetchone()
-        if row:
-            return json_resp(
-                {"size": row[0], "uploaded": row[1].timestamp(), "expires": row[2].timestamp()}
-            )
-        else:
+
+        if row is None:
             app.logger.warn("File '{}' does not exist".format(id))
-            return error_resp(http.NOT_FOUND)
+            cache.set_missing(id)
+        elif row[-1] == config.COLD_TABLE and config.COLD_PROMOTE:
+            cur.execute(
+                sql.SQL(
+                    """
+                    WITH moved AS (DELETE FROM {} WHERE id = %s RETURNING *)
+                    INSERT INTO files (id, data, blob, size, uploaded, expiry, accessed)
+                    SELECT id, data, blob, size, uploaded, expiry, NOW() FROM moved
+                    ON CONFLICT (id) DO NOTHING
+                    """
+                ).format(sql.Identifier(config.COLD_TABLE)),
+                (id,),
+            )
+            row = (*row[:-1], "files")
+    return row
 
 
-@app.get("/session_version")
-def get_session_version():
-    platform = request.args.get("platform")
+class FileDataStream:
+    """
+    Iterable over the content of file `id` stored in the `data` column of `table`, from byte
+    `offset` up to (but not including) byte `end`, in slices of `storage.DB_CHUNK_SIZE` bytes,
+    preceded by `head` (content already fetched along with the file metadata), if given.  Each
+    slice is fetched with a pool connection that is only held for the duration of that query, so
+    that a slow download doesn't tie up a database connection.
+
+    Under WSGI this is iterated normally, using db.psql_pool; when serving via ASGI (see asgi.py)
+    it is iterated asynchronously, fetching the slices with db.async_pool.
+    """
 
-    if platform not in ("desktop", "android", "ios"):
-        app.logger.warn("Invalid session platform '{}'".format(platform))
-        return error_resp(http.NOT_FOUND)
-    project = "oxen-io/session-" + platform
+    def __init__(self, table, id, offset, end, head=None):
+        self.table, self.id, self.offset, self.end, self.head = table, id, offset, end, head
+        self.query = sql.SQL("SELECT substring(data from %s for %s) FROM {} WHERE id = %s").format(
+            sql.Identifier(table)
+        )
 
-    # If we were provided with auth headers then validate the authentication (if they weren't provided
-    # then just continue as usual for backwards compatibility)
-    blinded_id = valid_blinded_version_id_for_auth(request, False)
+    def _slices(self):
+        offset = self.offset
+        while offset < self.end:
+            n = min(storage.DB_CHUNK_SIZE, self.end - offset)
+            yield offset, n
+            offset += n
+
+    def _check(self, row, n):
+        if not row or row[0] is None or len(row[0]) != n:
+            # The file expired (or was otherwise removed) in the middle of the download
+            raise RuntimeError(f"File '{self.id}' went away while streaming it")
+        return row[0]
+
+    def __iter__(self):
+        if self.head:
+            yield self.head
+        for offset, n in self._slices():
+            with db.psql_pool.connection() as conn:
+                row = conn.execute(self.query, (offset + 1, n, self.id), binary=True).fetchone()
+            yield self._check(row, n)
+
+    async def __aiter__(self):
+        if self.head:
+            yield self.head
+        for offset, n in self._slices():
+            async with db.async_pool.connection() as conn:
+                cur = await conn.execute(self.query, (offset + 1, n, self.id), binary=True)
+                row = await cur.fetchone()
+            yield self._check(row, n)
+
+
+def set_file_cache_headers(response, id, uploaded, expiry):
+    """
+    Sets the validator and caching headers of a file download.  File content never changes, so the
+    id makes a strong ETag and the content can be cached for as long as the file exists.
+    `uploaded` and `expiry` are unix timestamps.
+    """
+    if id.isdigit():
+        # Backwards-compatible integer ids are random and could get reused for a different file
+        # once this one expires, so they aren't unique on their own.
+        response.set_etag("{}-{}".format(id, int(uploaded)))
+    else:
+        response.set_etag(id)
+    response.headers["Cache-Control"] = "public, max-age={}, immutable".format(
+        max(0, int(expiry - time.time()))
+    )
 
-    if blinded_id is not None:
-        for psql in (db.psql, db.slave):
-            if not psql:
-                continue
 
-            with psql.transaction(), psql.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO account_version_checks (blinded_id, platform, timestamp)
-                    VALUES (%s, %s, NOW())""",
-                    (blinded_id, platform),
-                )
+@app.get("/file/<id>")
+def get_file(id, req=request):
+    table = "files"
+    blob = None
+    cached = cache.get_file(id)
+    if cached is not None:
+        data, uploaded, expiry = cached
+        size = len(data)
+    else:
+        # For a plain download we fetch the first chunk of data along with the metadata; for small
+        # files (i.e. most of them) that is the whole thing, and larger files get streamed the rest
+        # of the way.  Conditional and range requests often don't need that chunk, so skip it.
+        first = 0 if req.range or req.if_none_match else storage.DB_CHUNK_SIZE
+        row = lookup_file(
+            "substring(data from 1 for %s), blob, size, uploaded, expiry",
+            id,
+            params=(first,),
+            binary=True,
+        )
+        if row is None:
+            return error_resp(http.NOT_FOUND)
 
-    with db.psql.cursor() as cur:
-        # Validate the project exists and retrieve when it was last updated
-        cur.execute("SELECT updated from projects WHERE name = %s", (project,),)
+        data, blob, size, uploaded, expiry, table = row
+        uploaded, expiry = uploaded.timestamp(), expiry.timestamp()
+        if blob is None and len(data) >= size:
+            cache.set_file(id, data, uploaded, expiry)
+
+    response = Response(mimetype="application/octet-stream")
+    set_file_cache_headers(response, id, uploaded, expiry)
+    response.headers["Accept-Ranges"] = "bytes"
+
+    if req.if_none_match.contains_weak(response.get_etag()[0]):
+        response.status_code = http.NOT_MODIFIED
+        return response
+
+    # Single range requests get a partial response; we ignore multi-range requests (and send the
+    # whole file), as well as range requests with an If-Range that isn't our current ETag.
+    start, end = 0, size
+    if_range = req.if_range
+    if_range_ok = if_range.etag == response.get_etag()[0] or not (if_range.etag or if_range.date)
+    if req.range is not None and req.range.units == "bytes" and if_range_ok:
+        byte_range = req.range.range_for_length(size)
+        if byte_range is not None:
+            start, end = byte_range
+            response.status_code = http.PARTIAL_CONTENT
+            response.headers["Content-Range"] = "bytes {}-{}/{}".format(start, end - 1, size)
+        elif len(req.range.ranges) == 1:
+            response.status_code = http.RANGE_NOT_SATISFIABLE
+            response.headers["Content-Range"] = "bytes */{}".format(size)
+            return response
 
-        row = cur.fetchone()
-        if row is None:
-            app.logger.warn("{} does not exist!".format(project))
-            return error_resp(http.BAD_GATEWAY)
+    if blob is None:
+        # `data` here is either the whole file, the first chunk of it, or empty
+        if len(data) >= end:
+            response.set_data(data if (start, end) == (0, len(data)) else data[start:end])
+        elif start < len(data):
+            response.response = FileDataStream(table, id, len(data), end, head=data[start:])
+        else:
+            response.response = FileDataStream(table, id, start, end)
+    else:
+        f = storage.open_blob(blob)
+        if f is None:
+            app.logger.error("File '{}' content blob {} is missing!".format(id, blob))
+            return error_resp(http.NOT_FOUND)
 
-        updated = row[0]
+        if start == 0 and end == size:
+            # Let the WSGI server send the file directly (e.g. via sendfile) if it supports it
+            response.response = wrap_file(req.environ, f)
+            response.direct_passthrough = True
+        else:
+            f.seek(start)
+            response.response = storage.file_chunks(f, end - start)
 
-        # Fetch the latest release version
-        cur.execute(
-            """
-            SELECT id, version, name, notes from release_versions
-            WHERE proj_name = %s ORDER BY version_code DESC""",
-            (project,),
-        )
+    response.content_length = end - start
+    return response
 
-        row = cur.fetchone()
-        if row is None:
-            app.logger.warn("{} has no releases!".format(project))
-            return error_resp(http.BAD_GATEWAY)
-
-        release_id = row[0]
-        response = {
-            "status_code": 200,
-            "updated": updated,
-            "result": row[1]
-        }
 
-        if row[2]:
-            response["name"] = row[2]
+@app.get("/files/<id>")
+def get_file_old(id):
+    cached = cache.get_file(id)
+    if cached is not None:
+        return json_resp({"status_code": 200, "result": utils.encode_base64(cached[0])})
 
-        if row[3]:
-            response["notes"] = row[3]
+    row = lookup_file("data, blob, uploaded, expiry", id, binary=True)
+    if row is None:
+        return error_resp(http.NOT_FOUND)
 
-        # Add release assets
-        cur.execute(
-            """
-            SELECT name, url FROM release_assets
-            WHERE release = %s""",
-            (release_id,),
-        )
-        assets = cur.fetchall()
+    data, blob, uploaded, expiry, _table = row
+    if blob is not None:
+        data = storage.read_blob(blob)
+        if data is None:
+            app.logger.error("File '{}' content blob {} is missing!".format(id, blob))
+            return error_resp(http.NOT_FOUND)
+    else:
+        cache.set_file(id, data, uploaded.timestamp(), expiry.timestamp())
+    return json_resp({"status_code": 200, "result": utils.encode_base64(data)})
 
-        if assets:
-            asset_info = []
 
-            for asset in assets:
-                asset_info.append({
-                    "name": asset[0],
-                    "url": asset[1]
-                })
-                
-            response["assets"] = asset_info
+@app.get("/file/<id>/info")
+def get_file_info(id, req=request):
+    row = lookup_file("size, uploaded, expiry", id)
+    if row is None:
+        return error_resp(http.NOT_FOUND)
 
-        # Add prerelease info if present
-        cur.execute(
-            """
-            SELECT id, version, name, notes from prerelease_versions
-            WHERE proj_name = %s ORDER BY version_code DESC""",
-            (project,),
-        )
+    return json_resp(
+        {"size": row[0], "uploaded": row[1].timestamp(), "expires": row[2].timestamp()}
+    )
 
-        row = cur.fetchone()
-        if row is not None:
-            prerelease_id = row[0]
-            response["prerelease"] = {
-                "result": row[1],
-                "updated": updated,
-            }
 
-            if row[2]:
-                response["prerelease"]["name"] = row[2]
+@app.get("/session_version")
+def get_session_version(req=request):
+    platform = req.args.get("platform")
 
-            if row[3]:
-                response["prerelease"]["notes"] = row[3]
+    if platform not in versions.PLATFORMS:
+        app.logger.warn("Invalid session platform '{}'".format(platform))
+        return error_resp(http.NOT_FOUND)
 
-            # Add prerelease assets
-            cur.execute(
-                """
-                SELECT name, url FROM release_assets
-                WHERE release = %s""",
-                (prerelease_id,),
-            )
-            assets = cur.fetchall()
+    # If we were provided with auth headers then validate the authentication (if they weren't provided
+    # then just continue as usual for backwards compatibility)
+    blinded_id = valid_blinded_version_id_for_auth(req, False)
 
-            if assets:
-                asset_info = []
+    # (A client retrying the same request through a different path is still the same check)
+    if blinded_id is not None and not req.environ.get('fileserver.auth_replay'):
+        version_checks.record(blinded_id, platform)
 
-                for asset in assets:
-                    asset_info.append({
-                        "name": asset[0],
-                        "url": asset[1]
-                    })
-                    
-                response["prerelease"]["assets"] = asset_info
+    # The response is precomputed (see versions.py), so this normally doesn't touch the database
+    cached = versions.get(platform)
+    if cached is None:
+        return error_resp(http.BAD_GATEWAY)
+    etag, body = cached
 
-        return json_resp(response)
+    if req.if_none_match.contains(etag):
+        response = Response(status=http.NOT_MODIFIED)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
 
 @app.get("/token_info")
-def get_token_info():
-    days = request.args.get("days")
+def get_token_info(req=request):
+    days = req.args.get("days")
 
     try:
         days = int(days)
@@ -448,34 +692,89 @@ def get_token_info():
     if days is None or not (1 <= days <= 30):
         days = 7
 
+    # Normally served from the cache of serialized responses (see token_info.py)
+    body = token_info.get(days)
+    if body is None:
+        return error_resp(http.BAD_GATEWAY)
+    return Response(body, mimetype="application/json")
+
+
+def require_admin():
+    """
+    Aborts the request unless it was made directly (i.e. not via an onion request) from one of the
+    ADMIN_ADDRESSES.
+    """
+    if (
+        request.environ.get('fileserver.subrequest')
+        or request.remote_addr not in config.ADMIN_ADDRESSES
+    ):
+        abort_with_reason(http.FORBIDDEN, f"Admin request from {request.remote_addr} refused")
+
+
+@app.get("/stats")
+def get_stats():
+    """
+    Returns file storage statistics: totals per files table, and per upload day along with when the
+    files uploaded that day expire (approximately, since FILE_EXPIRY may have changed since).  This
+    only reads the file_stats counters, so is cheap no matter how many files are stored.
+    """
+    require_admin()
+
     with db.psql.cursor() as cur:
-        cur.execute(
-            """
-            SELECT maximum_supply, sent_per_node, staking_reward_pool FROM session_token_stats
-            """,
-        )
-        stats = cur.fetchone()
-        if stats is None:
-            app.logger.warn("No token stats available!")
-            return error_resp(http.BAD_GATEWAY)
+        counts = stats.storage_stats(cur)
+        expiry = cur.execute("SELECT %s::interval", (config.FILE_EXPIRY,)).fetchone()[0]
+
+    days = {}
+    tables = {}
+    for table, per_day in counts.items():
+        tables[table] = {
+            "files": sum(f for f, _ in per_day.values()),
+            "bytes": sum(b for _, b in per_day.values()),
+        }
+        for day, (files, size) in per_day.items():
+            d = days.setdefault(day, [0, 0])
+            d[0] += files
+            d[1] += size
+
+    return json_resp(
+        {
+            "files": sum(t["files"] for t in tables.values()),
+            "bytes": sum(t["bytes"] for t in tables.values()),
+            "tables": tables,
+            "days": [
+                {
+                    "uploaded": day.isoformat(),
+                    "files": files,
+                    "bytes": size,
+                    "expires": (day + timedelta(days=1) + expiry).isoformat(),
+                }
+                for day, (files, size) in sorted(days.items())
+            ],
+        }
+    )
 
-        cur.execute(
-            """
-            SELECT current_value, circulating_supply, total_nodes, updated FROM session_token_history
-            WHERE updated >= date_trunc('day', NOW()) - INTERVAL '%s DAY'
-            """,
-            (days,)
-        )
-        rows = cur.fetchall()
-        columns = ["current_value", "circulating_supply", "total_nodes", "updated"]
-        history = [dict(zip(columns, row)) for row in rows]
-
-        return json_resp({
-            "status_code": 200,
-            "info": {
-                "maximum_supply": stats[0],
-                "sent_per_node": stats[1],
-                "staking_reward_pool": stats[2],
-                "history": history
-            }
-        })
+
+@app.get("/stats/version_checks")
+def get_version_check_stats():
+    """
+    Returns account version check statistics for the last `days` (default 30) full days: for each
+    platform (and for '*', all platforms) the number of checks and the (approximate) number of
+    unique users, in total and per day.  This reads only the daily rollups.
+    """
+    require_admin()
+
+    try:
+        days = int(request.args.get("days", 30))
+    except ValueError:
+        days = 0
+    if not 1 <= days <= 3650:
+        abort_with_reason(http.BAD_REQUEST, "Invalid days: expected an integer in [1, 3650]")
+
+    last = datetime.now(timezone.utc).date() - timedelta(days=1)
+    first = last - timedelta(days=days - 1)
+    with db.psql.cursor() as cur:
+        usage = version_checks.usage(cur, first, last)
+
+    for u in usage.values():
+        u["days"] = [[day.isoformat(), checks, users] for day, checks, users in u["days"]]
+    return json_resp({"first": first.isoformat(), "last": last.isoformat(), "platforms": usage})
@@ -0,0 +1,94 @@
+from .web import app
+from . import config
+
+from datetime import datetime
+from decimal import Decimal
+import flask
+import json
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+# JSON serialization of request and response bodies.
+#
+# Everything we send as JSON goes through `dumps` (and everything we parse through `loads`), which
+# use orjson when it is installed (`pip3 install orjson`, or `apt install python3-orjson`), and the
+# stdlib json module otherwise; JSON_BACKEND selects one explicitly.  Both produce identical,
+# compact UTF-8 output, with Decimal values encoded as strings and datetimes as (float) unix
+# timestamps.
+#
+# The `{"status_code": N}` bodies of error responses are fixed, so they are encoded just once (see
+# `status_body`).
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return obj.timestamp()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(',', ':'))
+
+
+def _json_dumps(data):
+    return _encoder.encode(data).encode()
+
+
+BACKENDS = {'json': (_json_dumps, json.loads)}
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def _orjson_dumps(data):
+        return orjson.dumps(data, default=_default, option=_ORJSON_OPTIONS)
+
+    BACKENDS['orjson'] = (_orjson_dumps, orjson.loads)
+
+backend = None
+dumps = None
+loads = None
+
+
+def use(name=None):
+    """
+    Selects the JSON backend `name` (one of BACKENDS), or the fastest available backend if None.
+    `dumps(data)` returns the encoded bytes of `data`; `loads(data)` parses bytes or str (and raises
+    a json.JSONDecodeError on invalid input, with either backend).
+    """
+    global backend, dumps, loads
+    if name is None:
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in BACKENDS:
+        raise ValueError(f"JSON backend '{name}' is not available")
+    dumps, loads = BACKENDS[name]
+    backend = name
+
+
+use(config.JSON_BACKEND)
+
+_status_bodies = {}
+
+
+def status_body(code):
+    """Returns the (pre-encoded) `{"status_code": code}` response body."""
+    body = _status_bodies.get(code)
+    if body is None:
+        body = _status_bodies[code] = b'{"status_code":%d}' % code
+    return body
+
+
+# Also use it for flask's own JSON handling (request.json, etc.), where supported (Flask 2.2+)
+if hasattr(flask.json, 'provider'):
+
+    class JSONProvider(flask.json.provider.DefaultJSONProvider):
+        def dumps(self, obj, **kwargs):
+            return dumps(obj).decode()
+
+        def loads(self, s, **kwargs):
+            return loads(s)
+
+    app.json = JSONProvider(app)
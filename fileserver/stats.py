@@ -1,4 +1,5 @@
 from .web import app
+from . import cache, config, replication
 
 si_prefixes = ["", "k", "M", "G", "T", "P", "E", "Z", "Y"]
 
@@ -11,10 +12,93 @@ def pretty_bytes(nbytes):
     return ("{} B" if i == 0 else "{:.1f} {}B").format(nbytes, si_prefixes[i])
 
 
+def storage_stats(cur):
+    """
+    Returns the current file storage statistics from the (trigger-maintained) file_stats counters,
+    without scanning the files tables, as a dict of file table name to a dict of per upload day
+    (as a datetime.date) [files, bytes] values.
+    """
+    cur.execute(
+        """
+        SELECT tbl, day, SUM(files), SUM(bytes) FROM file_stats
+        GROUP BY tbl, day HAVING SUM(files) <> 0 OR SUM(bytes) <> 0
+        ORDER BY tbl, day
+        """
+    )
+    stats = {}
+    for tbl, day, files, size in cur:
+        stats.setdefault(tbl, {})[day] = [int(files), int(size)]
+    return stats
+
+
+def compact_file_stats(cur):
+    """
+    Folds the shards of the file_stats counters of past days (which no longer get uploads, and so
+    have no more contention) into a single row, dropping days with no files left.  Must be called
+    inside a transaction.
+    """
+    cur.execute(
+        """
+        DELETE FROM file_stats WHERE day < (NOW() AT TIME ZONE 'UTC')::date
+        RETURNING tbl, day, files, bytes
+        """
+    )
+    totals = {}
+    for tbl, day, files, size in cur.fetchall():
+        t = totals.setdefault((tbl, day), [0, 0])
+        t[0] += files
+        t[1] += size
+    cur.executemany(
+        "INSERT INTO file_stats (tbl, day, shard, files, bytes) VALUES (%s, %s, 0, %s, %s)",
+        [(tbl, day, files, size) for (tbl, day), (files, size) in totals.items() if files or size],
+    )
+
+
 def log_stats(cur):
-    cur.execute("SELECT COUNT(*), sum(length(data)) FROM files")
-    num, size = cur.fetchone()
-    if num == 0 and size is None:
-        size = 0
+    stats = storage_stats(cur)
+    for table in ("files", config.COLD_TABLE):
+        if table is None:
+            continue
+        num = sum(f for f, _ in stats.get(table, {}).values())
+        size = sum(b for _, b in stats.get(table, {}).values())
+        app.logger.info(
+            "{}: {} files stored totalling {}".format(
+                "Current stats" if table == "files" else "Cold storage", num, pretty_bytes(size)
+            )
+        )
+
+    app.logger.info(
+        "Expiry: {} files ({}) expired; {} expired files waiting; last run took {}ms".format(
+            cache.stats.counter("expired_files"),
+            pretty_bytes(cache.stats.counter("expired_bytes")),
+            cache.stats.counter("expiry_backlog"),
+            cache.stats.counter("expiry_tick_ms"),
+        )
+    )
+
+    if cache.files is not None:
+        hits, misses = (cache.stats.counter(f"file_cache_{x}") for x in ("hits", "misses"))
+        app.logger.info(
+            "File cache: {} hits, {} misses ({:.1f}% hit rate)".format(
+                hits, misses, 100 * hits / max(hits + misses, 1)
+            )
+        )
+
+    if cache.missing is not None:
+        hits, adds = (cache.stats.counter(f"missing_cache_{x}") for x in ("hits", "adds"))
+        app.logger.info(
+            "Nonexistent file cache: {} lookups avoided, {} nonexistent ids looked up".format(
+                hits, adds
+            )
+        )
 
-    app.logger.info("Current stats: {} files stored totalling {}".format(num, pretty_bytes(size)))
+    if replication.enabled():
+        backlog, lag = replication.status(cur)
+        app.logger.info(
+            "Replication: {} changes waiting ({:.1f}s behind); {} replicated, {} failed".format(
+                backlog,
+                lag,
+                cache.stats.counter("replication_done"),
+                cache.stats.counter("replication_failures"),
+            )
+        )
@@ -0,0 +1,243 @@
+from . import config, utils
+
+from datetime import datetime, timedelta, timezone
+from psycopg import sql
+import os
+import struct
+import tempfile
+
+# On-disk, content-addressed blob storage for file bodies.
+#
+# When `config.FILE_STORAGE_DIR` is set, file content is not stored in the `files.data` column but
+# rather in a file on disk named after the blake2b content hash of the file (i.e. the same value
+# that `generate_file_id` returns), and the `files` row only records the metadata plus the content
+# hash in the `blob` column.  Blobs are sharded into two levels of subdirectories based on the first
+# characters of the hash (e.g. `ab/cd/abcdef...`) to keep directory sizes manageable.
+#
+# Multiple rows may refer to the same blob (e.g. identical uploads in backwards-compatible id mode),
+# so a blob is only removed once no row references it.  Adding and removing blob references is
+# serialized with a postgresql advisory lock on the blob hash (see `lock_blob`) so that a concurrent
+# upload of identical content can't race with the removal of an expired copy.
+
+
+# The size of the chunks in which we read, write, and hash file bodies
+CHUNK_SIZE = 65536
+
+# The size of the slices in which we fetch file content stored in the database for downloads; this
+# bounds the memory used per download.
+DB_CHUNK_SIZE = 512 * 1024
+
+
+class Upload:
+    """
+    A file body to be stored, along with its size and content hash id (see `generate_file_id`).
+    The body is either held in memory (`data`) or has been spooled into a temporary file (`file`) as
+    it was received.  Use `upload_from_bytes` or `spool_upload` to construct one.
+    """
+
+    def __init__(self, *, size, id, data=None, file=None):
+        self.size = size
+        self.id = id
+        self.data = data
+        self.file = file
+
+    def chunks(self):
+        """Yields the file body in chunks of at most CHUNK_SIZE bytes."""
+        if self.data is not None:
+            view = memoryview(self.data)
+            for i in range(0, self.size, CHUNK_SIZE):
+                yield view[i : i + CHUNK_SIZE]
+        else:
+            self.file.seek(0)
+            while True:
+                chunk = self.file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def close(self):
+        """Closes (and thereby removes) the spooled temporary file, if any."""
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def upload_from_bytes(data):
+    """Returns an Upload for a body that is already in memory."""
+    hasher = utils.file_id_hasher()
+    hasher.update(data)
+    return Upload(size=len(data), id=utils.file_id_from_hasher(hasher), data=data)
+
+
+def spool_upload(stream, max_size):
+    """
+    Reads an upload body from the file-like `stream` in CHUNK_SIZE pieces, hashing it and writing
+    it to a temporary file as it arrives, so that memory use doesn't depend on the size of the
+    upload.  If the body turns out to be larger than `max_size` we stop reading and return None;
+    otherwise returns an Upload.
+
+    When on-disk storage is enabled the temporary file is created inside the storage directory so
+    that it can later be hard-linked into place as the blob without copying it.
+    """
+    hasher = utils.file_id_hasher()
+    size = 0
+    if enabled():
+        f = tempfile.NamedTemporaryFile(dir=config.FILE_STORAGE_DIR, prefix=".upload-")
+    else:
+        f = tempfile.TemporaryFile()
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                f.close()
+                return None
+            hasher.update(chunk)
+            f.write(chunk)
+        f.flush()
+    except BaseException:
+        f.close()
+        raise
+
+    return Upload(size=size, id=utils.file_id_from_hasher(hasher), file=f)
+
+
+def enabled():
+    """Returns True if file bodies are stored on disk rather than in the database."""
+    return config.FILE_STORAGE_DIR is not None
+
+
+def blob_path(key):
+    """Returns the path of the blob with content hash `key`."""
+    return os.path.join(config.FILE_STORAGE_DIR, key[0:2], key[2:4], key)
+
+
+def lock_blob(cur, key):
+    """
+    Obtains a transaction-level advisory lock on the given blob, which must be held while adding or
+    removing a reference to the blob.  Must be called inside a transaction.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(hashtextextended(%s, 0))", (key,))
+
+
+def store_blob(key, upload):
+    """
+    Writes the body of Upload `upload` as the content of blob `key`.  The blob is written to a
+    temporary file (or, for a spooled upload, the spool file itself is used) and then atomically
+    linked into place, so that readers never see a partially written blob.  If the blob already
+    exists (i.e. identical content was stored before) this does nothing.
+    """
+    path = blob_path(key)
+    if os.path.exists(path):
+        return
+
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+
+    if upload.file is not None and hasattr(upload.file, "name"):
+        os.fsync(upload.file.fileno())
+        try:
+            os.link(upload.file.name, path)
+        except FileExistsError:
+            pass
+        return
+
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=f".{key}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in upload.chunks():
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def open_blob(key):
+    """Opens the given blob for reading; returns None if the blob does not exist."""
+    try:
+        return open(blob_path(key), "rb")
+    except FileNotFoundError:
+        return None
+
+
+def file_chunks(f, length):
+    """
+    Generator that yields `length` bytes from the current position of file `f` in chunks of at most
+    CHUNK_SIZE bytes, then closes the file.
+    """
+    try:
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                raise RuntimeError(f"Unexpected end of file reading {f.name}")
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def read_blob(key):
+    """Returns the full content of the given blob, or None if the blob does not exist."""
+    f = open_blob(key)
+    if f is None:
+        return None
+    with f:
+        return f.read()
+
+
+def release_blobs(psql, keys):
+    """
+    Removes the given blobs from disk if they are no longer referenced by any file.  This is called
+    with the blob hashes of deleted files rows.  Returns the number of blobs removed.
+    """
+    exists = sql.SQL(" OR ").join(
+        sql.SQL("EXISTS(SELECT 1 FROM {} WHERE blob = %(key)s)").format(sql.Identifier(t))
+        for t in ("files", config.COLD_TABLE)
+        if t is not None
+    )
+    removed = 0
+    for key in set(keys):
+        with psql.transaction(), psql.cursor() as cur:
+            lock_blob(cur, key)
+            cur.execute(sql.SQL("SELECT {}").format(exists), {"key": key})
+            if cur.fetchone()[0]:
+                continue
+            try:
+                os.unlink(blob_path(key))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+_PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+def copy_into_files(cur, id, upload):
+    """
+    Inserts a new files row with the body of `upload` stored in the `data` column.  Unlike a plain
+    INSERT this streams the body into the database via a binary COPY, so that a spooled upload never
+    has to be loaded into memory.
+    """
+    cur.execute("SELECT NOW() + %s::interval", (config.FILE_EXPIRY,))
+    expiry_us = (cur.fetchone()[0] - _PG_EPOCH) // timedelta(microseconds=1)
+    id_bytes = id.encode()
+
+    # Binary COPY format: signature, flags, and header extension length, followed by one tuple of
+    # field count and then length-prefixed field values, and finally a -1 trailer.
+    with cur.copy("COPY files (id, data, size, expiry) FROM STDIN (FORMAT BINARY)") as copy:
+        copy.write(b"PGCOPY\n\xff\r\n\0" + struct.pack("!ii", 0, 0))
+        copy.write(struct.pack("!hi", 4, len(id_bytes)) + id_bytes + struct.pack("!i", upload.size))
+        for chunk in upload.chunks():
+            copy.write(chunk)
+        copy.write(struct.pack("!iqiqh", 8, upload.size, 8, expiry_us, -1))
@@ -1,10 +1,94 @@
 from .web import app
-from . import http
+from . import config, http, metrics, serialize
 
 from flask import request
+from functools import cached_property
 from io import BytesIO
+import time
 import traceback
 from typing import Optional, Union
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags, parse_if_range_header, parse_range_header
+
+# Endpoints that sub-requests can call directly (see fast_subrequest) rather than through flask's
+# full request dispatch.  Their view functions take a `req` argument that is used instead of flask's
+# `request`, and must not depend on anything else about the request.
+FAST_ENDPOINTS = {
+    "submit_file",
+    "get_file",
+    "get_file_info",
+    "get_session_version",
+    "get_token_info",
+}
+
+_url_adapter = None
+
+
+class SubRequest:
+    """
+    Lightweight stand-in for flask's `request` for sub-requests handled by the fast path, providing
+    (with the same names and semantics) just the request attributes that the FAST_ENDPOINTS use.
+    """
+
+    def __init__(self, method, path, query_string, headers, body):
+        self.method = method
+        self.path = path
+        self.query_string = query_string.encode()
+        self.headers = headers
+        self.data = body
+        self.content_length = len(body)
+        self.environ = {'fileserver.body': body, 'fileserver.subrequest': True}
+
+    @cached_property
+    def args(self):
+        return MultiDict(parse_qsl(self.query_string.decode(), keep_blank_values=True))
+
+    @cached_property
+    def range(self):
+        return parse_range_header(self.headers.get("Range"))
+
+    @cached_property
+    def if_none_match(self):
+        return parse_etags(self.headers.get("If-None-Match"))
+
+    @cached_property
+    def if_range(self):
+        return parse_if_range_header(self.headers.get("If-Range"))
+
+
+def fast_subrequest(method, path, query_string, headers, body):
+    """
+    Handles a sub-request to one of the FAST_ENDPOINTS by calling its view function directly with a
+    SubRequest, skipping the construction of a WSGI environ and flask request context.  Returns the
+    response, or None if the request has to go through full flask dispatch instead (because it is
+    for some other endpoint, or is otherwise unusual).
+    """
+    global _url_adapter
+    if (
+        not config.SUBREQUEST_FAST_PATH
+        or method not in ("GET", "POST")
+        or not (path.isascii() and query_string.isascii())
+    ):
+        return None
+    if _url_adapter is None:
+        _url_adapter = app.url_map.bind("localhost")
+    try:
+        endpoint, args = _url_adapter.match(path, method)
+    except HTTPException:  # No such endpoint, method not allowed, redirect, etc.
+        return None
+    if endpoint not in FAST_ENDPOINTS:
+        return None
+
+    started = time.perf_counter()
+    req = SubRequest(method, path, query_string, headers, body)
+    try:
+        response = app.view_functions[endpoint](**args, req=req)
+    except HTTPException as e:
+        response = e.get_response()
+    metrics.record_request(endpoint, response.status_code, started)
+    return response
 
 
 def make_subrequest(
@@ -49,20 +133,32 @@ def make_subrequest(
 
     if body is None:
         if json is not None:
-            from json import dumps
-
-            body = dumps(json, separators=(',', ':')).encode()
+            body = serialize.dumps(json)
         else:
             body = b''
 
-    body_input = BytesIO(body)
-    content_length = len(body)
-
     if '?' in path:
         path, query_string = path.split('?', 1)
     else:
         query_string = ''
 
+    started = time.perf_counter()
+    fast_headers = Headers(headers)
+    fast_headers.remove('Content-Length')
+    fast_headers['Content-Type'] = content_type
+    try:
+        response = fast_subrequest(method, path, query_string, fast_headers, body)
+    except Exception:
+        app.logger.warning(f"Sub-request for {method} {path} failed: {traceback.format_exc()}")
+        raise
+    if response is not None:
+        metrics.observe("sfs_subrequest_duration_seconds", time.perf_counter() - started)
+        # (Fast path endpoints don't send Location headers, which are all that need the environ)
+        return finish_subrequest(method, path, response, response.get_wsgi_headers({}))
+
+    body_input = BytesIO(body)
+    content_length = len(body)
+
     # Set up the wsgi environ variables for the subrequest (see PEP 0333)
     subreq_env = {
         **request.environ,
@@ -74,22 +170,32 @@ def make_subrequest(
         **http_headers,
         'wsgi.input': body_input,
         'flask._preserve_context': False,
+        # Lets endpoints that would otherwise stream the body use it directly, without a copy:
+        'fileserver.body': body,
+        'fileserver.subrequest': True,
     }
+    # The server's file wrapper (e.g. for sendfile) can't be used because we need the response body
+    # ourselves, so force the use of werkzeug's plain file iterator instead.
+    subreq_env.pop('wsgi.file_wrapper', None)
 
     try:
         app.logger.debug(f"Initiating sub-request for {method} {path}")
-        with app.request_context(subreq_env):
+        with app.request_context(subreq_env), metrics.timed("sfs_subrequest_duration_seconds"):
             response = app.full_dispatch_request()
-        if response.status_code != http.OK:
-            app.logger.warning(
-                f"Sub-request for {method} {path} returned status {response.status_code}"
-            )
-        return response, {
-            k.lower(): v
-            for k, v in response.get_wsgi_headers(subreq_env)
-            if k.lower() != 'content-length'
-        }
+        return finish_subrequest(method, path, response, response.get_wsgi_headers(subreq_env))
 
     except Exception:
         app.logger.warning(f"Sub-request for {method} {path} failed: {traceback.format_exc()}")
         raise
+
+
+def finish_subrequest(method, path, response, headers):
+    """Returns the `make_subrequest` return value for `response`, with response headers `headers`"""
+    if response.direct_passthrough:
+        # Allow the caller to access the body of file responses via `response.get_data()`
+        response.direct_passthrough = False
+    if response.status_code != http.OK:
+        app.logger.warning(
+            f"Sub-request for {method} {path} returned status {response.status_code}"
+        )
+    return response, {k.lower(): v for k, v in headers if k.lower() != 'content-length'}
@@ -9,18 +9,24 @@ WARNING:
 
 Failed to load uwsgidecorators; we probably aren't running under uwsgi.
 
-File cleanup and session version updating will not be enabled!
+File cleanup and session version updating will not be enabled (unless serving via ASGI)!
 """
     )
 
     class timer:
-        """Do-nothing stub"""
+        """
+        Stub that just records the timer functions (in `timer.registered`, as (secs, f) tuples) so
+        that the ASGI server (see asgi.py) can run them.
+        """
+
+        registered = []
 
         def __init__(self, secs, **kwargs):
-            pass
+            self.secs = secs
 
         def __call__(self, f):
-            pass
+            timer.registered.append((self.secs, f))
+            return f
 
 
 else:
@@ -0,0 +1,99 @@
+from .web import app
+from . import cache, config, db, serialize
+
+from datetime import datetime, timezone
+import time
+
+# Cached /token_info responses.
+#
+# The token history (session_token_history, written by an external updater) is downsampled by a
+# trigger into session_token_history_hourly, which keeps the latest sample of each hour; responses
+# are built from that and cached, already serialized, per `days` value in each worker.  A cached
+# response is used for as long as the latest history timestamp (which the periodic job checks and
+# publishes to all workers via the `token_history_updated` stats counter) and the current UTC day
+# (which moves the start of the window) are unchanged, and at most TOKEN_INFO_TTL seconds.
+
+_responses = {}  # days -> (updated stamp, day, expiry, body)
+
+
+def latest_update(cur):
+    """Returns the timestamp of the most recent token history sample as integer microseconds."""
+    cur.execute("SELECT MAX(updated) FROM session_token_history")
+    updated = cur.fetchone()[0]
+    return 0 if updated is None else int(updated.timestamp() * 1_000_000)
+
+
+def poll(cur):
+    """Publishes the latest token history timestamp to all workers; called periodically."""
+    cache.stats.set_counter('token_history_updated', latest_update(cur))
+
+
+def build(cur, days):
+    """
+    Builds the /token_info response body for the last `days` days (plus the current day) of hourly
+    token history.  Returns None (and logs a warning) if no token stats are available.
+    """
+    cur.execute(
+        "SELECT maximum_supply, sent_per_node, staking_reward_pool FROM session_token_stats"
+    )
+    stats = cur.fetchone()
+    if stats is None:
+        app.logger.warning("No token stats available!")
+        return None
+
+    cur.execute(
+        """
+        SELECT current_value, circulating_supply, total_nodes, updated
+        FROM session_token_history_hourly
+        WHERE hour >= date_trunc('day', NOW()) - %s * '1 day'::interval
+        ORDER BY hour
+        """,
+        (days,),
+    )
+    history = [
+        {
+            "current_value": str(value),
+            "circulating_supply": supply,
+            "total_nodes": nodes,
+            "updated": updated.timestamp(),
+        }
+        for value, supply, nodes, updated in cur
+    ]
+    return serialize.dumps(
+        {
+            "status_code": 200,
+            "info": {
+                "maximum_supply": stats[0],
+                "sent_per_node": stats[1],
+                "staking_reward_pool": stats[2],
+                "history": history,
+            },
+        }
+    )
+
+
+def get(days):
+    """
+    Returns the serialized /token_info response for `days` days of history, from the cache if
+    current, otherwise built from the database.  Returns None if token info isn't available.
+    """
+    stamp = cache.stats.counter('token_history_updated')
+    today = datetime.now(timezone.utc).date()
+    now = time.monotonic()
+
+    cached = _responses.get(days)
+    if cached is not None and cached[:2] == (stamp, today) and cached[2] > now:
+        cache.stats.incr('token_info_cache_hits')
+        return cached[3]
+
+    cache.stats.incr('token_info_cache_misses')
+    with db.psql.cursor() as cur:
+        body = build(cur, days)
+    if body is not None:
+        _responses[days] = (stamp, today, now + config.TOKEN_INFO_TTL, body)
+    return body
+
+
+def drop():
+    """Clears the cached responses, e.g. after the token tables have been changed directly."""
+    _responses.clear()
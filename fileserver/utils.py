@@ -1,6 +1,12 @@
 from typing import Tuple
+from hashlib import blake2b
 import base64
 
+try:
+    import uwsgi
+except ModuleNotFoundError:
+    uwsgi = None
+
 
 def bencode_consume_string(body: memoryview) -> Tuple[memoryview, memoryview]:
     """
@@ -57,3 +63,28 @@ def decode_hex_or_b64(data: bytes, size: int):
             return decoded
 
     raise ValueError("Invalid value: could not decode as hex or base64")
+
+
+def file_id_hasher():
+    """
+    Returns a new blake2b hasher for computing a content-based file id; feed it the file body with
+    `.update()` and then pass it to `file_id_from_hasher` to get the id.
+    """
+    return blake2b(digest_size=33, salt=b"SessionFileSvr\0\0")
+
+
+def file_id_from_hasher(hasher):
+    """
+    Returns the file ID from a hasher returned by `file_id_hasher()`: the 33-byte digest encoded
+    into 44 base64 chars.  (Ideally would be 32, but that would result in base64 padding, so
+    increased to 33 to fit perfectly).
+    """
+    return base64.urlsafe_b64encode(hasher.digest()).decode()
+
+
+def threads_enabled():
+    """
+    Returns True if threads we start get to run: under uwsgi that needs python thread support
+    (`enable-threads` or `threads`) to be enabled.
+    """
+    return uwsgi is None or bool(uwsgi.opt.get('enable-threads') or uwsgi.opt.get('threads'))
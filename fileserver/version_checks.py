@@ -0,0 +1,322 @@
+from .web import app
+from . import cache, config, db, replication, utils
+from .hll import HyperLogLog
+
+import atexit
+from datetime import datetime, timedelta, timezone
+from psycopg import sql
+import re
+import threading
+import time
+
+# Buffered recording of account version checks.
+#
+# Authenticated /session_version requests record a (blinded_id, platform, timestamp) row in the
+# account_version_checks table.  Rather than making each request wait for its own tiny insert
+# transaction, requests just append the check to a per-worker buffer, which gets written to the
+# database in bulk (with COPY, and queued for replication as a single outbox entry) by a
+# background thread once VERSION_CHECK_BATCH_SIZE checks have accumulated, or at least every
+# VERSION_CHECK_FLUSH_INTERVAL seconds.  The buffer is also flushed when the worker exits.
+#
+# The trade-off is bounded loss: if a worker dies without a clean exit the checks in its buffer
+# (i.e. at most the last VERSION_CHECK_FLUSH_INTERVAL seconds or VERSION_CHECK_BATCH_SIZE checks,
+# unless the database was unreachable) are lost.  While the database can't be written to, failed
+# batches are put back into the buffer, keeping at most VERSION_CHECK_MAX_BUFFER checks (dropping
+# the oldest).
+#
+# Without thread support (e.g. uwsgi without `enable-threads`) the request that fills the buffer,
+# or finds its oldest check older than the flush interval, flushes it instead.
+#
+# In the database account_version_checks is partitioned by day (see schema.pgsql).  `maintain`,
+# called periodically, creates the partitions ahead of time, folds each finished day into per
+# platform rows of account_version_rollups (a check count, and a HyperLogLog sketch of the blinded
+# ids from which the number of unique users over any range of days can be estimated), and drops
+# partitions older than VERSION_CHECK_RETENTION_DAYS, so that the raw table stays bounded and usage
+# statistics (see `usage`) only need to read a few kB per day.
+
+_lock = threading.Lock()
+_wakeup = threading.Condition(_lock)
+_buffer = []
+_flusher = None
+_failed_at = None  # time.monotonic() of the last failed (non-threaded) flush
+_warned_unpartitioned = False
+
+
+def record(blinded_id, platform):
+    """Records an account version check, to be written to the database in the next flush."""
+    global _flusher, _failed_at
+    now = datetime.now(timezone.utc)
+    with _lock:
+        _buffer.append((blinded_id, platform, now))
+        _trim()
+        if utils.threads_enabled():
+            if _flusher is None:
+                _flusher = threading.Thread(
+                    target=_flush_periodically, name="sfs-version-checks", daemon=True
+                )
+                _flusher.start()
+            if len(_buffer) == config.VERSION_CHECK_BATCH_SIZE:
+                _wakeup.notify()
+            return
+
+        interval = config.VERSION_CHECK_FLUSH_INTERVAL
+        due = (
+            len(_buffer) >= config.VERSION_CHECK_BATCH_SIZE
+            or (now - _buffer[0][2]).total_seconds() >= interval
+        ) and (_failed_at is None or time.monotonic() - _failed_at >= interval)
+
+    if due:
+        try:
+            flush()
+            _failed_at = None
+        except Exception as e:
+            _failed_at = time.monotonic()
+            app.logger.warning(f"Failed to write account version checks: {e}")
+
+
+def _trim():
+    """Drops the oldest buffered checks beyond VERSION_CHECK_MAX_BUFFER; call with _lock held."""
+    excess = len(_buffer) - config.VERSION_CHECK_MAX_BUFFER
+    if excess > 0:
+        del _buffer[:excess]
+        cache.stats.incr('version_checks_dropped', excess)
+
+
+def pending():
+    """Returns the number of buffered checks waiting to be written."""
+    with _lock:
+        return len(_buffer)
+
+
+def flush():
+    """
+    Writes all buffered checks to the database.  Returns the number written.  If that fails the
+    checks are put back into the buffer (to be retried on the next flush) and the error is raised.
+    """
+    with _lock:
+        rows = _buffer[:]
+        _buffer.clear()
+    if not rows:
+        return 0
+
+    try:
+        with db.psql_pool.connection() as conn, conn.transaction(), conn.cursor() as cur:
+            replication.queue_version_checks(cur, rows)
+    except Exception:
+        with _lock:
+            _buffer[:0] = rows
+            _trim()
+        raise
+
+    cache.stats.incr('version_checks_written', len(rows))
+    return len(rows)
+
+
+def _flush_periodically():
+    while True:
+        with _lock:
+            if len(_buffer) < config.VERSION_CHECK_BATCH_SIZE:
+                _wakeup.wait(config.VERSION_CHECK_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            app.logger.warning(f"Failed to write account version checks: {e}")
+            # Don't spin while the database is unavailable:
+            with _lock:
+                _wakeup.wait(config.VERSION_CHECK_FLUSH_INTERVAL)
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        n = flush()
+    except Exception as e:
+        app.logger.error(f"Failed to write {pending()} account version checks at exit: {e}")
+    else:
+        if n:
+            app.logger.info(f"Wrote {n} buffered account version checks at exit")
+
+
+def partition_start(day):
+    return datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+
+
+def create_partition(psql, cur, day):
+    """
+    Creates the account_version_checks partition for (UTC) `day`, moving any checks for the day
+    that have landed in the default partition into it.
+    """
+    part = sql.Identifier(f"account_version_checks_p{day:%Y%m%d}")
+    start, end = partition_start(day), partition_start(day + timedelta(days=1))
+    with psql.transaction():
+        cur.execute(
+            sql.SQL("CREATE TABLE {} (LIKE account_version_checks INCLUDING DEFAULTS)").format(part)
+        )
+        cur.execute(
+            sql.SQL(
+                """
+                WITH moved AS (
+                    DELETE FROM account_version_checks_default
+                    WHERE timestamp >= %s AND timestamp < %s
+                    RETURNING blinded_id, platform, timestamp
+                )
+                INSERT INTO {} SELECT * FROM moved
+                """
+            ).format(part),
+            (start, end),
+        )
+        cur.execute(
+            sql.SQL(
+                "ALTER TABLE account_version_checks ATTACH PARTITION {} "
+                "FOR VALUES FROM ({}) TO ({})"
+            ).format(part, sql.Literal(start), sql.Literal(end))
+        )
+
+
+def rollup(psql, day):
+    """
+    Computes (or recomputes) the account_version_rollups rows of (UTC) `day` from the raw checks.
+    Returns the number of checks.
+    """
+    checks = {}
+    users = {}
+    start = partition_start(day)
+    with psql.transaction():
+        with psql.cursor(name="version_check_rollup") as scur:
+            scur.itersize = 10_000
+            scur.execute(
+                """
+                SELECT platform, blinded_id, COUNT(*) FROM account_version_checks
+                WHERE timestamp >= %s AND timestamp < %s
+                GROUP BY platform, blinded_id
+                """,
+                (start, start + timedelta(days=1)),
+            )
+            for platform, blinded_id, count in scur:
+                if platform not in users:
+                    users[platform] = HyperLogLog()
+                    checks[platform] = 0
+                users[platform].add(blinded_id)
+                checks[platform] += count
+
+        # The '*' row (which always gets added, and so also marks the day as rolled up) is the total
+        # over all platforms:
+        users["*"] = HyperLogLog()
+        for sketch in list(users.values()):
+            users["*"].merge(sketch)
+        checks["*"] = sum(checks.values())
+
+        with psql.cursor() as cur:
+            cur.executemany(
+                """
+                INSERT INTO account_version_rollups (day, platform, checks, users_hll)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (day, platform) DO UPDATE
+                    SET checks = EXCLUDED.checks, users_hll = EXCLUDED.users_hll
+                """,
+                [(day, p, checks[p], users[p].to_bytes()) for p in checks],
+            )
+    return checks["*"]
+
+
+def maintain(psql):
+    """
+    Creates upcoming account_version_checks partitions, rolls up (at most one per call, since that
+    involves reading all of the day's checks) finished days that haven't been rolled up yet, and
+    drops rolled up partitions older than VERSION_CHECK_RETENTION_DAYS.  Does nothing (other than
+    warning once) if the database's account_version_checks isn't partitioned yet, i.e. hasn't had
+    upgrades/06-version-check-partitions.pgsql applied.
+    """
+    global _warned_unpartitioned
+    now = datetime.now(timezone.utc)
+    today = now.date()
+    with psql.cursor() as cur:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = 'account_version_checks'::regclass")
+        if cur.fetchone()[0] != 'p':
+            if not _warned_unpartitioned:
+                app.logger.warning(
+                    "account_version_checks is not partitioned (see "
+                    "upgrades/06-version-check-partitions.pgsql); skipping its maintenance"
+                )
+                _warned_unpartitioned = True
+            return
+
+        cur.execute(
+            """
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'account_version_checks'::regclass
+            """
+        )
+        partitions = {}
+        for (name,) in cur.fetchall():
+            m = re.fullmatch(r"account_version_checks_p(\d{8})", name)
+            if m:
+                partitions[datetime.strptime(m[1], "%Y%m%d").date()] = name
+
+        for day in (today + timedelta(days=n) for n in range(3)):
+            if day not in partitions:
+                create_partition(psql, cur, day)
+
+        cur.execute("SELECT day FROM account_version_rollups WHERE platform = '*'")
+        rolled_up = {r[0] for r in cur.fetchall()}
+        cur.execute(
+            """
+            SELECT DISTINCT (timestamp AT TIME ZONE 'UTC')::date
+            FROM account_version_checks_default
+            """
+        )
+        days = set(partitions) | {r[0] for r in cur.fetchall()}
+
+        # Buffered checks get written a few seconds after they happen, so give a finished day some
+        # time before rolling it up.  (Checks held back by a longer database outage are still
+        # written, but won't be included in their day's rollup).
+        finished = (now - timedelta(minutes=10)).date()
+        todo = sorted(d for d in days - rolled_up if d < finished)
+        if todo:
+            n = rollup(psql, todo[0])
+            rolled_up.add(todo[0])
+            app.logger.info(f"Rolled up {n} account version checks of {todo[0]}")
+
+        oldest = today - timedelta(days=config.VERSION_CHECK_RETENTION_DAYS)
+        dropped = []
+        for day, name in sorted(partitions.items()):
+            if day < oldest and day in rolled_up:
+                cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+                dropped.append(name)
+        unrolled = [d for d in days if d not in rolled_up]
+        cur.execute(
+            "DELETE FROM account_version_checks_default WHERE timestamp < %s",
+            (partition_start(min([oldest, *unrolled])),),
+        )
+    if dropped:
+        app.logger.info(f"Dropped account version check partitions {', '.join(dropped)}")
+
+
+def usage(cur, first, last):
+    """
+    Returns account version check statistics for (UTC) days `first` through `last` from the
+    rollups: a dict of platform (or '*' for all platforms) to a dict with the total number of
+    "checks", the estimated number of unique "users" over the whole period, and a list of per day
+    [day, checks, users] values.  (Days that haven't been rolled up yet aren't included).
+    """
+    cur.execute(
+        """
+        SELECT day, platform, checks, users_hll FROM account_version_rollups
+        WHERE day BETWEEN %s AND %s ORDER BY day, platform
+        """,
+        (first, last),
+    )
+    result = {}
+    sketches = {}
+    for day, platform, checks, users_hll in cur:
+        sketch = HyperLogLog.from_bytes(users_hll)
+        r = result.setdefault(platform, {"checks": 0, "users": 0, "days": []})
+        r["checks"] += checks
+        r["days"].append([day, checks, sketch.count()])
+        if platform in sketches:
+            sketches[platform].merge(sketch)
+        else:
+            sketches[platform] = sketch
+    for platform, sketch in sketches.items():
+        result[platform]["users"] = sketch.count()
+    return result
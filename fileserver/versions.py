@@ -0,0 +1,127 @@
+from .web import app
+from . import cache, config, db, serialize
+
+from hashlib import blake2b
+
+# Precomputed /session_version responses.
+#
+# The release data only changes when the GitHub poller (github.py) updates a project, so
+# rather than querying it on every request the poller builds the final response body for the
+# platform and stores it, along with an ETag derived from it, in the shared `versions` cache from
+# where every worker serves it.  Requests that find nothing in the cache (e.g. before the poller's
+# first update, or in a process that doesn't share the poller's cache) build the body from the
+# database and cache it for SESSION_VERSION_TTL seconds.
+
+PLATFORMS = ("desktop", "android", "ios")
+
+# Cached values are the hex ETag followed by the json body
+_ETAG_SIZE = 32
+
+
+def project_name(platform):
+    return "oxen-io/session-" + platform
+
+
+def project_platform(project):
+    """Returns the platform of GitHub project name `project`, or None if not a known project"""
+    for platform in PLATFORMS:
+        if project == project_name(platform):
+            return platform
+    return None
+
+
+def _release_info(cur, view, project):
+    """
+    Returns the latest release of `project` in `view` (release_versions or prerelease_versions) as
+    a response dict without the "updated" field, or None if there are no such releases.
+    """
+    cur.execute(
+        f"SELECT id, version, name, notes FROM {view} WHERE proj_name = %s"
+        " ORDER BY version_code DESC LIMIT 1",
+        (project,),
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    release_id, version, name, notes = row
+    info = {"result": version}
+    if name:
+        info["name"] = name
+    if notes:
+        info["notes"] = notes
+
+    cur.execute("SELECT name, url FROM release_assets WHERE release = %s", (release_id,))
+    assets = [{"name": name, "url": url} for name, url in cur.fetchall()]
+    if assets:
+        info["assets"] = assets
+    return info
+
+
+def build(cur, platform):
+    """
+    Builds the /session_version response body for `platform` from the database.  Returns None (and
+    logs a warning) if the project or its releases are missing.
+    """
+    project = project_name(platform)
+    cur.execute("SELECT updated FROM projects WHERE name = %s", (project,))
+    row = cur.fetchone()
+    if row is None:
+        app.logger.warning("{} does not exist!".format(project))
+        return None
+    updated = row[0].timestamp()
+
+    release = _release_info(cur, "release_versions", project)
+    if release is None:
+        app.logger.warning("{} has no releases!".format(project))
+        return None
+    response = {"status_code": 200, "updated": updated, **release}
+
+    prerelease = _release_info(cur, "prerelease_versions", project)
+    if prerelease is not None:
+        response["prerelease"] = {"result": prerelease.pop("result"), "updated": updated}
+        response["prerelease"].update(prerelease)
+
+    return serialize.dumps(response)
+
+
+def store(platform, body, ttl=0):
+    """Caches the response body `body` for `platform`; returns the (etag, body) tuple."""
+    etag = blake2b(body, digest_size=_ETAG_SIZE // 2).hexdigest()
+    cache.versions.set(platform, etag.encode() + body, ttl)
+    return etag, body
+
+
+def refresh(cur, platform):
+    """
+    Rebuilds and caches the response for `platform`; called by the poller when the project gets
+    updated.
+    """
+    body = build(cur, platform)
+    if body is None:
+        cache.versions.delete(platform)
+    else:
+        store(platform, body)
+
+
+def get(platform):
+    """
+    Returns the (etag, body) of the /session_version response for `platform`, building it from the
+    database if it isn't cached.  Returns None if the version information isn't available.
+    """
+    val = cache.versions.get(platform)
+    if val is not None:
+        cache.stats.incr('version_cache_hits')
+        return val[:_ETAG_SIZE].decode(), val[_ETAG_SIZE:]
+
+    cache.stats.incr('version_cache_misses')
+    with db.psql.cursor() as cur:
+        body = build(cur, platform)
+    if body is None:
+        return None
+    return store(platform, body, config.SESSION_VERSION_TTL)
+
+
+def drop():
+    """Removes all cached responses, e.g. after the release tables have been changed directly."""
+    for platform in PLATFORMS:
+        cache.versions.delete(platform)
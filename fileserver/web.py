@@ -21,3 +21,5 @@ from . import routes  # noqa: F401, E402
 from . import cleanup  # noqa: F401, E402
 from . import db  # noqa: F401, E402
 from . import onion_req  # noqa: F401, E402
+from . import replication  # noqa: F401, E402
+from . import metrics  # noqa: F401, E402
@@ -41,7 +41,7 @@ for dentry in os.scandir(filesdir):
 
     stat = dentry.stat()
     size = stat.st_size
-    row = cur.execute("SELECT length(data) FROM files WHERE id = %s", (dentry.name,)).fetchone()
+    row = cur.execute("SELECT size FROM files WHERE id = %s", (dentry.name,)).fetchone()
     if row:
         if size != row[0]:
             print(
@@ -61,10 +61,10 @@ for dentry in os.scandir(filesdir):
 
         cur.execute(
             """
-            INSERT INTO files (id, data, uploaded, expiry)
-            VALUES (%s, %b, %s, %s + %s)
+            INSERT INTO files (id, data, size, uploaded, expiry)
+            VALUES (%s, %b, %s, %s, %s + %s)
             """,
-            (dentry.name, data, uploaded, uploaded, config.FILE_EXPIRY),
+            (dentry.name, data, size, uploaded, uploaded, config.FILE_EXPIRY),
         )
         count += 1
         committed_size += size
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Moves file content stored in the database `files.data` column into the on-disk blob store
+# configured via `FILE_STORAGE_DIR`.  This can be run while the file server is running, and can be
+# interrupted and restarted at any time.
+
+import psycopg
+from psycopg import sql
+import sys
+from datetime import datetime
+
+from fileserver import config, storage
+
+if len(sys.argv) != 1:
+    print("Usage: {}".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(1)
+
+if not storage.enabled():
+    print("Error: FILE_STORAGE_DIR is not set in the file server config", file=sys.stderr)
+    sys.exit(2)
+
+psql = psycopg.connect(**config.pgsql_connect_opts, autocommit=True)
+cur = psql.cursor()
+
+tables = [sql.Identifier(t) for t in ("files", config.COLD_TABLE) if t is not None]
+
+total_files = sum(
+    cur.execute(sql.SQL("SELECT COUNT(*) FROM {} WHERE data IS NOT NULL").format(t)).fetchone()[0]
+    for t in tables
+)
+
+count = 0
+moved_size = 0
+started = datetime.now()
+last_print = started
+for table in tables:
+    while True:
+        cur.execute(sql.SQL("SELECT id FROM {} WHERE data IS NOT NULL LIMIT 100").format(table))
+        ids = [r[0] for r in cur.fetchall()]
+        if not ids:
+            break
+
+        for id in ids:
+            with psql.transaction():
+                row = cur.execute(
+                    sql.SQL(
+                        "SELECT data FROM {} WHERE id = %s AND data IS NOT NULL FOR UPDATE"
+                    ).format(table),
+                    (id,),
+                    binary=True,
+                ).fetchone()
+                if not row:
+                    continue  # Expired or already moved since we selected it
+                upload = storage.upload_from_bytes(row[0])
+
+                storage.lock_blob(cur, upload.id)
+                storage.store_blob(upload.id, upload)
+                cur.execute(
+                    sql.SQL("UPDATE {} SET data = NULL, blob = %s WHERE id = %s").format(table),
+                    (upload.id, id),
+                )
+
+            count += 1
+            moved_size += upload.size
+
+            now = datetime.now()
+            if (now - last_print).total_seconds() > 0.5:
+                last_print = now
+                print(
+                    "\rMoved {:,} / {:,} files containing {:,.1f}MB ({:,.2f}MB/s)".format(
+                        count,
+                        total_files,
+                        moved_size / 1_000_000,
+                        moved_size / 1_000_000 / (now - started).total_seconds(),
+                    ),
+                    end='',
+                    flush=True,
+                )
+
+
+duration = (datetime.now() - started).total_seconds()
+print(
+    """
+
+Migration finished: moved {:,} files containing {:,d} bytes of data in {:,.2f} seconds
+
+Note that postgresql does not return the freed space to the operating system until you run a
+`VACUUM FULL` of the files tables (which locks the table while running).
+
+""".format(
+        count, moved_size, duration
+    )
+)
@@ -31,7 +31,8 @@ def db_conn(request):
     pgsql = request.config.getoption("--pgsql")
     web.app.logger.warning(f"using postgresql {pgsql}")
 
-    config.pgsql_connect_opts = {"conninfo": pgsql}
+    # Pool connections (used, for instance, for streaming downloads) need to use the test schema:
+    config.pgsql_connect_opts = {"conninfo": pgsql, "options": "-c search_path=sfs_tests"}
     db_.pg_connect()
     db_.psql = db_.psql_pool.getconn()
 
@@ -60,9 +61,23 @@ def db(request, db_conn):
         cur.execute("SET search_path TO sfs_tests")
         cur.execute(schema.read())
 
+    from fileserver import token_info, versions
+
+    versions.drop()
+    token_info.drop()
+
     return db_conn
 
 
+@pytest.fixture
+def fresh_stats(monkeypatch):
+    """Gives the test its own, empty set of statistics counters (`cache.stats`)"""
+    from fileserver import cache
+
+    monkeypatch.setattr(cache, "stats", cache.LocalCache(0))
+    return cache.stats
+
+
 @pytest.fixture
 def client():
     """Yields an flask test client for the app that can be used to make test requests"""
@@ -0,0 +1,115 @@
+from fileserver import asgi, config, db as db_, storage
+import asyncio
+import json
+import os
+
+
+async def asgi_request(method, path, body=b"", *, headers={}, chunk_size=None):
+    """
+    Makes a request to the ASGI app, sending the body in pieces of `chunk_size` bytes.  Returns
+    the status, (lower-case) headers dict, and body of the response.
+    """
+    chunk_size = chunk_size or len(body) or 1
+    pieces = [body[i : i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    messages = [
+        {"type": "http.request", "body": p, "more_body": i < len(pieces) - 1}
+        for i, p in enumerate(pieces)
+    ]
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "root_path": "",
+        "query_string": query.encode(),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        "client": ("127.0.0.1", 12345),
+        "server": ("localhost", 80),
+    }
+    received = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()  # i.e. the client never disconnects
+
+    async def send(message):
+        received.append(message)
+
+    await asgi.application(scope, receive, send)
+
+    start, *bodies = received
+    assert start["type"] == "http.response.start"
+    assert all(b["type"] == "http.response.body" for b in bodies)
+    assert not bodies[-1].get("more_body")
+    headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    return start["status"], headers, b"".join(b["body"] for b in bodies)
+
+
+def run_async(f):
+    """Runs coroutine function `f` with the asyncio database pool set up."""
+
+    async def main():
+        await db_.async_connect()
+        try:
+            return await f()
+        finally:
+            await db_.async_close()
+
+    return asyncio.run(main())
+
+
+def test_asgi_upload_download(db, monkeypatch):
+    monkeypatch.setattr(config, "ASGI_SPOOL_SIZE", 1000)
+    monkeypatch.setattr(storage, "DB_CHUNK_SIZE", 700)
+
+    small, big = os.urandom(500), os.urandom(5000)
+
+    async def requests():
+        status, _, body = await asgi_request("POST", "/file", small)
+        assert status == 200
+        small_id = json.loads(body)["id"]
+
+        # Sent in pieces and spooled to disk as it arrives:
+        status, _, body = await asgi_request("POST", "/file", big, chunk_size=999)
+        assert status == 200
+        big_id = json.loads(body)["id"]
+
+        status, headers, body = await asgi_request("GET", f"/file/{small_id}")
+        assert status == 200 and body == small
+        assert headers["content-length"] == "500"
+
+        # Streamed, in DB_CHUNK_SIZE slices, via the asyncio pool:
+        status, headers, body = await asgi_request("GET", f"/file/{big_id}")
+        assert status == 200 and body == big
+
+        status, headers, body = await asgi_request(
+            "GET", f"/file/{big_id}", headers={"Range": "bytes=1000-3999"}
+        )
+        assert status == 206 and body == big[1000:4000]
+        assert headers["content-range"] == "bytes 1000-3999/5000"
+
+        status, _, body = await asgi_request("GET", "/file/nosuchfile")
+        assert status == 404
+
+    run_async(requests)
+
+
+def test_asgi_too_large(db, monkeypatch):
+    monkeypatch.setattr(config, "ASGI_MAX_BODY", 2000)
+    body = os.urandom(3000)
+
+    async def requests():
+        # Rejected up front because of the Content-Length:
+        status, _, _ = await asgi_request(
+            "POST", "/file", body, headers={"Content-Length": "3000"}
+        )
+        assert status == 413
+
+        # Rejected while receiving it:
+        status, _, _ = await asgi_request("POST", "/file", body, chunk_size=500)
+        assert status == 413
+
+    run_async(requests)
@@ -0,0 +1,109 @@
+from fileserver import auth, cache, config, routes, version_checks
+from fileserver.web import app
+from hashlib import blake2b
+from nacl.signing import SigningKey
+from werkzeug.exceptions import HTTPException
+import pytest
+import time
+
+
+@pytest.fixture(autouse=True)
+def caches(monkeypatch):
+    """Gives each test empty auth caches, and no version check flushes"""
+    monkeypatch.setattr(config, "VERSION_CHECK_FLUSH_INTERVAL", 3600)
+    monkeypatch.setattr(cache, "auth_replays", cache.LocalCache(1_000_000))
+    auth._keys.clear()
+    version_checks._buffer.clear()
+    yield
+    version_checks._buffer.clear()
+
+
+def auth_headers(key, method, path, ts=None):
+    ts = str(int(time.time()) if ts is None else ts)
+    sig = key.sign(ts.encode() + method.encode() + path.encode()).signature
+    return {
+        "X-FS-Pubkey": "07" + key.verify_key.encode().hex(),
+        "X-FS-Timestamp": ts,
+        "X-FS-Signature": sig.hex(),
+    }
+
+
+def check_auth(headers, path="/session_version?platform=desktop"):
+    """Returns the (id, replay flag) of an auth check of a GET request, or the error status code"""
+    with app.test_request_context(path, headers=headers) as ctx:
+        try:
+            id = routes.valid_blinded_version_id_for_auth(ctx.request, True)
+        except HTTPException as e:
+            return e.response.status_code
+        return id, ctx.request.environ["fileserver.auth_replay"]
+
+
+def test_auth_caches(fresh_stats):
+    key = SigningKey.generate()
+    headers = auth_headers(key, "GET", "/session_version?platform=desktop")
+    id = headers["X-FS-Pubkey"]
+
+    assert check_auth(headers) == (id, False)
+    assert cache.stats.counter("auth_key_cache_misses") == 1
+    assert cache.stats.counter("auth_replay_misses") == 1
+
+    # An identical request (e.g. a retry through another path) doesn't get verified again:
+    assert check_auth(headers) == (id, True)
+    assert cache.stats.counter("auth_key_cache_hits") == 1
+    assert cache.stats.counter("auth_replay_hits") == 1
+
+    # A new request with the same key reuses the cached key, but gets verified:
+    headers = auth_headers(key, "GET", "/session_version?platform=android")
+    assert check_auth(headers, "/session_version?platform=android") == (id, False)
+    assert cache.stats.counter("auth_key_cache_hits") == 2
+    assert cache.stats.counter("auth_replay_misses") == 2
+
+
+def test_auth_failures(fresh_stats):
+    key = SigningKey.generate()
+    headers = auth_headers(key, "GET", "/session_version?platform=desktop")
+
+    # A signature for something else fails, and doesn't get remembered as verified:
+    assert check_auth(headers, "/session_version?platform=ios") == 401
+    assert check_auth(headers, "/session_version?platform=ios") == 401
+    assert cache.stats.counter("auth_replay_hits") == 0
+
+    old_ts = int(time.time()) - 2 * 86400
+    old = auth_headers(key, "GET", "/session_version?platform=desktop", ts=old_ts)
+    assert check_auth(old) == 425
+
+    # Not a valid point (and remembered as such):
+    bad = dict(headers, **{"X-FS-Pubkey": "07" + "ff" * 32})
+    assert check_auth(bad) == 400
+    assert auth._keys[b"\xff" * 32] is None
+    assert check_auth(bad) == 400
+
+
+def test_auth_body(fresh_stats):
+    key = SigningKey.generate()
+    ts, body = str(int(time.time())), b"request body"
+    signed = ts.encode() + b"POST/file" + blake2b(body, digest_size=64).digest()
+    headers = {
+        "X-FS-Pubkey": "07" + key.verify_key.encode().hex(),
+        "X-FS-Timestamp": ts,
+        "X-FS-Signature": key.sign(signed).signature.hex(),
+    }
+
+    # The signature covers the raw 64-byte BLAKE2b hash of the body:
+    with app.test_request_context("/file", method="POST", headers=headers, data=body) as ctx:
+        assert routes.valid_blinded_version_id_for_auth(ctx.request, True) == headers["X-FS-Pubkey"]
+    with app.test_request_context("/file", method="POST", headers=headers, data=b"other") as ctx:
+        with pytest.raises(HTTPException) as e:
+            routes.valid_blinded_version_id_for_auth(ctx.request, True)
+        assert e.value.response.status_code == 401
+
+
+def test_replayed_version_check(client):
+    key = SigningKey.generate()
+    headers = auth_headers(key, "GET", "/session_version?platform=desktop")
+
+    for _ in range(3):
+        client.get("/session_version?platform=desktop", headers=headers)
+
+    # Only the first of the identical requests counts as a version check:
+    assert version_checks.pending() == 1
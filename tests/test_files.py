@@ -0,0 +1,481 @@
+from fileserver import cache, compat_ids, config, storage
+import datetime
+import pytest
+import os
+
+
+@pytest.fixture(params=["db", "disk"])
+def storage_mode(request, tmp_path, monkeypatch):
+    """Runs the test with file content stored in the database, and again with on-disk storage."""
+    if request.param == "disk":
+        monkeypatch.setattr(config, "FILE_STORAGE_DIR", str(tmp_path))
+    else:
+        monkeypatch.setattr(config, "FILE_STORAGE_DIR", None)
+    return request.param
+
+
+def upload(client, data):
+    r = client.post("/file", data=data)
+    assert r.status_code == 200
+    return r.json["id"]
+
+
+@pytest.mark.parametrize("compat_ids", [True, False])
+def test_upload_download(client, db, storage_mode, compat_ids, monkeypatch):
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", compat_ids)
+
+    content = os.urandom(12345)
+    id = upload(client, content)
+
+    r = client.get(f"/file/{id}")
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/octet-stream"
+    assert r.data == content
+
+    r = client.get(f"/file/{id}/info")
+    assert r.status_code == 200
+    assert r.json["size"] == len(content)
+
+    with db.cursor() as cur:
+        cur.execute("SELECT data IS NULL, blob FROM files WHERE id = %s", (id,))
+        no_data, blob = cur.fetchone()
+    if storage_mode == "disk":
+        assert no_data
+        assert os.path.exists(storage.blob_path(blob))
+    else:
+        assert not no_data
+        assert blob is None
+
+    assert client.get("/file/nosuchfile").status_code == 404
+
+
+def test_compat_id_permutation():
+    for bits in (1, 2, 7, 8, 13):
+        ids = [compat_ids.permute(n, bits, b"k" * 32) for n in range(1 << bits)]
+        assert sorted(ids) == list(range(1 << bits))
+
+
+def test_compat_id_allocation(client, fresh_stats, monkeypatch):
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", True)
+    # Fix all but 8 bits of the id so that we can fill the id space completely:
+    fixed = [1, 0] * 22 + [1]
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS_FIXED_BITS", fixed)
+    prefix = int("".join(map(str, fixed)), 2)
+
+    ids = [int(upload(client, b"x")) for _ in range(256)]
+    assert sorted(ids) == [prefix << 8 | i for i in range(256)]
+    assert ids != sorted(ids)
+    assert cache.stats.counter("compat_id_retries") == 0
+
+    assert client.post("/file", data=b"x").status_code == 507
+
+
+def test_blob_expiry(client, db, storage_mode, monkeypatch):
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", True)
+    if storage_mode != "disk":
+        pytest.skip("blob expiry only applies to on-disk storage")
+
+    content = os.urandom(1000)
+    id1, id2 = upload(client, content), upload(client, content)
+    assert id1 != id2
+
+    with db.cursor() as cur:
+        cur.execute("SELECT DISTINCT blob FROM files")
+        blobs = [r[0] for r in cur.fetchall()]
+        assert len(blobs) == 1
+        path = storage.blob_path(blobs[0])
+
+        # Expiring one of the two uploads must keep the shared blob around:
+        cur.execute("DELETE FROM files WHERE id = %s RETURNING blob", (id1,))
+        assert storage.release_blobs(db, [r[0] for r in cur.fetchall()]) == 0
+        assert os.path.exists(path)
+        assert client.get(f"/file/{id2}").data == content
+
+        cur.execute("DELETE FROM files WHERE id = %s RETURNING blob", (id2,))
+        assert storage.release_blobs(db, [r[0] for r in cur.fetchall()]) == 1
+        assert not os.path.exists(path)
+
+
+def test_upload_size_limits(client, storage_mode, monkeypatch):
+    monkeypatch.setattr(config, "MAX_FILE_SIZE", 200_000)
+
+    assert client.post("/file", data=os.urandom(200_001)).status_code == 413
+    assert client.post("/file", data=b"").status_code == 413
+
+    # Bigger than a single read chunk, so this gets hashed and spooled incrementally:
+    content = os.urandom(200_000)
+    id = upload(client, content)
+    assert client.get(f"/file/{id}").data == content
+
+
+def test_dedup(client, db, storage_mode, monkeypatch):
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", False)
+
+    content = os.urandom(100_000)
+    id = upload(client, content)
+    with db.cursor() as cur:
+        cur.execute("UPDATE files SET expiry = NOW() + '1 minute' WHERE id = %s", (id,))
+
+    assert upload(client, content) == id
+    with db.cursor() as cur:
+        cur.execute("SELECT COUNT(*), MIN(expiry) > NOW() + '1 day' FROM files")
+        assert cur.fetchone() == (1, True)
+    assert client.get(f"/file/{id}").data == content
+
+
+def test_streamed_download(client, storage_mode, monkeypatch):
+    # Make the database slices small so that the download takes many of them:
+    monkeypatch.setattr(storage, "DB_CHUNK_SIZE", 1000)
+
+    for size in (999, 1000, 1001, 54321):
+        content = os.urandom(size)
+        id = upload(client, content)
+        r = client.get(f"/file/{id}")
+        assert r.status_code == 200
+        assert r.headers["content-length"] == str(size)
+        assert r.data == content
+
+
+def test_conditional_and_range(client, storage_mode):
+    content = os.urandom(5000)
+    id = upload(client, content)
+
+    r = client.get(f"/file/{id}")
+    etag = r.headers["etag"]
+    assert r.headers["accept-ranges"] == "bytes"
+    assert "immutable" in r.headers["cache-control"]
+
+    r = client.get(f"/file/{id}", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.data == b""
+
+    r = client.get(f"/file/{id}", headers={"Range": "bytes=1000-1999"})
+    assert r.status_code == 206
+    assert r.headers["content-range"] == "bytes 1000-1999/5000"
+    assert r.data == content[1000:2000]
+
+    r = client.get(f"/file/{id}", headers={"Range": "bytes=4000-"})
+    assert r.status_code == 206
+    assert r.data == content[4000:]
+
+    r = client.get(f"/file/{id}", headers={"Range": "bytes=1000-1999", "If-Range": etag})
+    assert r.status_code == 206
+    r = client.get(f"/file/{id}", headers={"Range": "bytes=1000-1999", "If-Range": '"nope"'})
+    assert r.status_code == 200
+    assert r.data == content
+
+    r = client.get(f"/file/{id}", headers={"Range": "bytes=5000-"})
+    assert r.status_code == 416
+    assert r.headers["content-range"] == "bytes */5000"
+
+
+def test_file_cache(client, db, fresh_stats, monkeypatch):
+    monkeypatch.setattr(config, "FILE_STORAGE_DIR", None)
+    monkeypatch.setattr(cache, "files", cache.LocalCache(100_000))
+
+    small, big = os.urandom(1000), os.urandom(config.FILE_CACHE_MAX_FILE_SIZE + 1)
+    small_id, big_id = upload(client, small), upload(client, big)
+
+    for id in (small_id, big_id):
+        assert client.get(f"/file/{id}").status_code == 200
+
+    # Clobber the data in the database: the small file should still be served from the cache
+    with db.cursor() as cur:
+        cur.execute("UPDATE files SET data = 'x', size = 1")
+
+    assert client.get(f"/file/{small_id}").data == small
+    r = client.get(f"/file/{small_id}", headers={"Range": "bytes=10-19"})
+    assert r.status_code == 206
+    assert r.data == small[10:20]
+    assert cache.files.get(big_id) is None
+
+    assert cache.stats.counter("file_cache_hits") == 2
+
+    cache.drop_files([small_id])
+    assert client.get(f"/file/{small_id}").data == b'x'
+
+
+def test_missing_cache(client, fresh_stats, monkeypatch):
+    # Not running under uwsgi there is no shared cache, so the missing file cache is disabled:
+    assert cache.missing is None
+
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", False)
+    monkeypatch.setattr(cache, "missing", cache.LocalCache(1000))
+
+    content = os.urandom(100)
+    id = storage.upload_from_bytes(content).id
+
+    assert client.get(f"/file/{id}").status_code == 404
+    assert client.get(f"/file/{id}/info").status_code == 404
+    assert cache.stats.counter("missing_cache_adds") == 1
+    assert cache.stats.counter("missing_cache_hits") == 1
+
+    # Uploading the file must clear it from the cache:
+    assert upload(client, content) == id
+    assert client.get(f"/file/{id}").data == content
+
+
+def test_local_cache_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    import sys
+
+    # Switch threads as often as possible, so that unsynchronized access would go wrong:
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+
+    c = cache.LocalCache(1000)
+
+    def hammer(n):
+        for i in range(5000):
+            key = f"k{(n + i) % 4}"
+            c.set(key, b"x" * 300, ttl=(0 if i % 3 else 60))
+            c.get(key)
+            if i % 7 == 0:
+                c.delete(f"k{i % 4}")
+            c.incr("ops")
+
+    # Concurrent use (e.g. by ASGI handler threads) must not corrupt the size accounting:
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for f in [executor.submit(hammer, n) for n in range(8)]:
+                f.result()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert c.counter("ops") == 8 * 5000
+    assert c.size == sum(len(v) for v, _ in c.items.values()) <= 1000
+    c.set("new", b"y" * 100)
+    assert c.get("new") == b"y" * 100
+
+
+@pytest.mark.parametrize("promote", [False, True])
+def test_cold_tier(client, db, storage_mode, promote, monkeypatch):
+    from fileserver.cleanup import move_to_cold_tier
+
+    monkeypatch.setattr(config, "COLD_TABLE", "files_cold")
+    monkeypatch.setattr(config, "COLD_PROMOTE", promote)
+
+    old, new = os.urandom(1000), os.urandom(1000)
+    old_id, new_id = upload(client, old), upload(client, new)
+
+    with db.cursor() as cur:
+        cur.execute("UPDATE files SET accessed = NOW() - '1 week' WHERE id = %s", (old_id,))
+        move_to_cold_tier(cur)
+        cur.execute("SELECT id FROM files")
+        assert [r[0] for r in cur.fetchall()] == [new_id]
+        cur.execute("SELECT id FROM files_cold")
+        assert [r[0] for r in cur.fetchall()] == [old_id]
+
+    assert client.get(f"/file/{old_id}").data == old
+    assert client.get(f"/file/{old_id}/info").json["size"] == 1000
+
+    with db.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM files_cold")
+        assert cur.fetchone()[0] == (0 if promote else 1)
+
+    if storage_mode == "disk":
+        # A blob referenced only by a cold file must not get removed:
+        with db.cursor() as cur:
+            cur.execute("SELECT blob FROM files_cold UNION ALL SELECT blob FROM files")
+            assert storage.release_blobs(db, [r[0] for r in cur.fetchall()]) == 0
+
+
+def test_cold_reupload(client, db, storage_mode, monkeypatch):
+    from fileserver.cleanup import move_to_cold_tier
+
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", False)
+    monkeypatch.setattr(config, "COLD_TABLE", "files_cold")
+
+    content = os.urandom(1000)
+    id = upload(client, content)
+    with db.cursor() as cur:
+        cur.execute("UPDATE files SET accessed = NOW() - '1 week'")
+        move_to_cold_tier(cur)
+
+    # Re-uploading a cold file moves it back rather than storing a second copy:
+    assert upload(client, content) == id
+    with db.cursor() as cur:
+        cur.execute("SELECT id, expiry > NOW() + '1 day' FROM files")
+        assert cur.fetchall() == [(id, True)]
+        cur.execute("SELECT COUNT(*) FROM files_cold")
+        assert cur.fetchone()[0] == 0
+        cur.execute("SELECT SUM(files), SUM(bytes) FROM file_stats")
+        assert cur.fetchone() == (1, 1000)
+    assert client.get(f"/file/{id}").data == content
+
+
+def test_cold_compat_id_collision(client, db, fresh_stats, monkeypatch):
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", True)
+    monkeypatch.setattr(config, "COLD_TABLE", "files_cold")
+
+    # A legacy id (in the cold tier) that the compat id allocation then happens to produce:
+    legacy = 123456789
+    with db.cursor() as cur:
+        cur.execute(
+            "INSERT INTO files_cold (id, data, size) VALUES (%s, 'legacy', 6)", (str(legacy),)
+        )
+    allocated = iter([legacy, legacy + 1])
+    monkeypatch.setattr(compat_ids, "allocate", lambda cur: next(allocated))
+
+    assert upload(client, b"new") == str(legacy + 1)
+    assert cache.stats.counter("compat_id_retries") == 1
+    assert client.get(f"/file/{legacy}").data == b"legacy"
+    with db.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM files WHERE id = %s", (str(legacy),))
+        assert cur.fetchone()[0] == 0
+
+
+def test_expiry_batches(client, db, storage_mode, fresh_stats, monkeypatch):
+    from fileserver.cleanup import expire_files
+
+    monkeypatch.setattr(config, "EXPIRY_BATCH_SIZE", 10)
+    monkeypatch.setattr(config, "EXPIRY_TIME_BUDGET", 0)
+
+    ids = [upload(client, os.urandom(100)) for _ in range(25)]
+    with db.cursor() as cur:
+        cur.execute("UPDATE files SET expiry = NOW() - '1 hour' WHERE id <> %s", (ids[0],))
+
+    # Out of time after the first batch:
+    assert expire_files(db) == (10, 1000, 14)
+    assert cache.stats.counter("expiry_backlog") == 14
+
+    monkeypatch.setattr(config, "EXPIRY_TIME_BUDGET", 60)
+    assert expire_files(db) == (14, 1400, 0)
+    assert cache.stats.counter("expired_files") == 24
+    assert cache.stats.counter("expired_bytes") == 2400
+    assert cache.stats.counter("expiry_backlog") == 0
+
+    with db.cursor() as cur:
+        cur.execute("SELECT id FROM files")
+        assert [r[0] for r in cur.fetchall()] == [ids[0]]
+    assert client.get(f"/file/{ids[0]}").status_code == 200
+
+
+def test_partitioned_files(client, db, storage_mode, monkeypatch):
+    from fileserver.cleanup import maintain_partitions
+
+    with open(os.path.dirname(__file__) + "/../partition-files.pgsql") as f:
+        db.execute(f.read())
+    monkeypatch.setattr(config, "PARTITIONED_FILES", True)
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", False)
+    monkeypatch.setattr(cache, "missing", None)
+
+    content = os.urandom(1000)
+    id = upload(client, content)
+    assert client.get(f"/file/{id}").data == content
+
+    # Re-uploading refreshes the expiry, which moves the file into a later partition:
+    with db.cursor() as cur:
+        cur.execute("UPDATE files SET expiry = NOW() + '1 day'")
+    assert upload(client, content) == id
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            SELECT COUNT(*), bool_and(expiry > NOW() + '1 week'), bool_and(
+                tableoid::regclass::text
+                = 'files_p' || to_char((expiry AT TIME ZONE 'UTC')::date, 'YYYYMMDD'))
+            FROM files
+            """
+        )
+        assert cur.fetchone() == (1, True, True)
+
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", True)
+    compat_content = os.urandom(1000)
+    compat_id = upload(client, compat_content)
+    assert client.get(f"/file/{compat_id}").data == compat_content
+
+    # Maintenance doesn't drop current partitions:
+    assert maintain_partitions(db) == 0
+
+    with db.cursor() as cur:
+        cur.execute(
+            "CREATE TABLE files_p20000101 PARTITION OF files "
+            "FOR VALUES FROM ('2000-01-01 00:00 UTC') TO ('2000-01-02 00:00 UTC')"
+        )
+        cur.execute("UPDATE files SET expiry = '2000-01-01 12:00 UTC' WHERE id = %s", (id,))
+
+    # Expired files are not found even before their partition gets dropped:
+    assert client.get(f"/file/{id}").status_code == 404
+
+    assert maintain_partitions(db) == 1
+    with db.cursor() as cur:
+        cur.execute("SELECT id FROM files")
+        assert [r[0] for r in cur.fetchall()] == [compat_id]
+    if storage_mode == "disk":
+        assert not os.path.exists(storage.blob_path(id))
+
+
+def test_partitioned_compat_id_collision(client, db, fresh_stats, monkeypatch):
+    with open(os.path.dirname(__file__) + "/../partition-files.pgsql") as f:
+        db.execute(f.read())
+    monkeypatch.setattr(config, "PARTITIONED_FILES", True)
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", True)
+
+    # A legacy (random) id that the compat id allocation then happens to produce:
+    legacy = 123456789
+    with db.cursor() as cur:
+        cur.execute("INSERT INTO files (id, data, size) VALUES (%s, 'legacy', 6)", (str(legacy),))
+    allocated = iter([legacy, legacy + 1])
+    monkeypatch.setattr(compat_ids, "allocate", lambda cur: next(allocated))
+
+    assert upload(client, b"new") == str(legacy + 1)
+    assert cache.stats.counter("compat_id_retries") == 1
+    assert client.get(f"/file/{legacy}").data == b"legacy"
+    with db.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM files WHERE id = %s", (str(legacy),))
+        assert cur.fetchone()[0] == 1
+
+
+def test_file_stats(client, db, monkeypatch):
+    from fileserver.cleanup import expire_files, move_to_cold_tier
+    from fileserver.stats import compact_file_stats
+
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", False)
+    monkeypatch.setattr(config, "COLD_TABLE", "files_cold")
+
+    ids = [upload(client, os.urandom(size)) for size in (100, 200, 300, 400)]
+    with db.cursor() as cur:
+        cur.execute("UPDATE files SET uploaded = NOW() - '2 days' WHERE id = %s", (ids[0],))
+        cur.execute("UPDATE files SET expiry = NOW() - '1 hour' WHERE id = %s", (ids[1],))
+        cur.execute("UPDATE files SET accessed = NOW() - '1 week' WHERE id = %s", (ids[2],))
+        move_to_cold_tier(cur)
+    expire_files(db)
+
+    # A re-upload moves the file to the current day:
+    id = upload(client, b"\0" * 100)
+    with db.cursor() as cur:
+        cur.execute("UPDATE files SET uploaded = NOW() - '2 days' WHERE id = %s", (id,))
+    assert upload(client, b"\0" * 100) == id
+
+    r = client.get("/stats")
+    assert r.status_code == 200
+    assert r.json["files"] == 4
+    assert r.json["bytes"] == 100 + 300 + 400 + 100
+    assert r.json["tables"] == {
+        "files": {"files": 3, "bytes": 600},
+        "files_cold": {"files": 1, "bytes": 300},
+    }
+    assert [(d["files"], d["bytes"]) for d in r.json["days"]] == [(1, 100), (3, 800)]
+
+    # The counters must agree with the actual files:
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            SELECT (uploaded AT TIME ZONE 'UTC')::date, COUNT(*), SUM(size)
+            FROM (
+                SELECT uploaded, size FROM files UNION ALL SELECT uploaded, size FROM files_cold
+            ) f
+            GROUP BY 1 ORDER BY 1
+            """
+        )
+        assert [(d, f, b) for d, f, b in cur.fetchall()] == [
+            (datetime.date.fromisoformat(d["uploaded"]), d["files"], d["bytes"])
+            for d in r.json["days"]
+        ]
+        with db.transaction():
+            compact_file_stats(cur)
+    assert client.get("/stats").json == r.json
+
+    # Not available via onion requests, or from elsewhere:
+    monkeypatch.setattr(config, "ADMIN_ADDRESSES", [])
+    assert client.get("/stats").status_code == 403
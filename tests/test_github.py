@@ -0,0 +1,133 @@
+from fileserver import config, github
+from hashlib import blake2b
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import pytest
+import threading
+
+
+@pytest.fixture
+def github_api(monkeypatch):
+    """
+    Runs a local stand-in for the GitHub releases API.  Yields an object with the `releases` to
+    serve (a dict of project name to release list, or to an HTTP error code) and a `log` of the
+    requests made, as (project, If-None-Match, status) tuples.
+    """
+
+    class API:
+        releases = {}
+        log = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            assert path.startswith("/repos/") and path.endswith("/releases")
+            project = path[len("/repos/") : -len("/releases")]
+            releases = API.releases.get(project, 404)
+            if_none_match = self.headers.get("If-None-Match")
+            if isinstance(releases, int):
+                status, body = releases, b'{"message": "error"}'
+            else:
+                body = json.dumps(releases).encode()
+                etag = '"{}"'.format(blake2b(body, digest_size=8).hexdigest())
+                status = 304 if if_none_match == etag else 200
+            API.log.append((project, if_none_match, status))
+
+            self.send_response(status)
+            if status in (200, 304) and not isinstance(releases, int):
+                self.send_header("ETag", etag)
+            if status == 304:
+                self.end_headers()
+                return
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(config, "GITHUB_API", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(github, "_retry_at", {})
+
+    yield API
+
+    server.shutdown()
+    server.server_close()
+
+
+def release(version, assets, prerelease=False):
+    return {
+        "tag_name": version,
+        "html_url": f"https://github.com/oxen-io/session-desktop/releases/tag/{version}",
+        "name": f"Session {version}",
+        "body": "notes",
+        "prerelease": prerelease,
+        "assets": [{"name": a, "url": f"https://example.com/{a}"} for a in assets],
+    }
+
+
+def make_due(db):
+    with db.cursor() as cur:
+        cur.execute("UPDATE projects SET updated = NOW() - '1 day'::interval")
+
+
+def assets(db):
+    with db.cursor() as cur:
+        cur.execute("SELECT name, xmin::text FROM release_assets ORDER BY name")
+        return dict(cur.fetchall())
+
+
+def test_github_poll(client, db, github_api):
+    github_api.releases = {
+        "oxen-io/session-desktop": [
+            release("v1.3.0", ["beta.deb"], prerelease=True),
+            release("v1.2.3", ["a.deb", "b.exe"]),
+        ],
+        "oxen-io/session-android": [release("1.2.0", [])],
+        "oxen-io/session-ios": 500,
+    }
+
+    # Projects only get checked once they're due:
+    assert github.poll(db) == 0
+    assert github_api.log == []
+
+    make_due(db)
+    assert github.poll(db) == 2
+    assert sorted(github_api.log) == [
+        ("oxen-io/session-android", None, 200),
+        ("oxen-io/session-desktop", None, 200),
+        ("oxen-io/session-ios", None, 500),
+    ]
+
+    v = client.get("/session_version?platform=desktop").json
+    assert (v["result"], v["prerelease"]["result"]) == ("1.2.3", "1.3.0")
+    assert sorted(a["name"] for a in v["assets"]) == ["a.deb", "b.exe"]
+    assert client.get("/session_version?platform=android").json["result"] == "1.2.0"
+    assert client.get("/session_version?platform=ios").status_code == 502
+
+    # Unchanged releases just get a 304; the failed project isn't retried until later:
+    github_api.log.clear()
+    make_due(db)
+    assert github.poll(db) == 0
+    assert sorted((project, status) for project, _, status in github_api.log) == [
+        ("oxen-io/session-android", 304),
+        ("oxen-io/session-desktop", 304),
+    ]
+    assert all(inm is not None for _, inm, _ in github_api.log)
+
+    # Changed assets get updated, without touching the unchanged ones:
+    before = assets(db)
+    github_api.releases["oxen-io/session-desktop"][1] = release("v1.2.3", ["b.exe", "c.dmg"])
+    make_due(db)
+    assert github.poll(db) == 1
+    after = assets(db)
+    assert sorted(after) == ["b.exe", "beta.deb", "c.dmg"]
+    assert after["b.exe"] == before["b.exe"]
+    assert after["beta.deb"] == before["beta.deb"]
+
+    v = client.get("/session_version?platform=desktop").json
+    assert sorted(a["name"] for a in v["assets"]) == ["b.exe", "c.dmg"]
@@ -0,0 +1,52 @@
+from fileserver import config, metrics as metrics_
+import os
+import pytest
+
+
+@pytest.fixture
+def stats(fresh_stats, monkeypatch):
+    monkeypatch.setattr(metrics_, "_last_pool_stats", 0)
+
+
+def metrics(client):
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain; version=0.0.4")
+    values = {}
+    for line in r.get_data(as_text=True).splitlines():
+        if not line.startswith("#"):
+            k, v = line.rsplit(" ", 1)
+            values[k] = float(v)
+    return values
+
+
+def test_request_metrics(client, stats):
+    content = os.urandom(1234)
+    id = client.post("/file", data=content).json["id"]
+    for _ in range(3):
+        assert client.get(f"/file/{id}").data == content
+    assert client.get("/file/nosuchfile").status_code == 404
+
+    m = metrics(client)
+    assert m['sfs_requests_total{endpoint="submit_file",status="2xx"}'] == 1
+    assert m['sfs_requests_total{endpoint="get_file",status="2xx"}'] == 3
+    assert m['sfs_requests_total{endpoint="get_file",status="4xx"}'] == 1
+    assert m['sfs_request_bytes_total{endpoint="submit_file"}'] == 1234
+    assert m['sfs_response_bytes_total{endpoint="get_file"}'] >= 3 * 1234
+
+    count = m['sfs_request_duration_seconds_count{endpoint="get_file"}']
+    assert count == 4
+    assert m['sfs_request_duration_seconds_bucket{endpoint="get_file",le="+Inf"}'] == count
+    assert m['sfs_request_duration_seconds_sum{endpoint="get_file"}'] > 0
+
+    # Buckets are cumulative:
+    prefix = 'sfs_request_duration_seconds_bucket{endpoint="get_file"'
+    buckets = [v for k, v in m.items() if k.startswith(prefix)]
+    assert buckets == sorted(buckets)
+
+    assert m['sfs_db_pool_pool_size{pool="psql"}'] >= 1
+
+
+def test_metrics_access(client, stats, monkeypatch):
+    monkeypatch.setattr(config, "ADMIN_ADDRESSES", [])
+    assert client.get("/metrics").status_code == 403
@@ -1,5 +1,5 @@
 from fileserver.web import app
-from fileserver import crypto, db, utils
+from fileserver import config, crypto, db, onion_req, utils
 from nacl.bindings import (
     crypto_scalarmult,
     crypto_aead_xchacha20poly1305_ietf_encrypt,
@@ -11,6 +11,8 @@ import nacl.hashlib
 import struct
 import json
 import time
+import tracemalloc
+import pytest
 
 from nacl.public import PrivateKey
 
@@ -42,13 +44,18 @@ def build_payload(inner_json, inner_body=None, *, v, enc_type, outer_json_extra=
         assert inner_body is None
         inner_data = inner_json
     elif v == 4:
+        # For a batch request inner_body is the list of sub-request bodies
+        if inner_body is None:
+            inner_body = []
+        elif not isinstance(inner_body, list):
+            inner_body = [inner_body]
         inner_data = b''.join(
             (
                 b'l',
                 str(len(inner_json)).encode(),
                 b':',
                 inner_json,
-                *(() if inner_body is None else (str(len(inner_body)).encode(), b':', inner_body)),
+                *(x for b in inner_body for x in (str(len(b)).encode(), b':', b)),
                 b'e',
             )
         )
@@ -99,7 +106,7 @@ def build_payload(inner_json, inner_body=None, *, v, enc_type, outer_json_extra=
 def decrypt_reply(data, *, v, enc_type):
     """
     Parses a reply; returns the json metadata and the body.  Note for v3 that there is only json;
-    body will always be None.
+    body will always be None.  For a v4 batch reply body is the list of response bodies.
     """
     if v == 3:
         data = utils.decode_base64(data)
@@ -125,7 +132,12 @@ def decrypt_reply(data, *, v, enc_type):
         data = memoryview(data)[1:-1]
         json_data, data = utils.bencode_consume_string(data)
         json_ = json.loads(json_data.tobytes())
-        if data:
+        if isinstance(json_, list):
+            body = []
+            while data:
+                b, data = utils.bencode_consume_string(data)
+                body.append(b.tobytes())
+        elif data:
             body, data = utils.bencode_consume_string(data)
             assert len(data) == 0
             body = body.tobytes()
@@ -177,7 +189,9 @@ def test_v4(client):
 
     info, body = decrypt_reply(r.data, v=4, enc_type="xchacha20")
 
-    assert info == {'code': 200, 'headers': {'content-type': 'application/json'}}
+    assert info['code'] == 200
+    assert info['headers']['content-type'] == 'application/json'
+    assert 'etag' in info['headers']
 
     v = json.loads(body)
     assert -1 < time.time() - v.pop('updated') < 1
@@ -239,3 +253,111 @@ def test_v4_post_body(client):
 
     assert info == {'code': 200, 'headers': {'content-type': 'text/plain; charset=utf-8'}}
     assert body == b'not json (x-omg/all-your-base): ' + content
+
+
+def test_v4_file_range(client):
+    content = nacl.utils.random(1000)
+    r = client.post("/file", data=content)
+    assert r.status_code == 200
+    id = r.json['id']
+
+    req = {'method': 'GET', 'endpoint': f'/file/{id}', 'headers': {'Range': 'bytes=100-199'}}
+    r = client.post("/oxen/v4/lsrpc", data=build_payload(req, v=4, enc_type="xchacha20"))
+    assert r.status_code == 200
+
+    info, body = decrypt_reply(r.data, v=4, enc_type="xchacha20")
+    assert info['code'] == 206
+    assert info['headers']['content-range'] == 'bytes 100-199/1000'
+    assert body == content[100:200]
+
+    etag = info['headers']['etag']
+    req['headers'] = {'If-None-Match': etag}
+    r = client.post("/oxen/v4/lsrpc", data=build_payload(req, v=4, enc_type="xchacha20"))
+    info, body = decrypt_reply(r.data, v=4, enc_type="xchacha20")
+    assert info['code'] == 304
+    assert not body
+
+
+@pytest.mark.parametrize("storage_mode", ["db", "disk"])
+def test_v4_reply_memory(client, storage_mode, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        config, "FILE_STORAGE_DIR", str(tmp_path) if storage_mode == "disk" else None
+    )
+    size = config.MAX_FILE_SIZE
+    content = nacl.utils.random(size)
+    id = client.post("/file", data=content).json['id']
+
+    req = json.dumps({'method': 'GET', 'endpoint': f'/file/{id}'}).encode()
+    req = b'l%d:%se' % (len(req), req)
+
+    with app.test_request_context("/oxen/v4/lsrpc", method="POST"):
+        tracemalloc.start()
+        try:
+            reply = onion_req.handle_v4_onionreq_plaintext(req)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    assert reply.endswith(b'%d:' % size + content + b'e')
+    # The body gets written directly into the reply buffer rather than assembled and then copied:
+    # besides the reply itself we only allow for one DB_CHUNK_SIZE slice, and some overhead.
+    assert peak < size + 1_500_000
+
+
+def test_v4_batch(client):
+    update_session_desktop_version()
+    content = nacl.utils.random(1000)
+    id = client.post("/file", data=content).json['id']
+
+    reqs = [
+        {'method': 'GET', 'endpoint': f'/file/{id}'},
+        {'method': 'GET', 'endpoint': '/session_version?platform=desktop'},
+        {'method': 'GET', 'endpoint': f'/file/{id}', 'headers': {'Range': 'bytes=0-9'}},
+        {
+            'method': 'POST',
+            'endpoint': '/test_v4_post_body',
+            'headers': {'content-type': 'text/plain'},
+        },
+        {'method': 'GET', 'endpoint': '/nosuchendpoint'},
+    ]
+    bodies = [b'', b'', b'', b'hi', b'']
+    r = client.post("/oxen/v4/lsrpc", data=build_payload(reqs, bodies, v=4, enc_type="xchacha20"))
+    assert r.status_code == 200
+    info, body = decrypt_reply(r.data, v=4, enc_type="xchacha20")
+
+    assert [i['code'] for i in info] == [200, 200, 206, 200, 404]
+    assert body[0] == content
+    assert json.loads(body[1])['result'] == 'v1.2.3'
+    assert body[2] == content[:10]
+    assert info[2]['headers']['content-range'] == 'bytes 0-9/1000'
+    assert body[3] == b'not json (text/plain): hi'
+    assert len(body) == 5
+
+
+def test_v4_batch_limits(client, monkeypatch):
+    content = nacl.utils.random(1000)
+    id = client.post("/file", data=content).json['id']
+    req = {'method': 'GET', 'endpoint': f'/file/{id}'}
+
+    def batch(n):
+        data = build_payload([req] * n, [b''] * n, v=4, enc_type="xchacha20")
+        r = client.post("/oxen/v4/lsrpc", data=data)
+        assert r.status_code == 200
+        return decrypt_reply(r.data, v=4, enc_type="xchacha20")
+
+    # Too many sub-requests fails the whole request:
+    info, body = batch(config.ONION_BATCH_MAX_REQUESTS + 1)
+    assert info['code'] == 400
+
+    # Responses that don't fit in the size limit get replaced with 413s:
+    monkeypatch.setattr(config, "ONION_BATCH_MAX_SIZE", 2500)
+    info, body = batch(3)
+    assert [i['code'] for i in info] == [200, 200, 413]
+    assert body == [content, content, b'']
+
+    # A mismatched number of bodies is an error:
+    data = build_payload([req] * 2, [b''], v=4, enc_type="xchacha20")
+    info, body = decrypt_reply(
+        client.post("/oxen/v4/lsrpc", data=data).data, v=4, enc_type="xchacha20"
+    )
+    assert info['code'] == 400
@@ -0,0 +1,157 @@
+from fileserver import cache, config, db as db_, replication, version_checks
+import psycopg
+import pytest
+import os
+
+
+@pytest.fixture
+def slave(request, db, monkeypatch):
+    """Sets up a second schema in the test database to act as the slave database."""
+    conn = psycopg.connect(
+        request.config.getoption("--pgsql"),
+        options="-c search_path=sfs_tests_slave",
+        autocommit=True,
+    )
+    with conn.transaction(), conn.cursor() as cur, open(
+        os.path.dirname(__file__) + "/../schema.pgsql", "r"
+    ) as schema:
+        cur.execute("DROP SCHEMA IF EXISTS sfs_tests_slave CASCADE")
+        cur.execute("CREATE SCHEMA sfs_tests_slave")
+        cur.execute(schema.read())
+
+    monkeypatch.setattr(config, "pgsql_slave", {})
+    monkeypatch.setattr(db_, "slave", conn)
+
+    yield conn
+
+    with conn.cursor() as cur:
+        cur.execute("DROP SCHEMA sfs_tests_slave CASCADE")
+    conn.close()
+
+
+def slave_files(slave):
+    with slave.cursor() as cur:
+        cur.execute("SELECT id, data, expiry FROM files ORDER BY id")
+        return cur.fetchall()
+
+
+@pytest.mark.parametrize("compat_ids", [True, False])
+def test_replicate_files(client, db, slave, fresh_stats, compat_ids, monkeypatch):
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", compat_ids)
+
+    content = os.urandom(1000)
+    r = client.post("/file", data=content)
+    assert r.status_code == 200
+    id = r.json["id"]
+
+    # Nothing gets written to the slave during the request:
+    assert slave_files(slave) == []
+    with db.cursor() as cur:
+        assert replication.status(cur)[0] == 1
+
+    replication.replicate()
+    assert [(f[0], f[1]) for f in slave_files(slave)] == [(id, content)]
+    with db.cursor() as cur:
+        assert replication.status(cur) == (0, 0)
+    assert cache.stats.counter("replication_done") == 1
+
+    if not compat_ids:
+        # A re-upload refreshes the expiry on the slave as well:
+        with slave.cursor() as cur:
+            cur.execute("UPDATE files SET expiry = NOW() + '1 minute'")
+        assert client.post("/file", data=content).json["id"] == id
+        replication.replicate()
+        ((_, _, expiry),) = slave_files(slave)
+        with slave.cursor() as cur:
+            assert cur.execute("SELECT %s > NOW() + '1 day'", (expiry,)).fetchone()[0]
+
+
+def test_replication_retry(client, db, slave, fresh_stats):
+    with slave.cursor() as cur:
+        cur.execute("ALTER TABLE files RENAME TO files_gone")
+
+    ids = [client.post("/file", data=os.urandom(100)).json["id"] for _ in range(3)]
+    replication.replicate()
+
+    # Failed changes stay queued (and get retried later) rather than getting lost:
+    with db.cursor() as cur:
+        cur.execute("SELECT ref, attempts, next_attempt > NOW() FROM replication_outbox")
+        assert sorted(cur.fetchall()) == sorted((id, 1, True) for id in ids)
+        assert replication.status(cur)[0] == 3
+    assert cache.stats.counter("replication_failures") == 3
+
+    with slave.cursor() as cur:
+        cur.execute("ALTER TABLE files_gone RENAME TO files")
+    with db.cursor() as cur:
+        cur.execute("UPDATE replication_outbox SET next_attempt = NOW()")
+
+    replication.replicate()
+    assert sorted(f[0] for f in slave_files(slave)) == sorted(ids)
+    with db.cursor() as cur:
+        assert replication.status(cur)[0] == 0
+
+
+def test_replicate_version_checks(db, slave):
+    version_checks.flush()
+    version_checks.record("15" + "ab" * 32, "desktop")
+    version_checks.record("15" + "cd" * 32, "ios")
+    version_checks.flush()
+
+    # The whole flushed batch is queued as a single outbox entry:
+    with db.cursor() as cur:
+        assert replication.status(cur)[0] == 1
+
+    replication.replicate()
+    with slave.cursor() as cur:
+        cur.execute("SELECT blinded_id, platform FROM account_version_checks ORDER BY platform")
+        assert cur.fetchall() == [("15" + "ab" * 32, "desktop"), ("15" + "cd" * 32, "ios")]
+
+
+def test_partitioned_slave_expiry(db, slave, monkeypatch):
+    from fileserver.cleanup import expire_files
+
+    monkeypatch.setattr(config, "PARTITIONED_FILES", True)
+    for conn in (db, slave):
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO files (id, data, size, expiry)
+                VALUES ('expired', 'x', 1, NOW() - '1 hour'::interval)
+                """
+            )
+
+    # The primary's partitions get dropped by `maintain_partitions`, but nothing maintains
+    # partitions on the slave, so its expired files have to be deleted:
+    assert expire_files(db)[0] == 0
+    assert expire_files(slave)[0] == 1
+    assert slave_files(slave) == []
+
+
+def test_unpartitioned_slave_version_checks(db, slave):
+    # A slave that hasn't had upgrades/06 applied yet:
+    with slave.cursor() as cur:
+        cur.execute("DROP TABLE account_version_checks")
+        cur.execute(
+            """
+            CREATE TABLE account_version_checks (
+                blinded_id varchar(66) NOT NULL,
+                platform varchar(25) NOT NULL,
+                timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+            )
+            """
+        )
+
+    # Maintenance gets skipped there, but still happens on the primary:
+    version_checks.maintain(slave)
+    version_checks.maintain(db)
+    with slave.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM account_version_rollups")
+        assert cur.fetchone()[0] == 0
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            SELECT COUNT(*) FROM pg_inherits
+            WHERE inhparent = 'account_version_checks'::regclass
+            """
+        )
+        assert cur.fetchone()[0] == 4  # the default partition, plus 3 days
@@ -0,0 +1,48 @@
+from fileserver import serialize
+from datetime import datetime, timezone
+from decimal import Decimal
+import json
+import pytest
+
+
+@pytest.fixture(params=sorted(serialize.BACKENDS))
+def backend(request):
+    """Runs a test with each of the available JSON backends"""
+    default = serialize.backend
+    serialize.use(request.param)
+    yield request.param
+    serialize.use(default)
+
+
+def test_serialize(backend):
+    data = {
+        "value": Decimal("0.123400"),
+        "updated": datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+        "name": "Session ✓",
+        "list": [1, 2.5, None, True],
+        3: "x",
+    }
+    assert serialize.dumps(data) == (
+        '{"value":"0.123400","updated":1704164645.0,"name":"Session ✓","list":[1,2.5,null,true],'
+        '"3":"x"}'
+    ).encode()
+
+    assert serialize.loads(serialize.dumps(data))["name"] == "Session ✓"
+    assert serialize.loads('{"a": [1]}') == {"a": [1]}
+
+    with pytest.raises(json.JSONDecodeError):
+        serialize.loads(b'{"a": ')
+    with pytest.raises(TypeError):
+        serialize.dumps({"a": object()})
+
+
+def test_error_bodies(client, backend):
+    assert serialize.status_body(404) == serialize.dumps({"status_code": 404})
+
+    r = client.get("/session_version?platform=nokia")
+    assert r.status_code == 404
+    assert r.data == b'{"status_code":404}'
+
+    r = client.post("/files", json={"not a file": 123})
+    assert r.status_code == 400
+    assert r.json == {"status_code": 400}
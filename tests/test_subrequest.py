@@ -0,0 +1,75 @@
+from fileserver import config, subrequest
+from fileserver.web import app
+import json
+import pytest
+import os
+
+
+def subreq(*args, **kwargs):
+    with app.test_request_context("/oxen/v4/lsrpc", method="POST"):
+        response, headers = subrequest.make_subrequest(*args, **kwargs)
+        return response.status_code, headers, response.get_data()
+
+
+@pytest.fixture
+def both_paths(monkeypatch):
+    """Returns a function making a sub-request via both the fast path and flask dispatch"""
+    calls = []
+    fast_subrequest = subrequest.fast_subrequest
+
+    def counting_fast_subrequest(*args):
+        response = fast_subrequest(*args)
+        calls.append(response is not None)
+        return response
+
+    monkeypatch.setattr(subrequest, "fast_subrequest", counting_fast_subrequest)
+
+    def make(*args, fast=True, **kwargs):
+        calls.clear()
+        monkeypatch.setattr(config, "SUBREQUEST_FAST_PATH", True)
+        fast_result = subreq(*args, **kwargs)
+        assert calls == [fast]
+        monkeypatch.setattr(config, "SUBREQUEST_FAST_PATH", False)
+        flask_result = subreq(*args, **kwargs)
+        # (The max-age of file downloads counts down, so could differ by a second)
+        for _, headers, _ in (fast_result, flask_result):
+            headers.pop("cache-control", None)
+        assert flask_result == fast_result
+        return fast_result
+
+    return make
+
+
+def test_fast_subrequests(db, both_paths, monkeypatch):
+    monkeypatch.setattr(config, "BACKWARDS_COMPAT_IDS", False)
+    content = os.urandom(1000)
+    code, _, body = both_paths("POST", "/file", body=content)
+    assert code == 200
+    id = json.loads(body)["id"]
+
+    code, headers, body = both_paths("GET", f"/file/{id}")
+    assert (code, body) == (200, content)
+    assert headers["etag"] == f'"{id}"'
+
+    code, headers, body = both_paths("GET", f"/file/{id}", headers={"Range": "bytes=10-19"})
+    assert (code, body) == (206, content[10:20])
+
+    code, _, _ = both_paths("GET", f"/file/{id}", headers={"If-None-Match": f'"{id}"'})
+    assert code == 304
+
+    code, _, body = both_paths("GET", f"/file/{id}/info")
+    assert code == 200 and json.loads(body)["size"] == 1000
+
+    assert both_paths("GET", "/file/nosuchfile")[0] == 404
+    assert both_paths("GET", "/session_version?platform=nope")[0] == 404
+    code, _, body = both_paths(
+        "GET", "/session_version?platform=desktop", headers={"X-FS-Pubkey": "abc"}
+    )
+    assert code == 400 and b"auth headers is missing" in body
+
+
+def test_subrequest_fallback(db, both_paths):
+    # Anything other than the fast endpoints goes through flask:
+    assert both_paths("GET", "/nosuchendpoint", fast=False)[0] == 404
+    assert both_paths("DELETE", "/file/abc", fast=False)[0] == 405
+    assert both_paths("GET", "/stats", fast=False)[0] == 403
@@ -0,0 +1,58 @@
+from fileserver import cache, token_info
+from datetime import datetime, timedelta, timezone
+
+
+def add_history(db, *samples):
+    with db.cursor() as cur:
+        cur.executemany(
+            """
+            INSERT INTO session_token_history
+                (current_value, circulating_supply, total_nodes, updated)
+            VALUES (%s, %s, %s, %s)
+            """,
+            samples,
+        )
+        token_info.poll(cur)
+
+
+def test_token_info(client, db, fresh_stats):
+    assert client.get("/token_info").status_code == 502
+
+    with db.cursor() as cur:
+        cur.execute("INSERT INTO session_token_stats VALUES (240000000, 25000, 40000000)")
+
+    hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    old = hour - timedelta(days=10)
+    add_history(
+        db,
+        ("1.5", 100, 1000, old),
+        ("1.25", 110, 1001, hour - timedelta(hours=1)),
+        # Only the latest sample of each hour is returned:
+        ("2.000001", 120, 1002, hour),
+        ("2.5", 130, 1003, hour + timedelta(seconds=30)),
+    )
+
+    r = client.get("/token_info")
+    assert r.status_code == 200
+    info = r.json["info"]
+    assert (info["maximum_supply"], info["sent_per_node"], info["staking_reward_pool"]) == (
+        240000000,
+        25000,
+        40000000,
+    )
+    assert [(h["current_value"], h["total_nodes"]) for h in info["history"]] == [
+        ("1.250000", 1001),
+        ("2.500000", 1003),
+    ]
+    assert info["history"][-1]["updated"] == (hour + timedelta(seconds=30)).timestamp()
+
+    assert len(client.get("/token_info?days=30").json["info"]["history"]) == 3
+
+    # Cached until new history arrives:
+    hits = cache.stats.counter("token_info_cache_hits")
+    assert client.get("/token_info").data == r.data
+    assert cache.stats.counter("token_info_cache_hits") == hits + 1
+
+    add_history(db, ("3", 140, 1004, hour + timedelta(seconds=60)))
+    history = client.get("/token_info").json["info"]["history"]
+    assert history[-1]["current_value"] == "3.000000"
@@ -0,0 +1,149 @@
+from fileserver import cache, config, replication, version_checks
+from fileserver.hll import HyperLogLog
+from datetime import datetime, timedelta, timezone
+import os
+import pytest
+import time
+
+
+@pytest.fixture(autouse=True)
+def buffer(monkeypatch):
+    """Starts each test with an empty buffer, and no flushes happening on their own"""
+    monkeypatch.setattr(config, "VERSION_CHECK_FLUSH_INTERVAL", 3600)
+    version_checks._buffer.clear()
+    yield
+    version_checks._buffer.clear()
+
+
+def version_checks_in(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT blinded_id, platform FROM account_version_checks ORDER BY blinded_id")
+        return cur.fetchall()
+
+
+def test_buffered_version_checks(db, fresh_stats):
+    for i in range(5):
+        version_checks.record(f"15{i:064x}", "desktop")
+
+    # Nothing is written until the buffer gets flushed:
+    assert version_checks_in(db) == []
+    assert version_checks.pending() == 5
+
+    assert version_checks.flush() == 5
+    assert version_checks_in(db) == [(f"15{i:064x}", "desktop") for i in range(5)]
+    assert version_checks.pending() == 0
+    assert cache.stats.counter("version_checks_written") == 5
+
+
+def test_version_check_batch_trigger(db, monkeypatch):
+    monkeypatch.setattr(config, "VERSION_CHECK_BATCH_SIZE", 3)
+    for i in range(3):
+        version_checks.record(f"15{i:064x}", "ios")
+
+    # Filling the buffer wakes up the flusher thread:
+    for _ in range(50):
+        if len(version_checks_in(db)) == 3:
+            break
+        time.sleep(0.1)
+    assert len(version_checks_in(db)) == 3
+
+
+def test_version_check_flush_failure(db, fresh_stats, monkeypatch):
+    monkeypatch.setattr(config, "VERSION_CHECK_MAX_BUFFER", 4)
+
+    def fail(cur, rows):
+        raise RuntimeError("database on fire")
+
+    for i in range(3):
+        version_checks.record(f"15{i:064x}", "android")
+    queue_version_checks = replication.queue_version_checks
+    monkeypatch.setattr(replication, "queue_version_checks", fail)
+    with pytest.raises(RuntimeError):
+        version_checks.flush()
+
+    # Failed checks go back in the buffer, but it doesn't grow beyond the limit:
+    for i in range(3, 5):
+        version_checks.record(f"15{i:064x}", "android")
+    assert version_checks.pending() == 4
+    assert cache.stats.counter("version_checks_dropped") == 1
+
+    monkeypatch.setattr(replication, "queue_version_checks", queue_version_checks)
+    assert version_checks.flush() == 4
+    assert version_checks_in(db) == [(f"15{i:064x}", "android") for i in range(1, 5)]
+
+
+def add_checks(db, day, platform, ids, repeat=1):
+    with db.cursor() as cur:
+        cur.executemany(
+            """
+            INSERT INTO account_version_checks (blinded_id, platform, timestamp)
+            VALUES (%s, %s, %s)
+            """,
+            [(f"15{i:064x}", platform, version_checks.partition_start(day)) for i in ids] * repeat,
+        )
+
+
+def partitions(db):
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'account_version_checks'::regclass ORDER BY 1
+            """
+        )
+        return [r[0] for r in cur.fetchall()]
+
+
+def test_version_check_rollups(client, db, monkeypatch):
+    monkeypatch.setattr(config, "VERSION_CHECK_RETENTION_DAYS", 3)
+    today = datetime.now(timezone.utc).date()
+    old, yesterday = today - timedelta(days=5), today - timedelta(days=1)
+
+    add_checks(db, old, "android", range(100))
+    add_checks(db, yesterday, "android", range(50, 150), repeat=2)
+    add_checks(db, yesterday, "ios", range(1000, 1200))
+    add_checks(db, today, "ios", range(10))
+
+    # Partitions get created (taking today's checks out of the default partition); one finished
+    # day gets rolled up per call, after which checks past the retention period are removed:
+    version_checks.maintain(db)
+    assert partitions(db) == ["account_version_checks_default"] + [
+        f"account_version_checks_p{today + timedelta(days=n):%Y%m%d}" for n in range(3)
+    ]
+    with db.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM account_version_checks_default")
+        assert cur.fetchone()[0] == 400  # Yesterday's; the old ones are rolled up and removed
+    version_checks.maintain(db)
+    with db.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM account_version_checks")
+        assert cur.fetchone()[0] == 400 + 10
+
+    r = client.get("/stats/version_checks?days=7")
+    assert r.status_code == 200
+    stats = r.json["platforms"]
+    assert stats["android"]["checks"] == 300
+    assert stats["android"]["users"] == pytest.approx(150, rel=0.05)
+    assert stats["ios"]["checks"] == 200
+    assert stats["*"]["checks"] == 500
+    assert stats["*"]["users"] == pytest.approx(350, rel=0.05)
+    assert [d[:2] for d in stats["*"]["days"]] == [
+        [old.isoformat(), 100],
+        [yesterday.isoformat(), 400],
+    ]
+
+    assert client.get("/stats/version_checks?days=0").status_code == 400
+
+
+def test_hyperloglog():
+    a, b = HyperLogLog(), HyperLogLog()
+    assert a.count() == 0
+    ids = [os.urandom(33).hex() for _ in range(20000)]
+    for id in ids[:15000]:
+        a.add(id)
+    for id in ids[5000:]:
+        b.add(id)
+    assert a.count() == pytest.approx(15000, rel=0.05)
+    assert len(a.to_bytes()) == 4096
+
+    merged = HyperLogLog.from_bytes(a.to_bytes()).merge(b)
+    assert merged.count() == pytest.approx(20000, rel=0.05)
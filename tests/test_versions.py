@@ -0,0 +1,74 @@
+from fileserver import cache, versions
+import pytest
+
+
+def add_release(db, version_code, name, prerelease=False, assets=()):
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO releases (project, prerelease, version_code, url, name)
+            SELECT id, %s, %s, 'https://example.com', %s FROM projects
+            WHERE name = 'oxen-io/session-desktop'
+            RETURNING id
+            """,
+            (prerelease, version_code, name),
+        )
+        (id,) = cur.fetchone()
+        for asset in assets:
+            cur.execute(
+                "INSERT INTO release_assets (release, name, url) VALUES (%s, %s, %s)",
+                (id, asset, f"https://example.com/{asset}"),
+            )
+
+
+def test_session_version(client, db):
+    add_release(db, 1002003, "v1.2.3", assets=["a.deb", "b.exe"])
+    add_release(db, 1003000, "v1.3.0 beta", prerelease=True)
+
+    r = client.get("/session_version?platform=desktop")
+    assert r.status_code == 200
+    v = r.json
+    updated = v.pop("updated")
+    assert v == {
+        "status_code": 200,
+        "result": "1.2.3",
+        "name": "v1.2.3",
+        "assets": [
+            {"name": "a.deb", "url": "https://example.com/a.deb"},
+            {"name": "b.exe", "url": "https://example.com/b.exe"},
+        ],
+        "prerelease": {"result": "1.3.0", "updated": updated, "name": "v1.3.0 beta"},
+    }
+    etag = r.headers["ETag"]
+
+    r = client.get("/session_version?platform=desktop", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert not r.data
+
+
+def test_session_version_cached(client, db):
+    add_release(db, 1002003, "v1.2.3")
+    r = client.get("/session_version?platform=desktop")
+    assert r.json["result"] == "1.2.3"
+    etag = r.headers["ETag"]
+    hits = cache.stats.counter("version_cache_hits")
+
+    # Served from the cache until the poller refreshes it:
+    add_release(db, 1002004, "v1.2.4")
+    r = client.get("/session_version?platform=desktop")
+    assert (r.json["result"], r.headers["ETag"]) == ("1.2.3", etag)
+    assert cache.stats.counter("version_cache_hits") == hits + 1
+
+    with db.cursor() as cur:
+        versions.refresh(cur, "desktop")
+    r = client.get("/session_version?platform=desktop")
+    assert r.json["result"] == "1.2.4"
+    assert r.headers["ETag"] != etag
+
+
+@pytest.mark.parametrize("platform", ["android", "ios"])
+def test_session_version_unavailable(client, platform):
+    # Projects without releases are an error, and don't get cached:
+    assert client.get(f"/session_version?platform={platform}").status_code == 502
+    assert cache.versions.get(platform) is None
+    assert client.get("/session_version?platform=windows95").status_code == 404